@@ -2,27 +2,65 @@ from arcgis.gis import GIS
 import arcgis
 from arcgis.geometry import filters
 import arcpy
+import atexit
+import contextlib
+import csv
+import hashlib
+import itertools
 import json
 from collections import defaultdict
 import os
 import sys
+import time
+import random
+import sqlite3
+import threading
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+import numpy as np
 import openpyxl
+from openpyxl.utils.cell import column_index_from_string, range_boundaries
 from pathlib import Path
+from urllib.parse import urlsplit
 
 
 # Author - Ruben Brionez Jr
 # Credits - Tiffany Rufo and the Omni Fiber GIS Department
 
-# TODO: Add fail safe for inaccessible layers in portal
 # TODO: Incorporate special crossings.
 # TODO: Create a function to get a assumption on number of anchors based on strand features * 4
-# TODO: Exclude features within an MDU Boundary
 # TODO: Add a .lower() to anything that may be missed due to capitalization
-# TODO: Add exclusion for 'Existing' features in Status
-# TODO: Add a clipping function for strand and conduit for better accuracy OR defer to vendors for drafting
 # TODO: Re-work the HHP calculations, revisit MDU, FDH HHPs and DNB HHPs - Use all address points? except in MDU?
 # TODO: Messages should report back linear footages so people know things.
 
+# Change Log 10-18-2026
+# Version 1.5
+""" - Added Portal request timeouts, retries and hedging; stages that still fail are reported as FAILED, not zero.
+    - Poles on strand, conduit at poles and addresses in DNB are joined locally with a spatial index.
+    - Added EXCLUDE_MDU_FEATURES to report the BOM with and without features inside MDU boundaries.
+    - Added CLIP_TO_FDH to count only the share of strand and conduit inside the FDH.
+    - Added VALIDATE_LENGTHS / USE_RECOMPUTED_LENGTHS to flag and replace stale footage attributes.
+    - Added PLAN_QUERIES to read each layer once per FDH for every stage.
+    - Stage attribute filters are sent in the where clause; added EXCLUDE_EXISTING.
+    - Added NATIVE_SR_QUERIES to query layers in their own spatial reference and project locally.
+    - Added USE_MEMBERSHIP_TABLE to fetch each FDH's features by OBJECTID from a local membership table.
+    - Added USE_FDH_INDEX, a local FDH boundary index used for FDH selection and lookups.
+    - Added INCREMENTAL_REFRESH to recompute only the FDHs and stages touched by edits.
+    - BOM calculations moved to a derivation graph (DERIVATIONS) fed by BOM_STAGES.
+    - Engineering factors moved to BOM_FACTORS; added SWEEP_FACTORS.
+    - Added a cost engine (RateCards) pricing BOMs from the template's rate cards; added PRICE_CACHED_FDHS.
+    - Added a run history (RECORD_RUNS, COMPARE_RUNS_FOR, LATEST_FOR_SERV_AREA).
+    - Added City_Code / Serv_Area / market roll-ups (UPDATE_ROLLUPS).
+    - Added a warm BOM service on localhost (RUN_SERVICE, USE_SERVICE) in bom_service.py.
+    - Added PREFETCH_SERV_AREA to read each layer once per Serv_Area batch.
+    - Added TILE_QUERIES to split dense reads into quadtree tiles.
+    - Added SHARD_READS to read large layers in OBJECTID-range shards.
+    - Added a Portal record / replay mode (CASSETTE_MODE) in portal_cassette.py.
+    - Added a local Portal emulator (EMULATOR_DIR) in portal_emulator.py.
+    - Added a per-host request governor (GOVERN_REQUESTS).
+    - Added a resumable batch over the selected FDHs (RUN_SELECTED_FDHS, BATCH_JOURNAL).
+    - Added snapshot-consistent reads (SNAPSHOT_READS)."""
+
 # Change Log 06-17-2024
 # Version 1.4
 """ - Added functionality to correctly select FDH layer name, either FDH_Boundary or FDH Boundary will work.
@@ -104,6 +142,167 @@ sys.path.append(script_dir)
 arcpy.AddMessage("**** BOM Processing v1.4 - June 2025 ****\n"
                  "\n")
 
+# Portal request settings
+DEFAULT_LAYER_TIMEOUT = 60  # Seconds to wait for a single layer query before it is abandoned
+LAYER_TIMEOUTS = {  # Per-layer timeout overrides keyed by Portal item id
+    "dfb329f0de874dbca01eee76133c250d": 180,  # Address Master is the largest layer we read
+}
+QUERY_RETRIES = 3  # Extra attempts for a query that timed out or hit a transient (5xx / 429) error
+QUERY_BACKOFF = 2  # Seconds to wait before the first retry, doubled on every retry after that
+HEDGE_REQUESTS = False  # Send a duplicate request when a query runs longer than its p95 latency
+HEDGE_MIN_SAMPLES = 5  # Latency samples needed for a layer before hedging kicks in
+
+# Portal concurrency governor settings
+GOVERN_REQUESTS = False  # Pace the requests sent to each Portal host and adapt how many run at once
+HOST_RATE = 10  # Requests per second sent to one host at most (token bucket refill rate)...
+HOST_BURST = 20  # ...with up to this many at once after a quiet spell (token bucket size)
+MIN_CONCURRENCY = 1  # Requests in flight per host, the adaptive limit stays between these
+MAX_CONCURRENCY = 16
+INITIAL_CONCURRENCY = 4
+CONCURRENCY_BACKOFF = 0.5  # Limit and rate are multiplied by this on a 429/503, a timeout or a slow response...
+BACKOFF_COOLDOWN = 1.0  # ...at most once per this many seconds, and grows by one per limit's worth of good responses
+SLOW_RESPONSE_FACTOR = 3.0  # A response this many times the layer's median latency counts as congestion
+BATCH_SHARE = 0.75  # Share of the limit batch requests may use, the rest is kept for interactive runs
+
+# Local Portal emulator settings
+EMULATOR_DIR = None  # Folder of <item id>.geojson files answering every Portal request instead of Portal
+EMULATOR_LATENCY = 0.1  # Seconds per emulated request...
+EMULATOR_JITTER = 0.05  # ...plus up to this many seconds more
+EMULATOR_BANDWIDTH = None  # Bytes per second of emulated responses, None: unlimited
+EMULATOR_MAX_RECORD_COUNT = 2000  # Features per emulated page (maxRecordCount)
+EMULATOR_RATE_LIMIT = None  # Requests per second before the emulator answers 429, None: no throttling
+EMULATOR_ERROR_RATE = 0.0  # Fraction of emulated requests that fail with a 503
+
+# Record / replay settings
+CASSETTE_MODE = None  # "record": save every Portal request of the run with its response, "replay": answer from it
+CASSETTE_PATH = os.path.join(script_dir, "bom_cassette.json.gz")
+REPLAY_LATENCY_SCALE = 1.0  # A replayed response waits its recorded time multiplied by this (0: no waiting)
+
+portal_layers = {}  # Portal item id -> resolved feature layer
+query_latencies = defaultdict(list)  # Portal item id -> successful query durations in seconds
+cassette = None  # portal_cassette.Cassette of the run (CASSETTE_MODE)
+cassette_lock = threading.Lock()
+host_governors = {}  # Portal host -> HostGovernor (GOVERN_REQUESTS)
+governor_lock = threading.Lock()
+request_lock = threading.Lock()  # Guards the per-FDH request counts
+request_context = threading.local()  # Priority ("interactive" or "batch") and BomContext of a thread's requests
+
+# Snapshot settings
+SNAPSHOT_READS = False  # Pin every layer read of one BOM to one moment (adds a count query per layer and FDH)
+SNAPSHOT_GDB_VERSION = None  # Version read from versioned layers without an archive, one that is not edited during runs
+SNAPSHOT_RETRIES = 1  # Times a BOM is read again when a layer read as it is now was edited during the reads
+
+# Local spatial join settings
+JOIN_SR = 102100  # Features used in local spatial joins are held in Web Mercator (meters), geodesic lengths assume it
+JOIN_TOLERANCE = 0.01  # Meters, a pole within this distance of a strand or duct counts as touching it
+
+# MDU exclusion settings
+EXCLUDE_MDU_FEATURES = False  # Export the BOM without features inside MDU boundaries (both versions are reported)
+MDU_EXEMPT_STAGES = {"FDH Selection", "Addresses", "MDU Exclusion"}  # Stages that always see MDU features
+
+# Clipping settings
+CLIP_TO_FDH = False  # Clip strand and conduit to the FDH boundary instead of counting only whole features inside it
+FEET_PER_METER = 3.280839895
+
+# Length validation settings
+VALIDATE_LENGTHS = False  # Compare stored footage attributes with the geodesic length of each line feature
+USE_RECOMPUTED_LENGTHS = False  # Replace stale footage attributes with the geodesic length before aggregating
+LENGTH_TOLERANCE_FT = 10  # A stored length is stale when it is off by more than this many feet...
+LENGTH_TOLERANCE_PCT = 5  # ...and by more than this percent of the geodesic length
+LENGTH_FIELDS = {  # Portal item id -> (layer label, stored footage field)
+    "d8380eadf1514800ba303842456798b1": ("Cable", "LengthFT"),
+    "a1950b90b7214b30867bd57bb7760626": ("Strand", "calcfootage"),
+    "cd6de7b04ed144fe833317fd7fd7731e": ("Conduit", "UG1FT"),
+    "9f7962eb211a451da43748fd21122911": ("Drops", "calcfootage"),
+}
+
+# Query planner settings
+PLAN_QUERIES = False  # Merge every stage's reads of a layer into one Portal query per layer per FDH
+PREFETCH_SERV_AREA = True  # In a batch, read each layer once per Serv_Area and split it among its FDHs (PLAN_QUERIES)
+SERV_AREA_MIN_FDHS = 3  # FDHs of one Serv_Area a batch needs before its layers are read for the whole extent
+
+# Sharded read settings
+SHARD_READS = False  # Read large layers as parallel OBJECTID-range shards instead of pages that skip rows
+SHARD_SIZE = 1000  # OBJECTIDs per shard
+SHARDED_LAYERS = {  # Portal item ids whose reads inside an FDH are sharded (whole-layer downloads always are)
+    "dfb329f0de874dbca01eee76133c250d",  # Address Master
+    "9f7962eb211a451da43748fd21122911",  # Drops
+}
+
+# Tiled fetch settings
+TILE_QUERIES = False  # Count each layer in the FDH first and fetch dense layers in parallel tiles
+TILE_FEATURE_LIMIT = None  # Features per tile, None: the layer's maxRecordCount
+TILE_MAX_DEPTH = 4  # Quadtree levels, a tile is split in four while it holds more than the limit
+
+# Attribute filter settings
+EXCLUDE_EXISTING = False  # Leave out network features whose status is 'Existing' (pushed into the server query)
+STATUS_FIELD = "Status"
+EXISTING_EXEMPT_STAGES = {"Addresses"}  # Stages that keep existing features
+compiled_predicates = {}  # Where clause -> the attribute predicates it was compiled from
+
+# Batch settings
+RUN_SELECTED_FDHS = False  # Build (and export) the BOM of every FDH selected in the map as one batch
+BATCH_JOURNAL = False  # Journal every finished stage, BOM and export so a restarted batch picks up where it stopped
+JOURNAL_FSYNC = True  # Sync every journal line to disk, a crash loses at most the line being written
+
+# Local database settings
+LOCAL_DB = os.path.join(script_dir, "bom_local.sqlite")  # FDH index and feature-to-FDH membership table
+USE_FDH_INDEX = False  # Look FDH boundaries up in the local index instead of querying Portal for every run
+FDH_INDEX_REFRESH = True  # Pull FDH boundary edits into the index at the start of a run (off: no network calls)
+USE_MEMBERSHIP_TABLE = False  # Fetch features by OBJECTID from the feature-to-FDH table instead of spatial queries
+INCREMENTAL_REFRESH = False  # Recompute only the FDHs touched by edits since the last run and list changed cells
+RECORD_RUNS = False  # Keep every run's BOM values, stage timings and layer edit versions in the local database
+COMPARE_RUNS_FOR = None  # cab_id: print what changed between its last two recorded runs and stop
+LATEST_FOR_SERV_AREA = None  # Serv_Area: print the latest recorded BOM of each of its FDHs and stop
+UPDATE_ROLLUPS = False  # Keep City_Code / Serv_Area / market totals of every recorded FDH up to date
+REPORT_ROLLUPS = False  # Print the rollup totals of every City_Code and Serv_Area and stop
+ROLLUP_QUANTITIES = (  # BOM quantities summed in the rollups, footage unrounded
+    "total_f1", "total_f2", "strand_ftg", "total_hhp", "drop_count", "total_hhp_mdu", "total_cabinets",
+    "active_cabinet_count", "total_strand_ftg", "total_ug1ft", "total_ae_ftg", "total_ug_ftg", "total_pole_count",
+    "fp_count", "total_anchors")
+ROLLUP_DERIVED = (  # Derived from the summed quantities when a rollup is read (DERIVATIONS), rounded once
+    "total_f1_miles", "total_f2_miles", "est_total_miles", "ae_bom_miles", "ug_bom_miles", "percent_ae", "percent_ug")
+MEMBERSHIP_CHUNK = 500  # OBJECTIDs per attribute-only query
+
+# Spatial reference settings
+NATIVE_SR_QUERIES = False  # Query each layer in its own spatial reference and project locally, not on the server
+COMPARE_SR_TIMING = False  # Also time every query with server-side reprojection and report the difference
+WEB_MERCATOR_WKIDS = {102100, 102113, 3857, 900913}
+GEOGRAPHIC_WGS84_WKIDS = {4326}
+
+layer_wkids = {}  # Portal item id -> native spatial reference wkid of the layer
+fdh_index = {}  # In-memory copy of the local FDH index: features, R-tree and cab_id lookup
+sr_timings = defaultdict(list)  # Portal item id -> (native seconds, reprojected seconds) per compared query
+
+# BOM factors, inputs of the derivation graph
+BOM_FACTORS = {
+    "strand_sag": 1.10,  # Strand footage multiplier for sag
+    "anchor_strand_ft": 25,  # Strand footage added per anchor
+    "coupler_spacing_ft": 300,  # Conduit footage per coupler
+    "grounded_pole_ratio": 0.25,  # Grounded poles per pole on strand
+    "tree_trimming_ratio": 0.175,  # Tree trimming footage per strand foot
+    "lashing_wire_ratio": 1.5,  # Lashing wire footage per strand foot
+    "special_crossing_ft": 50,  # Footage added to the 4" conduit for a special crossing
+    "sp3_base": 24,  # Base SP3 count added to the non-F1 SP3 total
+}
+SWEEP_FACTORS = {}  # BOM factor -> values to try on every FDH cached in the local database, e.g. {"strand_sag": [1.08]}
+
+# Cost engine settings
+PRICE_CACHED_FDHS = False  # Price every FDH cached in the local database for every vendor in the template's rate cards
+RATE_CARD_SHEETS = {"RateCard": "Construction", "RateCard_E": "Design"}  # Rate card sheet -> the cost it prices
+VENDOR_CELL = "E2"  # Cell of each rate card sheet holding the selected vendor, its list offers the vendors
+RATE_CARD_HEADER_ROW = 3  # Row of each rate card sheet naming the vendor above each rate column
+RATE_CARD_ITEM_COLUMN = "A"  # Column of each rate card sheet holding the line item code (see RATE_CARD_LINES)
+RATE_CARD_TOTAL_CELLS = {"RateCard": None, "RateCard_E": None}  # Rate card sheet -> "Sheet!Cell" of its total
+cost_models = {}  # Template path -> RateCards, the rate cards are read once
+
+# BOM service settings
+RUN_SERVICE = False  # Keep this process running as a warm BOM service on localhost instead of running one FDH
+USE_SERVICE = False  # Send the FDH to the BOM service when one is running, otherwise run the BOM here
+SERVICE_PORT = 8765  # localhost port of the BOM service
+SERVICE_TIMEOUT = 600  # Seconds the script tool waits for the BOM service to answer
+SERVICE_SYNC_SECONDS = 30  # The service pulls Portal edits at most this often (a request can ask for a refresh)
+
 
 def get_one_drive_documents():
     user_profile = Path(os.environ["USERPROFILE"])
@@ -114,6 +313,2131 @@ def get_one_drive_documents():
     return str(user_profile / "Documents")
 
 
+def export_output_path(cab_id):
+    """The Excel output path from the tool parameters, or BOM_<cab_id>_<timestamp>.xlsx in OneDrive Documents."""
+    # Fallback name
+    default_filename = "Exported_BOM.xlsx"
+    if cab_id:
+        timestamp = datetime.now().strftime("%m-%d-%Y_%H%M%S")
+        default_filename = f"BOM_{cab_id}_{timestamp}.xlsx"
+
+    output_path = arcpy.GetParameterAsText(4)
+
+    if not output_path:
+        # Build default path in OneDrive
+        one_drive_docs = get_one_drive_documents()
+        output_path = os.path.join(one_drive_docs, default_filename)
+        arcpy.AddMessage(f"No output path specified. Using default: {output_path}")
+
+    # Ensure it ends with .xlsx
+    if not output_path.lower().endswith(".xlsx"):
+        output_path += ".xlsx"
+    return output_path
+
+
+class LayerQueryError(Exception):
+    """Raised when a Portal request still fails after all timeouts and retries."""
+
+
+def is_transient_error(error):
+    """Returns True for errors worth retrying: timeouts, dropped connections, throttling and 5xx responses."""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    message = str(error).lower()
+    transient_markers = ("timed out", "timeout", "connection", "temporarily", "429", "500", "502", "503", "504",
+                         "too many requests", "service unavailable", "bad gateway")
+    return any(marker in message for marker in transient_markers)
+
+
+def latency_p95(layer_key):
+    """Returns the 95th percentile query latency for a layer, or None when there are not enough samples."""
+    samples = sorted(query_latencies[layer_key])
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))]
+
+
+class BomContext:
+    """The state the stages of one BOM run share: the FDH being built, its per-FDH caches, and the Serv_Area reads
+    and snapshot of the batch it belongs to. Every thread has its own (bom_context()) and the threads it starts for
+    parallel reads share it, so BOMs built by different service requests never see each other's FDH."""
+
+    def __init__(self):
+        self.cab_id = None  # FDH whose BOM is being built, named in the stage messages
+        self.query_cache = {}  # Query signature -> result, reset for every FDH so repeat reads cost no requests
+        self.failed_stages = {}  # Stage name -> error that caused the stage to fail
+        self.projected_geometries = {}  # (geometry, from wkid, to wkid) -> query geometry projected locally
+        self.stale_lengths = {}  # (layer label, OBJECTID) -> (stored ft, geodesic ft) for features with stale footage
+        self.planned_reads = {}  # Portal item id -> merged read shared by every stage of the current FDH
+        self.request_counts = defaultdict(int)  # Portal item id -> requests sent for the current FDH
+        self.stage_timings = defaultdict(float)  # Stage -> seconds spent in it for the current FDH
+        self.mdu_filter_active = False  # True while the BOM is re-calculated without MDU features
+        self.stage_journal = None  # BatchJournal the finished stages of the current FDH are written to
+        self.area_reads = {}  # Portal item id -> one read for a Serv_Area batch, partitioned by cab_id
+        self.read_snapshot = {}  # Moment the layer reads are pinned to and how each layer was pinned
+
+
+def bom_context():
+    """The BomContext of this thread, a new one for a thread that has none."""
+    context = getattr(request_context, "bom", None)
+    if context is None:
+        context = request_context.bom = BomContext()
+    return context
+
+
+@contextlib.contextmanager
+def bom_run():
+    """Builds the BOMs of this thread (and the threads it starts) in a fresh BomContext."""
+    previous = getattr(request_context, "bom", None)
+    request_context.bom = BomContext()
+    try:
+        yield request_context.bom
+    finally:
+        request_context.bom = previous
+
+
+def start_request(func, *args, **kwargs):
+    """Runs a Portal call on a daemon thread so a hung request can be abandoned without blocking the run."""
+    future = Future()
+    priority = current_priority()
+    context = bom_context()
+
+    def runner():
+        if not future.set_running_or_notify_cancel():
+            return
+        request_context.priority = priority  # Parallel reads keep the priority of the run that started them...
+        request_context.bom = context  # ...and its BOM state
+        try:
+            future.set_result(func(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=runner, daemon=True).start()
+    return future
+
+
+def count_request(layer_key):
+    """Counts one request sent to a Portal layer for the current FDH."""
+    with request_lock:
+        bom_context().request_counts[layer_key] += 1
+
+
+def current_priority():
+    """The priority of the Portal requests sent from this thread: "interactive" unless inside a batch."""
+    return getattr(request_context, "priority", "interactive")
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """Sends the Portal requests of this thread (and the threads it starts) with the given priority."""
+    previous = current_priority()
+    request_context.priority = priority
+    try:
+        yield
+    finally:
+        request_context.priority = previous
+
+
+class HostGovernor:
+    """Paces the requests sent to one Portal host so parallel BOM runs do not overload a server other users share.
+
+    A token bucket caps the request rate (bursts up to HOST_BURST) and an AIMD limit caps the requests in flight.
+    Both are cut by CONCURRENCY_BACKOFF (at most once per BACKOFF_COOLDOWN) on a 429/503, timeout or response
+    slower than SLOW_RESPONSE_FACTOR x the layer's median, and ramp back up with good responses: the limit by one
+    per limit's worth of them up to MAX_CONCURRENCY, the rate by 1% of HOST_RATE each up to HOST_RATE. Interactive
+    requests go first; batch requests wait while one is queued and use at most BATCH_SHARE of the limit.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.condition = threading.Condition()
+        self.tokens = float(HOST_BURST)
+        self.rate = float(HOST_RATE)
+        self.refilled_at = time.monotonic()
+        self.limit = float(INITIAL_CONCURRENCY)
+        self.in_flight = 0
+        self.waiting = defaultdict(int)  # Priority -> requests queued for a slot
+        self.backed_off_at = None
+        self.sent = self.backoffs = self.congested = 0
+        self.waited = 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(float(HOST_BURST), self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def acquire(self, priority="interactive", block=True):
+        """Waits for a token and a free slot and returns the slot's ticket, or None instead of waiting when block is
+        False."""
+        started = time.monotonic()
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    self.refill()
+                    slots = self.limit if priority == "interactive" else max(1.0, self.limit * BATCH_SHARE)
+                    if (self.in_flight + 1 <= slots and self.tokens >= 1 and
+                            (priority == "interactive" or not self.waiting["interactive"])):
+                        break
+                    if not block:
+                        return None
+                    # A release wakes the queue, a missing token is waited out
+                    self.condition.wait(timeout=min(1.0, max(0.01, (1 - self.tokens) / self.rate)))
+            finally:
+                self.waiting[priority] -= 1
+            self.tokens -= 1
+            self.in_flight += 1
+            self.sent += 1
+            self.waited += time.monotonic() - started
+        return {"released": False}
+
+    def free(self, ticket):
+        """Gives a slot back once, whichever of the request and its timeout ends first (the caller holds the
+        condition). Returns False when it was already given back."""
+        if ticket["released"]:
+            return False
+        ticket["released"] = True
+        self.in_flight -= 1
+        self.condition.notify_all()
+        return True
+
+    def release(self, ticket, layer_key, seconds, error=None):
+        """Frees the slot of a finished request and adapts the limit to how the host answered it."""
+        samples = sorted(query_latencies[layer_key])
+        slow = len(samples) >= HEDGE_MIN_SAMPLES and seconds > SLOW_RESPONSE_FACTOR * samples[len(samples) // 2]
+        with self.condition:
+            if not self.free(ticket):
+                return  # Abandoned after its timeout, which already counted against the host
+            if (error is not None and is_transient_error(error)) or slow:
+                self.back_off()
+            elif error is None:
+                self.limit = min(float(MAX_CONCURRENCY), self.limit + 1 / self.limit)
+                self.rate = min(float(HOST_RATE), self.rate + HOST_RATE / 100)
+
+    def back_off(self):
+        """Cuts the concurrency limit and the rate after a sign of congestion (the caller holds the condition)."""
+        self.congested += 1
+        now = time.monotonic()
+        if self.backed_off_at is None or now - self.backed_off_at >= BACKOFF_COOLDOWN:
+            self.limit = max(float(MIN_CONCURRENCY), self.limit * CONCURRENCY_BACKOFF)
+            self.tokens = min(self.tokens, 0.0)  # The burst already sent was too much, start from an empty bucket
+            self.rate = max(HOST_RATE / 20, self.rate * CONCURRENCY_BACKOFF)
+            self.backed_off_at = now
+            self.backoffs += 1
+
+    def timed_out(self, tickets):
+        """Requests abandoned after their timeout free their slots (a hung call must not hold one for good) and the
+        host is treated as congested."""
+        with self.condition:
+            for ticket in filter(None, tickets):
+                self.free(ticket)
+            self.back_off()
+
+    def state(self):
+        with self.condition:
+            self.refill()
+            return {"host": self.host, "limit": round(self.limit, 2), "rate": round(self.rate, 2),
+                    "in_flight": self.in_flight,
+                    "tokens": round(self.tokens, 2), "sent": self.sent, "congested": self.congested,
+                    "backoffs": self.backoffs, "waited_seconds": round(self.waited, 2),
+                    "queued": dict(self.waiting)}
+
+
+def host_governor(layer_key):
+    """The governor of the host serving a layer (the Portal itself before the layer is resolved), or None when
+    GOVERN_REQUESTS is off."""
+    if not GOVERN_REQUESTS:
+        return None
+    url = str(getattr(portal_layers.get(layer_key), "url", None) or getattr(gis, "url", None) or "")
+    host = urlsplit(url).netloc or url or "portal"
+    with governor_lock:
+        if host not in host_governors:
+            host_governors[host] = HostGovernor(host)
+        return host_governors[host]
+
+
+def send_governed(governor, ticket, layer_key, func, *args, **kwargs):
+    """Runs one Portal call in a slot already taken from its host's governor and frees the slot when it returns."""
+    started = time.monotonic()
+    error = None
+    try:
+        return func(*args, **kwargs)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        governor.release(ticket, layer_key, time.monotonic() - started, error)
+
+
+def report_governors():
+    """Prints the limits and current state of every host governor."""
+    if not host_governors:
+        return
+    arcpy.AddMessage(f"*** Portal Governor (rate {HOST_RATE}/s, burst {HOST_BURST}, "
+                     f"concurrency {MIN_CONCURRENCY}-{MAX_CONCURRENCY}) ***\n" +
+                     "\n".join(f"► {state['host']}: limit {state['limit']:g} in flight at {state['rate']:g}/s, "
+                               f"{state['sent']} requests, {state['congested']} congested "
+                               f"({state['backoffs']} back-offs), {state['waited_seconds']:g}s queued in total"
+                               for state in (governor.state() for governor in list(host_governors.values()))) +
+                     "\n")
+
+
+def run_request(func, layer_key, *args, **kwargs):
+    """Runs one Portal call with the layer's timeout, exponential-backoff retries and optional hedging. With
+    GOVERN_REQUESTS each attempt first waits for a slot of its host's governor, which the timeout does not count."""
+    timeout = LAYER_TIMEOUTS.get(layer_key, DEFAULT_LAYER_TIMEOUT)
+    governor = host_governor(layer_key)
+    last_error = None
+
+    def send(ticket):
+        if governor is None:
+            return start_request(func, *args, **kwargs)
+        return start_request(send_governed, governor, ticket, layer_key, func, *args, **kwargs)
+
+    for attempt in range(QUERY_RETRIES + 1):
+        if attempt:
+            delay = QUERY_BACKOFF * (2 ** (attempt - 1)) * random.uniform(0.8, 1.2)  # Jitter avoids retry bursts
+            arcpy.AddWarning(f"⚠ Retrying request to layer {layer_key} in {delay:.1f}s "
+                             f"(attempt {attempt + 1} of {QUERY_RETRIES + 1}): {last_error}")
+            time.sleep(delay)
+
+        tickets = [governor.acquire(current_priority())] if governor is not None else [None]
+        started = time.monotonic()
+        count_request(layer_key)
+        pending = {send(tickets[0])}
+        hedge_after = latency_p95(layer_key) if HEDGE_REQUESTS else None
+        hedged = False
+
+        try:
+            while pending:
+                remaining = timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    if governor is not None:
+                        governor.timed_out(tickets)
+                    raise TimeoutError(f"no response within {timeout}s")
+
+                wait_for = remaining
+                if hedge_after is not None and not hedged:
+                    wait_for = max(0.0, min(remaining, hedge_after - (time.monotonic() - started)))
+
+                done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    if future.exception() is None:
+                        query_latencies[layer_key].append(time.monotonic() - started)
+                        return future.result()
+                    last_error = future.exception()
+
+                if not done and hedge_after is not None and not hedged:
+                    hedged = True
+                    if governor is not None:
+                        tickets.append(governor.acquire(current_priority(), block=False))
+                        if tickets[-1] is None:
+                            continue  # No spare slot on the host, a duplicate would only add to its load
+                    # The query is slower than 95% of its peers, race it against a duplicate request
+                    count_request(layer_key)
+                    pending.add(send(tickets[-1]))
+                    arcpy.AddMessage(f"⏱ Hedging slow request to layer {layer_key} "
+                                     f"(p95 {hedge_after:.2f}s exceeded).")
+
+            raise last_error
+
+        except Exception as e:
+            last_error = e
+            if not is_transient_error(e):
+                break
+
+    raise LayerQueryError(f"Request to layer {layer_key} failed: {last_error}")
+
+
+def get_portal_layer(item_id, stage):
+    """Resolves and caches the first layer of a Portal item. Marks the stage failed if the item is unavailable."""
+    if item_id in portal_layers:
+        return portal_layers[item_id]
+
+    if CASSETTE_MODE == "replay":
+        replayed = run_cassette().replay_layer(item_id)
+        if replayed is None:
+            arcpy.AddError(f"❌ Layer with ID '{item_id}' is not in the cassette {CASSETTE_PATH}.")
+            mark_stage_failed(stage, f"Layer with ID '{item_id}' was not recorded")
+            return None
+        portal_layers[item_id] = replayed
+        return portal_layers[item_id]
+
+    started = time.monotonic()
+    try:
+        layer_item = run_request(gis.content.get, item_id, item_id)
+    except LayerQueryError as e:
+        arcpy.AddError(f"❌ Layer with ID '{item_id}' could not be reached in ArcGIS Portal: {e}")
+        mark_stage_failed(stage, e)
+        return None
+
+    if not layer_item or not layer_item.layers:
+        arcpy.AddError(f"❌ Layer with ID '{item_id}' not found in ArcGIS Portal.")
+        mark_stage_failed(stage, f"Layer with ID '{item_id}' not found in ArcGIS Portal")
+        return None
+
+    portal_layers[item_id] = layer_item.layers[0]  # Assuming first layer is correct
+    if CASSETTE_MODE == "record":
+        portal_layers[item_id] = run_cassette().recording_layer(item_id, portal_layers[item_id],
+                                                                time.monotonic() - started)
+    return portal_layers[item_id]
+
+
+def run_cassette():
+    """The cassette the run records to or replays from (CASSETTE_MODE), created on first use."""
+    global cassette
+    with cassette_lock:
+        if cassette is None:
+            import portal_cassette
+            cassette = portal_cassette.Cassette(sys.modules[__name__], CASSETTE_PATH)
+    return cassette
+
+
+class LayerProperties(dict):
+    """Layer properties held locally (cassette, emulator), with attribute access like the arcgis PropertyMap."""
+
+    def __getattr__(self, name):
+        try:
+            value = self[name]
+        except KeyError:
+            raise AttributeError(name)
+        return LayerProperties(value) if isinstance(value, dict) else value
+
+
+def wkid_of(spatial_reference):
+    """The wkid of a spatial reference given as a number or an Esri JSON dict."""
+    if isinstance(spatial_reference, dict):
+        return spatial_reference.get("latestWkid") or spatial_reference.get("wkid")
+    return spatial_reference
+
+
+def same_sr(first, second):
+    """True when two spatial references need no projection between them."""
+    first, second = wkid_of(first), wkid_of(second)
+    return first == second or (first in WEB_MERCATOR_WKIDS and second in WEB_MERCATOR_WKIDS)
+
+
+def native_wkid(item_id, stage):
+    """Reads the spatial reference a layer stores its features in, once per run."""
+    if item_id not in layer_wkids:
+        portal_layer = get_portal_layer(item_id, stage)
+        properties = run_request(lambda: portal_layer.properties, item_id)
+        spatial_reference = (properties.get("extent") or {}).get("spatialReference") or \
+            properties.get("spatialReference") or {}
+        layer_wkids[item_id] = wkid_of(spatial_reference) or JOIN_SR
+    return layer_wkids[item_id]
+
+
+def mercator_coordinates(coordinates, from_wkid, to_wkid):
+    """Projects an (n, 2) coordinate array between WGS 1984 and Web Mercator, or returns None for other pairs."""
+    radius = 6378137.0
+    if from_wkid in GEOGRAPHIC_WGS84_WKIDS and to_wkid in WEB_MERCATOR_WKIDS:
+        lat = np.radians(np.clip(coordinates[:, 1], -85.0511287798, 85.0511287798))
+        return np.column_stack([radius * np.radians(coordinates[:, 0]), radius * np.log(np.tan(np.pi / 4 + lat / 2))])
+    if from_wkid in WEB_MERCATOR_WKIDS and to_wkid in GEOGRAPHIC_WGS84_WKIDS:
+        lat = np.pi / 2 - 2 * np.arctan(np.exp(-coordinates[:, 1] / radius))
+        return np.column_stack([np.degrees(coordinates[:, 0] / radius), np.degrees(lat)])
+    return None
+
+
+def project_geometry(geometry, from_wkid, to_wkid):
+    """Projects an Esri JSON geometry locally, in numpy where possible and with ArcPy otherwise."""
+    from_wkid, to_wkid = wkid_of(from_wkid), wkid_of(to_wkid)
+    if not geometry or same_sr(from_wkid, to_wkid):
+        return geometry
+
+    if mercator_coordinates(np.zeros((1, 2)), from_wkid, to_wkid) is None:
+        from_sr, to_sr = arcpy.SpatialReference(from_wkid), arcpy.SpatialReference(to_wkid)
+        transformation = (arcpy.ListTransformations(from_sr, to_sr) or [""])[0]  # Datum shift, e.g. NAD83 to WGS84
+        shape = arcpy.AsShape(dict(geometry, spatialReference={"wkid": from_wkid}), True)
+        return json.loads(shape.projectAs(to_sr, transformation).JSON)
+
+    def project(part):
+        part = np.asarray(part, dtype=float)
+        part[:, :2] = mercator_coordinates(part[:, :2], from_wkid, to_wkid)
+        return part.tolist()
+
+    projected = dict(geometry, spatialReference={"wkid": to_wkid})
+    if geometry.get("x") is not None:
+        projected["x"], projected["y"] = project([[geometry["x"], geometry["y"]]])[0][:2]
+    for key in ("points", "paths", "rings"):
+        if geometry.get(key):
+            projected[key] = project(geometry[key]) if key == "points" else [project(part) for part in geometry[key]]
+    return projected
+
+
+def query_geometry_in_sr(geometry, from_wkid, to_wkid):
+    """Projects a query geometry (the FDH boundary) once per FDH and target reference."""
+    context = bom_context()
+    key = (json.dumps(geometry.get("rings") or geometry, default=str), wkid_of(from_wkid), wkid_of(to_wkid))
+    if key not in context.projected_geometries:
+        context.projected_geometries[key] = project_geometry(geometry, from_wkid, to_wkid)
+    return context.projected_geometries[key]
+
+
+def join_geometry(geometry):
+    """The FDH boundary in JOIN_SR, the reference of the features fetched for local joins."""
+    return query_geometry_in_sr(geometry, geometry.get("spatialReference") or JOIN_SR, JOIN_SR)
+
+
+def query_native_sr(portal_layer, item_id, stage, query_kwargs):
+    """Sends a query in the layer's own spatial reference so the server reprojects neither the query geometry nor
+    the features, then projects the returned features into the requested out_sr locally."""
+    wkid = native_wkid(item_id, stage)
+    native_kwargs = dict(query_kwargs)
+
+    geometry_filter = query_kwargs.get("geometry_filter")
+    if isinstance(geometry_filter, dict) and isinstance(geometry_filter.get("geometry"), dict):
+        geometry = geometry_filter["geometry"]
+        filter_wkid = geometry_filter.get("inSR") or geometry.get("spatialReference") or JOIN_SR
+        if not same_sr(filter_wkid, wkid):
+            native_kwargs["geometry_filter"] = dict(geometry_filter, inSR=wkid,
+                                                    geometry=query_geometry_in_sr(geometry, filter_wkid, wkid))
+
+    out_sr = query_kwargs.get("out_sr")
+    if out_sr is not None:
+        native_kwargs["out_sr"] = wkid
+
+    started = time.monotonic()
+    result = run_request(portal_layer.query, item_id, **native_kwargs)
+    native_seconds = time.monotonic() - started
+
+    if COMPARE_SR_TIMING and native_kwargs != query_kwargs:
+        started = time.monotonic()
+        run_request(portal_layer.query, item_id, **query_kwargs)
+        sr_timings[item_id].append((native_seconds, time.monotonic() - started))
+
+    if out_sr is not None and not same_sr(wkid, out_sr) and hasattr(result, "features"):
+        for feature in result.features:
+            feature.geometry = project_geometry(feature.geometry, wkid, out_sr)
+    return result
+
+
+def send_query(portal_layer, item_id, stage, query_kwargs):
+    """Sends one uncached layer query, in the layer's native spatial reference when NATIVE_SR_QUERIES is on, and
+    pinned to the snapshot of the current BOM when there is one."""
+    query_kwargs = snapshot_kwargs(portal_layer, item_id, query_kwargs)
+    if NATIVE_SR_QUERIES:
+        return query_native_sr(portal_layer, item_id, stage, query_kwargs)
+    return run_request(portal_layer.query, item_id, **query_kwargs)
+
+
+def send_sharded_query(portal_layer, item_id, stage, query_kwargs):
+    """Sends a large read as OBJECTID-range shards fetched in parallel instead of offset pages.
+
+    The matching OBJECTIDs come from one returnIdsOnly query and are cut into contiguous shards of SHARD_SIZE.
+    Every shard is the same query limited to its OBJECTID range, so the server never skips rows, and the features
+    come back in OBJECTID order.
+    """
+    id_kwargs = {key: value for key, value in query_kwargs.items()
+                 if key not in ("out_fields", "out_sr", "return_geometry")}
+    ids = send_query(portal_layer, item_id, stage, dict(id_kwargs, return_ids_only=True)) or {}
+    object_ids = sorted(ids.get("objectIds") or [])
+    if not object_ids:
+        return LayerResult([])
+
+    field = ids.get("objectIdFieldName") or "OBJECTID"
+    where = query_kwargs.get("where", "1=1")
+    pending = []
+    for start in range(0, len(object_ids), SHARD_SIZE):
+        shard = object_ids[start:start + SHARD_SIZE]
+        shard_where = f"{field} >= {shard[0]} AND {field} <= {shard[-1]}"
+        if where != "1=1":
+            shard_where += f" AND ({where})"
+        pending.append(start_request(send_query, portal_layer, item_id, stage, dict(query_kwargs, where=shard_where)))
+
+    results = [future.result() for future in pending]
+    return LayerResult([feature for result in results for feature in result.features],
+                       getattr(results[0], "spatial_reference", None))
+
+
+def send_layer_query(portal_layer, item_id, stage, query_kwargs, sharded=False):
+    """Sends one uncached layer query, as OBJECTID shards when SHARD_READS is on and the read is large: a spatial
+    read of a layer in SHARDED_LAYERS or a whole-layer download. Counts and id lists are always one query."""
+    large = sharded or (item_id in SHARDED_LAYERS and query_kwargs.get("geometry_filter") is not None)
+    if SHARD_READS and large and not query_kwargs.get("return_count_only") and not query_kwargs.get("return_ids_only"):
+        return send_sharded_query(portal_layer, item_id, stage, query_kwargs)
+    return send_query(portal_layer, item_id, stage, query_kwargs)
+
+
+def layer_properties_now(item_id, stage):
+    """A layer's properties as the server reports them now, not the copy cached on the layer handle."""
+    portal_layer = get_portal_layer(item_id, stage)
+    if isinstance(portal_layer, arcgis.features.FeatureLayer):
+        portal_layer = arcgis.features.FeatureLayer(portal_layer.url, gis=gis)  # Fetches its properties afresh
+    return run_request(lambda: portal_layer.properties, item_id)
+
+
+def layer_edit_versions(stage="Run History"):
+    """The last edit date (epoch ms) Portal reports now for every source layer, read in parallel."""
+    pending = {item_id: start_request(layer_properties_now, item_id, stage)
+               for item_id in sorted({item_id for _, item_id, _, _, _ in stage_reads()})}
+    versions = {}
+    for item_id, future in pending.items():
+        try:
+            versions[item_id] = (future.result().get("editingInfo") or {}).get("lastEditDate")
+        except Exception:
+            versions[item_id] = None
+    return versions
+
+
+def pin_snapshot(area=False, moment=None):
+    """Pins every layer read of the BOM (or, with area, of the Serv_Area batch) about to run to one moment.
+
+    The moment is the newest edit the server reports across the source layers, so it is on the server's clock like
+    the historic moments and edit dates it is compared with. The workstation clock is only used when no layer
+    reports a last edit date. A given moment (that of the journaled stages of a resumed BOM) is pinned as is.
+    """
+    context = bom_context()
+    if moment is None:
+        moment = max(filter(None, layer_edit_versions("Snapshot").values()), default=None)
+        if moment is None:
+            arcpy.AddWarning("⚠ No source layer reports its last edit date, the snapshot uses this computer's clock.")
+            moment = int(time.time() * 1000)
+    context.read_snapshot.clear()
+    context.read_snapshot.update(moment=moment, area=area, historic=set(), versioned=set(), local=set(),
+                                 unchecked=set())
+
+
+def end_area_reads():
+    """Drops the Serv_Area reads of a finished batch and the snapshot they were read at."""
+    context = bom_context()
+    context.area_reads.clear()
+    context.read_snapshot.clear()
+
+
+def snapshot_kwargs(portal_layer, item_id, query_kwargs):
+    """query_kwargs pinned to the snapshot moment of the current BOM: the layer as it was at that moment when it
+    keeps an archive (historicMoment), SNAPSHOT_GDB_VERSION when it is versioned. Any other layer is read as it is
+    now and checked for edits after the moment once the BOM is built (check_snapshot)."""
+    context = bom_context()
+    if not context.read_snapshot:
+        return query_kwargs
+    properties = portal_layer.properties
+    if (properties.get("archivingInfo") or {}).get("supportsQueryWithHistoricMoment"):
+        context.read_snapshot["historic"].add(item_id)
+        return dict(query_kwargs, historic_moment=context.read_snapshot["moment"])
+    if SNAPSHOT_GDB_VERSION and properties.get("isDataVersioned"):
+        context.read_snapshot["versioned"].add(item_id)
+        return dict(query_kwargs, gdb_version=SNAPSHOT_GDB_VERSION)
+    context.read_snapshot["local"].add(item_id)
+    return query_kwargs
+
+
+def check_snapshot(fdh_geometry):
+    """Layers read as they are now (no archive or version) that were edited inside the FDH after the snapshot
+    moment, so the BOM may mix their features before and after the edit. The stages all read one copy of each layer
+    (planned reads and the query cache), so those are the only reads that can disagree with the moment. Layers
+    without editor tracking cannot be checked and are listed as unchecked, as are all layers of a replayed run (the
+    cassette does not change, and the check's where clause holds the moment of the run)."""
+    context = bom_context()
+    if CASSETTE_MODE == "replay":
+        context.read_snapshot["unchecked"].update(context.read_snapshot["local"])
+        return []
+    pending = {}
+    for item_id in sorted(context.read_snapshot["local"]):
+        try:
+            edit_field = edit_date_field(item_id, "Snapshot")
+        except LayerQueryError:
+            edit_field = None
+        if not edit_field:
+            context.read_snapshot["unchecked"].add(item_id)
+            continue
+        # The where clause holds whole seconds, the newest edit (the moment itself) is not an edit after it
+        after = -(-context.read_snapshot["moment"] // 1000) * 1000
+        pending[item_id] = start_request(send_query, get_portal_layer(item_id, "Snapshot"), item_id, "Snapshot", dict(
+            where=edited_since(edit_field, after), geometry_filter=filters.intersects(fdh_geometry),
+            return_count_only=True))
+
+    edited = []
+    for item_id, future in pending.items():
+        try:
+            if future.result():
+                edited.append(item_id)
+        except Exception as e:
+            arcpy.AddWarning(f"⚠ Edits to layer {item_id} since the snapshot could not be checked: {e}")
+            context.read_snapshot["unchecked"].add(item_id)
+    return edited
+
+
+def snapshot_record(edited):
+    """The snapshot a BOM was read at, as kept with its values and written to the export."""
+    read_snapshot = bom_context().read_snapshot
+    return {"moment": datetime.fromtimestamp(read_snapshot["moment"] / 1000, timezone.utc).isoformat(
+                timespec="seconds"),
+            "moment_ms": read_snapshot["moment"],
+            "historic_moment": sorted(read_snapshot["historic"]),
+            "gdb_version": sorted(read_snapshot["versioned"]),
+            "local": sorted(read_snapshot["local"] - read_snapshot["unchecked"]),
+            "unchecked": sorted(read_snapshot["unchecked"]),
+            "edited_during_read": sorted(edited)}
+
+
+def report_sr_timings():
+    """Prints the time saved per query by querying layers in their native spatial reference."""
+    if not sr_timings:
+        return
+
+    lines = []
+    for item_id, timings in sr_timings.items():
+        native_seconds = sum(native for native, _ in timings) / len(timings)
+        reprojected_seconds = sum(reprojected for _, reprojected in timings) / len(timings)
+        lines.append(f"► {item_id} (wkid {layer_wkids.get(item_id)}): native {native_seconds:.2f}s, "
+                     f"reprojected {reprojected_seconds:.2f}s, saved {reprojected_seconds - native_seconds:.2f}s "
+                     f"per query")
+    arcpy.AddMessage("*** Native Spatial Reference Timing ***\n" + "\n".join(lines) + "\n")
+
+
+class LayerResult:
+    """Features handed to a stage by query_layer, a private view of the cached query result."""
+
+    def __init__(self, features, spatial_reference=None):
+        self.features = features
+        self.spatial_reference = spatial_reference
+
+
+def query_layer(item_id, stage, **query_kwargs):
+    """Queries a Portal layer through the request layer. All layer queries in this tool are idempotent reads.
+
+    Spatial queries against the FDH are answered from the merged read of the query planner when it covers them,
+    other identical queries within one FDH are answered from query_cache, and while mdu_filter_active the features
+    tagged inside an MDU boundary are left out of the view handed to non-exempt stages.
+    """
+    context = bom_context()
+    if query_kwargs.get("return_geometry", True):
+        query_kwargs.setdefault("out_sr", JOIN_SR)  # Keep every geometry in one reference for local joins
+
+    result = planned_view(item_id, query_kwargs)
+    if result is None:
+        cache_key = json.dumps([item_id, query_kwargs], sort_keys=True, default=str)
+        if cache_key not in context.query_cache:
+            portal_layer = get_portal_layer(item_id, stage)
+            if portal_layer is None:
+                raise LayerQueryError(f"Layer with ID '{item_id}' is not available")
+            context.query_cache[cache_key] = send_layer_query(portal_layer, item_id, stage, query_kwargs)
+            if VALIDATE_LENGTHS and item_id in LENGTH_FIELDS and hasattr(context.query_cache[cache_key], "features"):
+                check_stored_lengths(item_id, context.query_cache[cache_key].features)
+        result = context.query_cache[cache_key]
+
+    if not hasattr(result, "features"):
+        return result  # Counts and id lists
+
+    features = list(result.features)
+    if context.mdu_filter_active and stage not in MDU_EXEMPT_STAGES:
+        features = [feature for feature in features if not feature.attributes.get("_in_mdu")]
+    return LayerResult(features, getattr(result, "spatial_reference", None))
+
+
+def reset_fdh_state():
+    """Clears the per-FDH query cache and stage failures before a new FDH is processed."""
+    context = bom_context()
+    context.query_cache.clear()
+    context.failed_stages.clear()
+    context.projected_geometries.clear()
+    context.stale_lengths.clear()
+    context.planned_reads.clear()
+    context.request_counts.clear()
+    context.stage_timings.clear()
+
+
+def stage_reads():
+    """Every layer read the stages make inside an FDH, as (stage, item id, out fields, spatial relationship,
+    attribute predicates). The stages send exactly these reads (stage_query), and the query planner, the membership
+    sync, the BOM service and INCREMENTAL_REFRESH take the layers each stage reads from here.
+    """
+    line_relation = "intersects" if CLIP_TO_FDH else "contains"
+    reads = [
+        ("Addresses", address_master_id, "*", "contains", []),
+        ("Addresses", do_not_build_id, "*", "contains", []),
+        ("Addresses", mdu_boundary_id, "*", "intersects", []),
+        ("Conduit", conduit_id, "OBJECTID, UG1FT, LaborFootage, BOMCalc, reareasment, Cond_Diam", line_relation, []),
+        ("Structures", structures_id, "structuretype", "contains", []),
+        ("Splice Enclosures", splice_enclosure_id, "splicesize, placementtype", "contains", []),
+        # Placement is not pushed down for cable, the SP1-SP3 totals count every uniquely named cable
+        ("Cables", cable_id, "OBJECTID, cable_name, placementtype, fibercount, hierarchy, LengthFT, SpliceSlack, "
+                             "SP1, SP2, SP3", "contains", []),
+        ("Slackloops", slackloop_id, "cable_capacity, placement, loop_length, type", "contains",
+         [attribute_predicate("type", ["Maintenance Loop"])]),
+        ("Strand and Poles", strand_id, "*", line_relation, []),
+        ("Strand and Poles", poles_id, "OBJECTID, MR_Level", "intersects", []),
+        ("Strand and Poles", conduit_id, "duct_count", "intersects", []),
+        ("Cabinets", passive_id, "Cab_Size", "contains", []),
+        ("Cabinets", active_id, "*", "contains", []),
+        ("Risers", riser_id, "*", "contains", []),
+        ("Guys", guys_id, "Guy_Type", "contains", []),
+        ("Drops", drop_id, "*", "contains", []),
+    ]
+
+    if EXCLUDE_EXISTING:
+        existing = attribute_predicate(STATUS_FIELD, ["Existing"], exclude=True)
+        for stage, item_id, _, _, predicates in reads:
+            if stage not in EXISTING_EXEMPT_STAGES and item_id != poles_id:  # New strand hangs on existing poles
+                predicates.append(existing)
+    return reads
+
+
+def attribute_predicate(field, values, exclude=False, ignore_case=True):
+    """An attribute filter a stage applies to a layer: keep (or with exclude, drop) rows whose field is one of
+    the values. Text is compared trimmed and case-insensitively unless ignore_case is False."""
+    values = tuple(str(value).strip().upper() if ignore_case else value for value in values)
+    return field, values, exclude, ignore_case
+
+
+def sql_literal(value):
+    """Quotes a value for a where clause."""
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def compile_where(predicates):
+    """Compiles attribute predicates into a server where clause. Excluding a value keeps rows where it is null."""
+    clauses = []
+    for field, values, exclude, ignore_case in predicates:
+        column = f"UPPER(TRIM(BOTH ' ' FROM {field}))" if ignore_case else field
+        listed = ", ".join(sql_literal(value) for value in values)
+        if exclude:
+            clauses.append(f"({field} IS NULL OR {column} NOT IN ({listed}))")
+        else:
+            clauses.append(f"{column} IN ({listed})")
+
+    where = " AND ".join(clauses) or "1=1"
+    compiled_predicates[where] = list(predicates)
+    return where
+
+
+def matches_predicates(attributes, predicates):
+    """Evaluates attribute predicates locally, with the same meaning as the compiled where clause."""
+    for field, values, exclude, ignore_case in predicates:
+        value = attributes.get(field)
+        if value is None and field not in attributes:
+            value = next((v for k, v in attributes.items() if k.lower() == field.lower()), None)
+        if value is not None and ignore_case:
+            value = str(value).strip().upper()
+
+        if exclude and value is not None and value in values:
+            return False
+        if not exclude and (value is None or value not in values):
+            return False
+    return True
+
+
+def stage_query(stage, item_id, fdh_geometry):
+    """The query_layer arguments of one of the stage reads listed in stage_reads(), against the FDH."""
+    for read_stage, read_item_id, out_fields, relation, predicates in stage_reads():
+        if read_stage == stage and read_item_id == item_id:
+            geometry_filter = filters.intersects if relation == "intersects" else filters.contains
+            return dict(where=compile_where(predicates), geometry_filter=geometry_filter(fdh_geometry, sr=JOIN_SR),
+                        out_fields=out_fields, return_geometry=True)
+    raise KeyError(f"Stage {stage} has no read of layer {item_id} in stage_reads()")
+
+
+def field_set(out_fields):
+    """Lower-cased field names of an out_fields string, or None for every field ("*")."""
+    fields = {field.strip().lower() for field in (out_fields or "*").split(",") if field.strip()}
+    return None if "*" in fields else fields
+
+
+def merged_stage_reads(stages=None):
+    """One read per layer covering what every stage (or only the given stages) needs from it, as
+    {item id: (first stage, out_fields, field set or None for every field, where clauses or None for every row,
+    merged where clause)}."""
+    merged = {}
+    for stage, item_id, out_fields, _, predicates in stage_reads():
+        if stages is not None and stage not in stages:
+            continue
+        first_stage, fields, wheres = merged.get(item_id, (stage, {"objectid": "OBJECTID"}, set()))
+        if fields is not None and field_set(out_fields) is not None:
+            for field in out_fields.split(",") + [predicate[0] for predicate in predicates]:
+                fields.setdefault(field.strip().lower(), field.strip())  # Predicates are re-checked locally
+        else:
+            fields = None
+        wheres.add(compile_where(predicates))
+        merged[item_id] = (first_stage, fields, wheres)
+
+    reads = {}
+    for item_id, (stage, fields, wheres) in merged.items():
+        out_fields = "*" if fields is None else ", ".join(fields.values())
+        fields = None if fields is None else set(fields)
+        wheres = None if "1=1" in wheres else wheres  # None, every row was fetched
+        where = "1=1" if wheres is None else " OR ".join(f"({where})" for where in sorted(wheres))
+        reads[item_id] = (stage, out_fields, fields, wheres, where)
+    return reads
+
+
+def planned_read(fdh_geometry, fields, wheres, features):
+    """The merged read of one layer for the FDH that planned_view answers the stage queries from."""
+    return {
+        "fields": fields,
+        "wheres": wheres,
+        "rings": json.dumps(fdh_geometry.get("rings")),
+        "features": features,
+        "index": FeatureIndex(features),
+    }
+
+
+def prefetch_fdh_layers(fdh_geometry, cab_id=None, stages=None):
+    """Sends one merged query per layer for the FDH: everything intersecting the boundary with the union of the
+    fields the stages need. The layers are read in parallel and the stages take their views of the results.
+    With USE_MEMBERSHIP_TABLE the features are fetched by OBJECTID instead of by a spatial query, and layers read
+    for a whole Serv_Area batch (prefetch_area_layers) are taken from the FDH's partition with no query at all.
+    With stages only the layers those stages read are fetched."""
+    context = bom_context()
+    pending = {}
+    for item_id, (stage, out_fields, fields, wheres, where) in merged_stage_reads(stages).items():
+        area_read = (context.area_reads.get(item_id)
+                     if not context.read_snapshot or context.read_snapshot["area"] else None)
+        partition = area_read["partitions"].get(str(cab_id).upper()) if area_read and cab_id else None
+        if partition is not None:
+            context.planned_reads[item_id] = planned_read(fdh_geometry, area_read["fields"], area_read["wheres"],
+                                                          [copy_feature(feature) for feature in partition])
+            continue
+
+        object_ids = membership_object_ids(item_id, cab_id) if USE_MEMBERSHIP_TABLE and cab_id else None
+        if object_ids is not None:
+            future = start_request(query_by_object_ids, item_id, stage, object_ids, where=where,
+                                   out_fields=out_fields, return_geometry=True)
+        else:
+            future = start_request(query_intersecting, item_id, stage, fdh_geometry, where=where,
+                                   out_fields=out_fields, return_geometry=True)
+        pending[item_id] = (fields, wheres, future)
+
+    for item_id, (fields, wheres, future) in pending.items():
+        try:
+            features = future.result().features
+        except Exception as e:
+            # Left out of the plan, the stage sends its own query and reports the failure itself
+            arcpy.AddWarning(f"⚠ Planned read of layer {item_id} failed, its stages will query it directly: {e}")
+            continue
+        context.planned_reads[item_id] = planned_read(fdh_geometry, fields, wheres, features)
+
+
+def polygon_extent(rings):
+    """(xmin, ymin, xmax, ymax) of polygon rings."""
+    corners = np.concatenate([np.asarray(ring, dtype=float)[:, :2] for ring in rings])
+    return (*corners.min(axis=0), *corners.max(axis=0))
+
+
+def envelope_polygon(xmin, ymin, xmax, ymax):
+    """A rectangle as a JOIN_SR polygon, usable as a query geometry."""
+    return {"rings": [[[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax], [xmin, ymin]]],
+            "spatialReference": {"wkid": JOIN_SR}}
+
+
+def tile_feature_limit(item_id, stage):
+    """Features one tile may hold: TILE_FEATURE_LIMIT, or the most a single query of the layer returns."""
+    if TILE_FEATURE_LIMIT:
+        return TILE_FEATURE_LIMIT
+    portal_layer = get_portal_layer(item_id, stage)
+    return (portal_layer.properties.get("maxRecordCount") if portal_layer is not None else None) or 1000
+
+
+def query_intersecting(item_id, stage, geometry, where="1=1", **query_kwargs):
+    """Fetches the features of a layer intersecting a polygon (an FDH boundary or a Serv_Area extent).
+
+    With TILE_QUERIES a count-only query is sent first. When the polygon holds more features than one query
+    returns, its extent is split as a quadtree, each level counted in parallel, until every tile is within the
+    limit; the tiles are then fetched in parallel, merged by OBJECTID and trimmed to the polygon locally.
+    """
+    def intersecting(query_geometry, **kwargs):
+        return query_layer(item_id, stage, where=where, geometry_filter=filters.intersects(query_geometry, sr=JOIN_SR),
+                           **kwargs)
+
+    if not TILE_QUERIES:
+        return intersecting(geometry, **query_kwargs)
+    limit = tile_feature_limit(item_id, stage)
+    total = intersecting(geometry, return_count_only=True, return_geometry=False)
+    if total <= limit:
+        return intersecting(geometry, **query_kwargs)
+
+    start = time.perf_counter()
+    tiles, leaves = [polygon_extent(geometry["rings"])], []
+    for depth in range(1, TILE_MAX_DEPTH + 1):
+        quadrants = []
+        for xmin, ymin, xmax, ymax in tiles:
+            xmid, ymid = (xmin + xmax) / 2, (ymin + ymax) / 2
+            quadrants += [(xmin, ymin, xmid, ymid), (xmid, ymin, xmax, ymid),
+                          (xmin, ymid, xmid, ymax), (xmid, ymid, xmax, ymax)]
+        counts = [start_request(intersecting, envelope_polygon(*quadrant), return_count_only=True,
+                                return_geometry=False) for quadrant in quadrants]
+        tiles = []
+        for quadrant, count in zip(quadrants, counts):
+            count = count.result()
+            if count > limit and depth < TILE_MAX_DEPTH:
+                tiles.append(quadrant)
+            elif count:
+                leaves.append(quadrant)
+        if not tiles:
+            break
+
+    pending = [start_request(intersecting, envelope_polygon(*leaf), **query_kwargs) for leaf in leaves]
+    features, seen = [], set()
+    for future in pending:
+        for feature in future.result().features:
+            object_id = feature.attributes.get("OBJECTID")
+            if object_id is None or object_id not in seen:  # Features crossing a tile edge come back from both
+                seen.add(object_id)
+                features.append(feature)
+    features = [features[i] for i in sorted(FeatureIndex(features).query(geometry, "intersects"))]
+    arcpy.AddMessage(f"► {stage}: {total} features of layer {item_id} fetched in {len(leaves)} tiles "
+                     f"in {time.perf_counter() - start:.2f}s")
+    return LayerResult(features)
+
+
+def prefetch_area_layers(fdh_features, stages=None):
+    """Reads each layer once for the extent of a batch of FDHs in the same Serv_Area, instead of once per FDH, and
+    partitions the features among the FDH boundaries with one local join per layer.
+
+    Serv_Areas with fewer than SERV_AREA_MIN_FDHS FDHs in the batch are left to per-FDH reads. The partitions are
+    used by prefetch_fdh_layers until area_reads is cleared at the end of the batch.
+    """
+    context = bom_context()
+    context.area_reads.clear()
+    if SNAPSHOT_READS:
+        pin_snapshot(area=True)  # One moment for the whole batch, its FDHs are cut from the same reads
+    batches = defaultdict(list)
+    for fdh in fdh_features:
+        if fdh is not None and (fdh.geometry or {}).get("rings"):
+            batches[str(fdh.attributes.get("Serv_Area")).upper()].append(fdh)
+    batches = {serv_area: fdhs for serv_area, fdhs in batches.items() if len(fdhs) >= SERV_AREA_MIN_FDHS}
+    if not batches:
+        return
+
+    reads = merged_stage_reads(stages)
+    pending = []
+    for serv_area, fdhs in batches.items():
+        extent = envelope_polygon(*polygon_extent([ring for fdh in fdhs for ring in fdh.geometry["rings"]]))
+        for item_id, (stage, out_fields, fields, wheres, where) in reads.items():
+            future = start_request(query_intersecting, item_id, stage, extent, where=where,
+                                   out_fields=out_fields, return_geometry=True)
+            pending.append((fdhs, item_id, fields, wheres, future))
+
+    for fdhs, item_id, fields, wheres, future in pending:
+        try:
+            features = future.result().features
+        except Exception as e:
+            arcpy.AddWarning(f"⚠ Serv_Area read of layer {item_id} failed, its FDHs will read it one by one: {e}")
+            continue
+        index = FeatureIndex(features)
+        area_read = context.area_reads.setdefault(item_id, {"fields": fields, "wheres": wheres, "partitions": {}})
+        for fdh in fdhs:
+            area_read["partitions"][str(fdh.attributes.get("cab_id")).upper()] = [
+                features[i] for i in index.query(fdh.geometry, "intersects")]
+
+    fdh_count = sum(len(fdhs) for fdhs in batches.values())
+    arcpy.AddMessage(f"► Serv_Area prefetch: {len(pending)} layer reads for {fdh_count} FDHs in "
+                     f"{len(batches)} Serv_Area(s) instead of {len(reads) * fdh_count}\n")
+
+
+def query_by_object_ids(item_id, stage, object_ids, where="1=1", **query_kwargs):
+    """Fetches features by OBJECTID in chunks read in parallel, attribute-only queries with no spatial predicate."""
+    pending = []
+    for start in range(0, len(object_ids), MEMBERSHIP_CHUNK):
+        chunk = ", ".join(str(object_id) for object_id in object_ids[start:start + MEMBERSHIP_CHUNK])
+        chunk_where = f"OBJECTID IN ({chunk})" + ("" if where == "1=1" else f" AND ({where})")
+        pending.append(start_request(query_layer, item_id, stage, where=chunk_where, **query_kwargs))
+    return LayerResult([feature for future in pending for feature in future.result().features])
+
+
+def open_local_db():
+    """Opens the local FDH index and membership database, creating the tables on first use."""
+    connection = sqlite3.connect(LOCAL_DB)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS fdh_boundaries (
+            objectid INTEGER PRIMARY KEY, cab_id TEXT, serv_area TEXT, attributes TEXT, geometry TEXT,
+            xmin REAL, ymin REAL, xmax REAL, ymax REAL, edit_date INTEGER);
+        CREATE INDEX IF NOT EXISTS fdh_cab ON fdh_boundaries (cab_id);
+        CREATE INDEX IF NOT EXISTS fdh_serv_area ON fdh_boundaries (serv_area);
+        CREATE TABLE IF NOT EXISTS membership (
+            item_id TEXT, objectid INTEGER, cab_id TEXT, contained INTEGER,
+            PRIMARY KEY (item_id, objectid, cab_id));
+        CREATE INDEX IF NOT EXISTS membership_cab ON membership (cab_id, item_id);
+        CREATE TABLE IF NOT EXISTS membership_fdhs (cab_id TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS layer_sync (item_id TEXT PRIMARY KEY, last_edit INTEGER, synced_at TEXT);
+        CREATE TABLE IF NOT EXISTS bom_values (cab_id TEXT PRIMARY KEY, values_json TEXT, computed_at TEXT);
+        CREATE TABLE IF NOT EXISTS bom_graph (cab_id TEXT PRIMARY KEY, settings TEXT, values_json TEXT);
+        CREATE TABLE IF NOT EXISTS bom_runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT, cab_id TEXT, serv_area TEXT, city_code TEXT, run_at TEXT,
+            construction_vendor TEXT, design_vendor TEXT, complete INTEGER, values_json TEXT, stage_timings TEXT,
+            layer_versions TEXT);
+        CREATE INDEX IF NOT EXISTS runs_cab ON bom_runs (cab_id, run_at);
+        CREATE INDEX IF NOT EXISTS runs_serv_area ON bom_runs (serv_area, cab_id, run_at);
+        CREATE INDEX IF NOT EXISTS runs_run_at ON bom_runs (run_at);
+        CREATE INDEX IF NOT EXISTS runs_vendor ON bom_runs (construction_vendor, design_vendor, run_at);
+        CREATE TABLE IF NOT EXISTS rollup_members (
+            cab_id TEXT PRIMARY KEY, city_code TEXT, serv_area TEXT, values_json TEXT);
+        CREATE TABLE IF NOT EXISTS bom_rollups (
+            city_code TEXT, serv_area TEXT, quantity TEXT, total REAL, PRIMARY KEY (city_code, serv_area, quantity));
+    """)
+    return connection
+
+
+def edit_date_field(item_id, stage):
+    """The editor-tracking date field of a layer, or None when editor tracking is off."""
+    properties = run_request(lambda: get_portal_layer(item_id, stage).properties, item_id)
+    return (properties.get("editFieldsInfo") or {}).get("editDateField")
+
+
+def fetch_layer_features(item_id, stage, where="1=1", out_fields="OBJECTID", extent=None):
+    """Fetches every matching feature of a layer in JOIN_SR without caching it in the per-FDH query cache, only
+    those intersecting a JOIN_SR polygon when an extent is given."""
+    portal_layer = get_portal_layer(item_id, stage)
+    if portal_layer is None:
+        raise LayerQueryError(f"Layer with ID '{item_id}' is not available")
+    query_kwargs = dict(where=where, out_fields=out_fields, return_geometry=True, out_sr=JOIN_SR)
+    if extent is not None:
+        query_kwargs["geometry_filter"] = filters.intersects(extent, sr=JOIN_SR)
+    return send_layer_query(portal_layer, item_id, stage, query_kwargs, sharded=True).features
+
+
+def fdh_extent(fdh_features):
+    """The envelope of FDH boundaries as a JOIN_SR polygon, or None when there are none."""
+    rings = [ring for fdh in fdh_features for ring in (fdh.geometry or {}).get("rings") or []]
+    return envelope_polygon(*polygon_extent(rings)) if rings else None
+
+
+def join_to_fdhs(features, fdh_features):
+    """Local bulk join of features to every FDH boundary: (OBJECTID, cab_id, contained) per touching pair."""
+    index = FeatureIndex(features)
+    rows = []
+    for fdh in fdh_features:
+        contained = set(index.query(fdh.geometry, "contains"))
+        for i in index.query(fdh.geometry, "intersects"):
+            rows.append((features[i].attributes.get("OBJECTID"), fdh.attributes.get("cab_id"), int(i in contained)))
+    return rows
+
+
+def latest_edit(features, edit_field):
+    """The newest editor-tracking date (epoch ms) among the features, or None."""
+    edits = [feature.attributes.get(edit_field) for feature in features] if edit_field else []
+    return max((edit for edit in edits if edit is not None), default=None)
+
+
+def edited_since(edit_field, last_edit):
+    """Where clause for features edited after an epoch-ms timestamp."""
+    stamp = datetime.fromtimestamp(last_edit / 1000, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    return f"{edit_field} > TIMESTAMP '{stamp}'"
+
+
+def sync_membership(fdh_boundary_id, cab_ids=None, item_ids=None, refresh_index=True):
+    """Brings the feature-to-FDH membership table up to date for the FDHs it covers.
+
+    The table covers the FDHs of every earlier sync plus cab_ids; with neither (cab_ids None on the first
+    INCREMENTAL_REFRESH) it covers every indexed FDH. The first sync of a layer downloads the OBJECTID,
+    editor-tracking date and geometry of each feature intersecting the extent of the covered FDHs, and an FDH new
+    to the table adds the features intersecting its own extent. Later syncs download only the features edited
+    since the last one (layer-wide, so features moved out of the extent are dropped) plus the OBJECTIDs within the
+    extent to drop deleted ones. A change to any FDH boundary rebuilds the table. Returns {cab_id: item ids of the
+    layers whose features in it were added, edited, moved or deleted}, with the FDH layer's id for boundaries that
+    changed themselves (None if the sync failed). refresh_index=False skips the FDH index refresh when the caller
+    has just run it.
+    """
+    item_ids = item_ids or sorted({item_id for _, item_id, _, _, _ in stage_reads()})
+    connection = open_local_db()
+    synced = dict(connection.execute("SELECT item_id, last_edit FROM layer_sync").fetchall())
+    checkpoints = dict(synced)  # Edits after these were not seen by the last run, even when the table is rebuilt
+    previous_rows = defaultdict(set)
+    for item_id, object_id, cab_id in connection.execute("SELECT item_id, objectid, cab_id FROM membership"):
+        previous_rows[item_id].add((object_id, cab_id))
+    covered = {row[0] for row in connection.execute("SELECT cab_id FROM membership_fdhs")}
+    now = datetime.now().isoformat(timespec="seconds")
+
+    try:
+        changed = refresh_fdh_index(fdh_boundary_id) if refresh_index else set()
+        affected = defaultdict(set, {cab_id: {fdh_boundary_id} for cab_id in changed})
+        fdh_by_cab_id = {str(fdh.attributes.get("cab_id")).upper(): fdh for fdh in load_fdh_index()["features"]}
+        requested = {str(cab_id).upper() for cab_id in cab_ids} if cab_ids is not None else \
+            (set() if covered else set(fdh_by_cab_id))
+        fdh_version = fdh_index_version(connection)
+        if synced.get(fdh_boundary_id) != fdh_version:  # For the FDH layer the sync row holds the index version
+            arcpy.AddMessage("► FDH boundaries changed, rebuilding the membership table.")
+            connection.execute("DELETE FROM membership")
+            connection.execute("DELETE FROM layer_sync")
+            synced = {}
+        fdh_features = [fdh_by_cab_id[cab_id] for cab_id in sorted(covered | requested) if cab_id in fdh_by_cab_id]
+        new_fdhs = [fdh_by_cab_id[cab_id] for cab_id in sorted(requested - covered) if cab_id in fdh_by_cab_id]
+        extent = fdh_extent(fdh_features)
+
+        for item_id in item_ids:
+            edit_field = edit_date_field(item_id, "Membership")
+            last_edit = synced.get(item_id) if edit_field else None
+            out_fields = ", ".join(filter(None, ["OBJECTID", edit_field]))
+
+            if last_edit is None:
+                features = fetch_layer_features(item_id, "Membership", out_fields=out_fields, extent=extent) \
+                    if extent else []
+                connection.execute("DELETE FROM membership WHERE item_id = ?", (item_id,))
+                joined = join_to_fdhs(features, fdh_features)
+            else:
+                features = fetch_layer_features(item_id, "Membership", edited_since(edit_field, last_edit),
+                                                out_fields)
+                edited_ids = [(item_id, feature.attributes.get("OBJECTID")) for feature in features]
+                connection.executemany("DELETE FROM membership WHERE item_id = ? AND objectid = ?", edited_ids)
+                joined = join_to_fdhs(features, fdh_features)
+                if new_fdhs:  # Their features are older than the checkpoint, so they do not move it
+                    joined += join_to_fdhs(fetch_layer_features(item_id, "Membership", out_fields=out_fields,
+                                                                extent=fdh_extent(new_fdhs)), new_fdhs)
+
+                # Drop rows of deleted features
+                layer_ids = run_request(get_portal_layer(item_id, "Membership").query, item_id,
+                                        where="1=1", geometry_filter=filters.intersects(extent, sr=JOIN_SR),
+                                        return_ids_only=True) if extent else {}
+                live_ids = set(layer_ids.get("objectIds") or [])
+                stored_ids = {row[0] for row in connection.execute(
+                    "SELECT DISTINCT objectid FROM membership WHERE item_id = ?", (item_id,))}
+                connection.executemany("DELETE FROM membership WHERE item_id = ? AND objectid = ?",
+                                       [(item_id, object_id) for object_id in stored_ids - live_ids])
+
+            connection.executemany("INSERT OR REPLACE INTO membership VALUES (?, ?, ?, ?)",
+                                   [(item_id, *row) for row in joined])
+            newest = latest_edit(features, edit_field)
+            connection.execute("INSERT OR REPLACE INTO layer_sync VALUES (?, ?, ?)",
+                               (item_id, max(filter(None, [newest, last_edit]), default=None), now))
+
+            # FDHs gaining or losing a feature, plus FDHs holding a feature edited since the last checkpoint
+            rows = set(connection.execute("SELECT objectid, cab_id FROM membership WHERE item_id = ?", (item_id,)))
+            checkpoint = checkpoints.get(item_id) if edit_field else None
+            edited = {feature.attributes.get("OBJECTID") for feature in features
+                      if checkpoint is None or (feature.attributes.get(edit_field) or 0) > checkpoint}
+            for _, cab_id in (rows ^ previous_rows[item_id]) | {row for row in rows if row[0] in edited}:
+                affected[cab_id].add(item_id)
+            arcpy.AddMessage(f"► Membership of layer {item_id}: {len(features)} features "
+                             f"{'re-joined' if last_edit is not None else 'joined'}"
+                             f"{f', {len(new_fdhs)} FDHs added' if new_fdhs and last_edit is not None else ''}.")
+
+        connection.executemany("INSERT OR IGNORE INTO membership_fdhs VALUES (?)",
+                               [(str(fdh.attributes.get("cab_id")).upper(),) for fdh in fdh_features])
+        connection.execute("INSERT OR REPLACE INTO layer_sync VALUES (?, ?, ?)", (fdh_boundary_id, fdh_version, now))
+        connection.commit()
+        return dict(affected)
+    except Exception as e:
+        connection.rollback()
+        arcpy.AddWarning(f"⚠ Membership table could not be updated, spatial queries will be used: {e}")
+        return None
+    finally:
+        connection.close()
+
+
+def refresh_fdh_index(fdh_boundary_id):
+    """Pulls FDH boundary edits into the local index: only boundaries edited since the newest indexed edit when the
+    layer is edit tracked, everything otherwise. Returns the cab_ids of boundaries added, changed or removed."""
+    connection = open_local_db()
+    try:
+        edit_field = edit_date_field(fdh_boundary_id, "FDH Index")
+        last_edit = connection.execute("SELECT MAX(edit_date) FROM fdh_boundaries").fetchone()[0] \
+            if edit_field else None
+        features = fetch_layer_features(fdh_boundary_id, "FDH Index",
+                                        edited_since(edit_field, last_edit) if last_edit else "1=1", "*")
+
+        changed = set()
+        for feature in features:
+            attributes = feature.attributes
+            prepared = prepare_geometry(feature.geometry)
+            if prepared is None:
+                continue
+            row = (attributes.get("cab_id"), attributes.get("Serv_Area"), json.dumps(attributes, default=str),
+                   json.dumps(feature.geometry), *prepared["bbox"], attributes.get(edit_field) if edit_field else None)
+            stored = connection.execute("SELECT cab_id, serv_area, attributes, geometry FROM fdh_boundaries "
+                                        "WHERE objectid = ?", (attributes.get("OBJECTID"),)).fetchone()
+            if stored != row[:4]:
+                changed |= {attributes.get("cab_id")} | ({stored[0]} if stored else set())
+                connection.execute("INSERT OR REPLACE INTO fdh_boundaries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (attributes.get("OBJECTID"), *row))
+
+        # Drop deleted boundaries
+        if last_edit:
+            live_ids = set(run_request(get_portal_layer(fdh_boundary_id, "FDH Index").query, fdh_boundary_id,
+                                       where="1=1", return_ids_only=True).get("objectIds") or [])
+        else:
+            live_ids = {feature.attributes.get("OBJECTID") for feature in features}
+        stored = dict(connection.execute("SELECT objectid, cab_id FROM fdh_boundaries").fetchall())
+        deleted = set(stored) - live_ids
+        connection.executemany("DELETE FROM fdh_boundaries WHERE objectid = ?",
+                               [(object_id,) for object_id in deleted])
+        changed |= {stored[object_id] for object_id in deleted}
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        arcpy.AddWarning(f"⚠ FDH index could not be refreshed, using the boundaries already indexed: {e}")
+        return set()
+    finally:
+        connection.close()
+
+    fdh_index.clear()
+    arcpy.AddMessage(f"► FDH index refreshed: {len(changed)} boundaries added, changed or removed.")
+    return changed
+
+
+def fdh_index_version(connection):
+    """A fingerprint of the indexed FDH boundaries, it changes whenever any boundary does."""
+    version = hashlib.sha1()
+    for row in connection.execute("SELECT objectid, cab_id, geometry FROM fdh_boundaries ORDER BY objectid"):
+        version.update(json.dumps(row).encode())
+    return version.hexdigest()
+
+
+def load_fdh_index():
+    """Loads the indexed FDH boundaries into memory with an R-tree, once per run."""
+    if not fdh_index:
+        connection = open_local_db()
+        try:
+            rows = connection.execute("SELECT attributes, geometry FROM fdh_boundaries ORDER BY objectid").fetchall()
+        finally:
+            connection.close()
+        features = [arcgis.features.Feature(geometry=json.loads(geometry), attributes=json.loads(attributes))
+                    for attributes, geometry in rows]
+        fdh_index["features"] = features
+        fdh_index["index"] = FeatureIndex(features)
+        fdh_index["by_cab_id"] = {str(feature.attributes.get("cab_id")).upper(): feature for feature in features}
+    return fdh_index
+
+
+def copy_feature(feature):
+    """A feature with its own copy of the geometry and attributes."""
+    return arcgis.features.Feature(geometry=json.loads(json.dumps(feature.geometry)),
+                                   attributes=dict(feature.attributes))
+
+
+def fdh_index_feature(cab_id):
+    """An FDH boundary from the local index by cab_id (with its own copy of the geometry), or None."""
+    feature = load_fdh_index()["by_cab_id"].get(str(cab_id).upper())
+    if feature is None:
+        return None
+    return copy_feature(feature)
+
+
+def fdhs_at_point(x, y):
+    """cab_ids of the indexed FDH boundaries containing a point given in JOIN_SR."""
+    return [feature.attributes.get("cab_id") for feature in load_fdh_index()["index"].intersects({"x": x, "y": y})]
+
+
+def fdhs_in_serv_area(serv_area):
+    """cab_ids of every indexed FDH boundary in a service area."""
+    connection = open_local_db()
+    try:
+        return [row[0] for row in connection.execute(
+            "SELECT cab_id FROM fdh_boundaries WHERE UPPER(serv_area) = UPPER(?) ORDER BY cab_id", (serv_area,))]
+    finally:
+        connection.close()
+
+
+def membership_object_ids(item_id, cab_id):
+    """OBJECTIDs of a layer's features touching an FDH, or None when the layer or the FDH is not in the membership
+    table."""
+    if not os.path.exists(LOCAL_DB):
+        return None
+    connection = open_local_db()
+    try:
+        if not connection.execute("SELECT 1 FROM layer_sync WHERE item_id = ?", (item_id,)).fetchone():
+            return None
+        if not connection.execute("SELECT 1 FROM membership_fdhs WHERE cab_id = ?",
+                                  (str(cab_id).upper(),)).fetchone():
+            return None
+        # Rows hold the cab_id as stored in Portal, the caller may pass it in another case
+        return [row[0] for row in connection.execute(
+            "SELECT objectid FROM membership WHERE item_id = ? AND UPPER(cab_id) = ? ORDER BY objectid",
+            (item_id, str(cab_id).upper()))]
+    finally:
+        connection.close()
+
+
+def planned_view(item_id, query_kwargs):
+    """Answers a stage's spatial query against the FDH from the merged read, or returns None if it cannot."""
+    plan = bom_context().planned_reads.get(item_id)
+    geometry_filter = query_kwargs.get("geometry_filter")
+    if plan is None or not isinstance(geometry_filter, dict):
+        return None
+    where = query_kwargs.get("where", "1=1")
+    if where not in compiled_predicates or query_kwargs.get("out_sr") != JOIN_SR:
+        return None  # Only where clauses built from attribute predicates can be checked locally
+    if plan["wheres"] is not None and where not in plan["wheres"]:
+        return None
+    if json.dumps((geometry_filter.get("geometry") or {}).get("rings")) != plan["rings"]:
+        return None  # Not a query against this FDH
+
+    requested = field_set(query_kwargs.get("out_fields"))
+    if plan["fields"] is not None and (requested is None or not requested <= plan["fields"]):
+        return None
+
+    relation = query_kwargs.get("spatial_rel") or geometry_filter.get("spatialRel")
+    if relation == "esriSpatialRelIntersects":
+        features = plan["features"]
+    elif relation == "esriSpatialRelContains":
+        inside = set(plan["index"].query(geometry_filter["geometry"], "contains"))
+        features = [feature for i, feature in enumerate(plan["features"]) if i in inside]
+    else:
+        return None
+    predicates = compiled_predicates[where]
+    return LayerResult([feature for feature in features if matches_predicates(feature.attributes, predicates)])
+
+
+def report_request_counts(cab_id):
+    """Prints the number of Portal requests the FDH took, per layer."""
+    context = bom_context()
+    total = sum(context.request_counts.values())
+    arcpy.AddMessage(f"*** Portal Requests for {cab_id}: {total} ***\n" +
+                     "\n".join(f"► {layer_key}: {count}" for layer_key, count in context.request_counts.items()) +
+                     "\n")
+    report_governors()
+    report_sr_timings()
+
+
+def mark_stage_failed(stage, error):
+    """Records a stage whose results cannot be trusted so it is not mistaken for a real zero."""
+    bom_context().failed_stages[stage] = str(error)
+
+
+def report_failed_stages():
+    """Reports every failed stage at the end of the run. Returns True if the BOM is incomplete."""
+    context = bom_context()
+    if not context.failed_stages:
+        return False
+
+    arcpy.AddError("❌ The following stages FAILED. Their quantities are NOT zero, they are unknown:\n" +
+                   "\n".join(f"► {stage}: {error}" for stage, error in context.failed_stages.items()) +
+                   "\n")
+    return True
+
+
+def prepare_geometry(geometry):
+    """Converts an Esri JSON geometry into vertex and segment arrays used by the local spatial predicates."""
+    if geometry is None:
+        return None
+    if not isinstance(geometry, dict) and hasattr(geometry, "JSON"):
+        geometry = json.loads(geometry.JSON)  # ArcPy Geometry
+
+    if geometry.get("x") is not None:
+        kind, parts = "point", [np.array([[geometry["x"], geometry["y"]]], dtype=float)]
+    elif geometry.get("points"):
+        kind, parts = "point", [np.asarray(geometry["points"], dtype=float)[:, :2]]
+    elif geometry.get("paths"):
+        kind, parts = "line", [np.asarray(path, dtype=float)[:, :2] for path in geometry["paths"] if len(path)]
+    elif geometry.get("rings"):
+        kind, parts = "polygon", [np.asarray(ring, dtype=float)[:, :2] for ring in geometry["rings"] if len(ring)]
+    else:
+        return None
+
+    if not parts:
+        return None
+
+    vertices = np.vstack(parts)
+    if kind == "point":
+        segments = np.empty((0, 4))
+    else:
+        segments = np.vstack([np.hstack([part[:-1], part[1:]]) for part in parts if len(part) > 1] or
+                             [np.empty((0, 4))])
+
+    return {
+        "kind": kind,
+        "vertices": vertices,
+        "segments": segments,
+        "bbox": np.array([vertices[:, 0].min(), vertices[:, 1].min(), vertices[:, 0].max(), vertices[:, 1].max()])
+    }
+
+
+def points_in_polygon(points, segments):
+    """Even-odd test of many points against every ring edge of a polygon at once."""
+    inside = np.zeros(len(points), dtype=bool)
+    if not len(points) or not len(segments):
+        return inside
+
+    x1, y1, x2, y2 = (segments[:, i][None, :] for i in range(4))
+    chunk = max(1, 4_000_000 // len(segments))  # Keeps the point x edge matrix to a few million cells
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start in range(0, len(points), chunk):
+            px = points[start:start + chunk, 0][:, None]
+            py = points[start:start + chunk, 1][:, None]
+            crosses = ((y1 > py) != (y2 > py)) & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+            inside[start:start + chunk] = crosses.sum(axis=1) % 2 == 1
+    return inside
+
+
+def points_in_or_on_polygon(points, segments):
+    """Like points_in_polygon, but points on the boundary (within JOIN_TOLERANCE) count as inside."""
+    inside = points_in_polygon(points, segments)
+    if (~inside).any():
+        inside[~inside] = point_segment_distances(points[~inside], segments) <= JOIN_TOLERANCE
+    return inside
+
+
+def point_segment_distances(points, segments):
+    """Distance from each point to the nearest of the given segments."""
+    if not len(segments):
+        return np.full(len(points), np.inf)
+
+    a = segments[None, :, :2]
+    ab = segments[None, :, 2:] - a
+    p = points[:, None, :]
+    length_sq = (ab ** 2).sum(axis=2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(length_sq > 0, ((p - a) * ab).sum(axis=2) / length_sq, 0.0)
+    nearest = a + np.clip(t, 0.0, 1.0)[:, :, None] * ab
+    return np.sqrt(((p - nearest) ** 2).sum(axis=2)).min(axis=1)
+
+
+def segments_cross(segments_a, segments_b, proper=False):
+    """Returns True if any segment in the first set crosses (or, unless proper, touches) one in the second."""
+    if not len(segments_a) or not len(segments_b):
+        return False
+
+    a1, a2 = segments_a[:, None, :2], segments_a[:, None, 2:]
+    b1, b2 = segments_b[None, :, :2], segments_b[None, :, 2:]
+
+    def orientation(p, q, r):
+        return (q[..., 0] - p[..., 0]) * (r[..., 1] - p[..., 1]) - (q[..., 1] - p[..., 1]) * (r[..., 0] - p[..., 0])
+
+    o1, o2 = orientation(a1, a2, b1), orientation(a1, a2, b2)
+    o3, o4 = orientation(b1, b2, a1), orientation(b1, b2, a2)
+    if proper:
+        # Endpoints within JOIN_TOLERANCE of the other segment touch it, they do not cross it
+        reach_a = JOIN_TOLERANCE * np.hypot(*(a2 - a1).transpose(2, 0, 1))
+        reach_b = JOIN_TOLERANCE * np.hypot(*(b2 - b1).transpose(2, 0, 1))
+        crossing = ((o1 * o2 < 0) & (o3 * o4 < 0) & (np.minimum(abs(o1), abs(o2)) > reach_a) &
+                    (np.minimum(abs(o3), abs(o4)) > reach_b))
+        return bool(crossing.any())
+
+    boxes_overlap = ((np.minimum(a1[..., 0], a2[..., 0]) <= np.maximum(b1[..., 0], b2[..., 0])) &
+                     (np.minimum(b1[..., 0], b2[..., 0]) <= np.maximum(a1[..., 0], a2[..., 0])) &
+                     (np.minimum(a1[..., 1], a2[..., 1]) <= np.maximum(b1[..., 1], b2[..., 1])) &
+                     (np.minimum(b1[..., 1], b2[..., 1]) <= np.maximum(a1[..., 1], a2[..., 1])))
+    return bool(((o1 * o2 <= 0) & (o3 * o4 <= 0) & boxes_overlap).any())
+
+
+def geometry_distance(first, second):
+    """Planar distance between two prepared geometries, 0 when they touch, cross or one lies inside the other."""
+    if segments_cross(first["segments"], second["segments"]):
+        return 0.0
+    if second["kind"] == "polygon" and points_in_polygon(first["vertices"][:1], second["segments"]).any():
+        return 0.0
+    if first["kind"] == "polygon" and points_in_polygon(second["vertices"][:1], first["segments"]).any():
+        return 0.0
+
+    if first["kind"] == "point" and second["kind"] == "point":
+        deltas = first["vertices"][:, None, :] - second["vertices"][None, :, :]
+        return float(np.sqrt((deltas ** 2).sum(axis=2)).min())
+
+    return float(min(point_segment_distances(first["vertices"], second["segments"]).min(),
+                     point_segment_distances(second["vertices"], first["segments"]).min()))
+
+
+def polygon_contains(polygon, other):
+    """True when every vertex of the other geometry is inside the polygon and none of its segments leave it."""
+    if not points_in_or_on_polygon(other["vertices"], polygon["segments"]).all():
+        return False
+    return not segments_cross(other["segments"], polygon["segments"], proper=True)
+
+
+class FeatureIndex:
+    """STR-packed R-tree over features already fetched from Portal, used for local bulk spatial joins.
+
+    Build one per layer per FDH, then call contains/intersects/within_distance (or the bulk_* variants) with
+    Esri JSON geometries in the same spatial reference. Each lookup walks the tree in O(log n) and only runs the
+    exact vectorized predicate on the candidates whose bounding boxes overlap the query.
+    """
+
+    def __init__(self, features, node_capacity=16):
+        self.features = []
+        self.geometries = []
+        for feature in features:
+            prepared = prepare_geometry(getattr(feature, "geometry", feature))
+            if prepared is not None:
+                self.features.append(feature)
+                self.geometries.append(prepared)
+
+        self.node_capacity = node_capacity
+        self.boxes = (np.array([geom["bbox"] for geom in self.geometries]) if self.geometries
+                      else np.empty((0, 4)))
+
+        # Point layers get a fully vectorized fast path over all candidates at once
+        self.all_points = all(geom["kind"] == "point" and len(geom["vertices"]) == 1 for geom in self.geometries)
+        self.point_coords = self.boxes[:, :2] if self.all_points else None
+
+        self.levels = []
+        self.leaf_order = np.arange(len(self.geometries))
+        if len(self.geometries):
+            self.leaf_order, node_boxes, starts, ends = self._str_pack(self.boxes)
+            self.levels.append((node_boxes, starts, ends))
+            while len(node_boxes) > node_capacity:
+                order, node_boxes, starts, ends = self._str_pack(node_boxes)
+                previous_boxes, previous_starts, previous_ends = self.levels[-1]
+                self.levels[-1] = (previous_boxes[order], previous_starts[order], previous_ends[order])
+                self.levels.append((node_boxes, starts, ends))
+            self.levels.reverse()  # Root level first
+
+    def __len__(self):
+        return len(self.features)
+
+    def _str_pack(self, boxes):
+        """Sort-Tile-Recursive packing: returns the entry order plus the parent node boxes and child ranges."""
+        count = len(boxes)
+        centers_x = (boxes[:, 0] + boxes[:, 2]) / 2
+        centers_y = (boxes[:, 1] + boxes[:, 3]) / 2
+        slice_size = int(np.ceil(np.sqrt(np.ceil(count / self.node_capacity)))) * self.node_capacity
+
+        by_x = np.argsort(centers_x, kind="stable")
+        order = np.concatenate([chunk[np.argsort(centers_y[chunk], kind="stable")]
+                                for chunk in (by_x[i:i + slice_size] for i in range(0, count, slice_size))])
+
+        starts = np.arange(0, count, self.node_capacity)
+        ends = np.minimum(starts + self.node_capacity, count)
+        packed = boxes[order]
+        node_boxes = np.column_stack([np.minimum.reduceat(packed[:, 0], starts),
+                                      np.minimum.reduceat(packed[:, 1], starts),
+                                      np.maximum.reduceat(packed[:, 2], starts),
+                                      np.maximum.reduceat(packed[:, 3], starts)])
+        return order, node_boxes, starts, ends
+
+    def candidates(self, bbox):
+        """Indices of features whose bounding box overlaps the given [xmin, ymin, xmax, ymax]."""
+        if not self.levels:
+            return np.empty(0, dtype=int)
+
+        def overlapping(boxes):
+            return ((boxes[:, 0] <= bbox[2]) & (boxes[:, 2] >= bbox[0]) &
+                    (boxes[:, 1] <= bbox[3]) & (boxes[:, 3] >= bbox[1]))
+
+        nodes = np.arange(len(self.levels[0][0]))
+        for node_boxes, starts, ends in self.levels:
+            nodes = nodes[overlapping(node_boxes[nodes])]
+            lengths = ends[nodes] - starts[nodes]
+            if not lengths.sum():
+                return np.empty(0, dtype=int)
+            offsets = np.repeat(starts[nodes] - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+            nodes = np.arange(lengths.sum()) + offsets
+
+        found = self.leaf_order[nodes]
+        return found[overlapping(self.boxes[found])]
+
+    def query(self, geometry, predicate="intersects", distance=0.0):
+        """Returns indices of indexed features matching the predicate against a query geometry.
+
+        predicate is one of "contains" (the query polygon contains the feature), "intersects" or
+        "within_distance".
+        """
+        query_geom = prepare_geometry(geometry)
+        if query_geom is None:
+            return []
+
+        reach = distance if predicate == "within_distance" else JOIN_TOLERANCE if predicate == "intersects" else 0
+        bbox = query_geom["bbox"] + np.array([-reach, -reach, reach, reach])
+        found = self.candidates(bbox)
+        if not len(found):
+            return []
+
+        if predicate == "contains":
+            if query_geom["kind"] != "polygon":
+                return []
+            if self.all_points:
+                return list(found[points_in_or_on_polygon(self.point_coords[found], query_geom["segments"])])
+            return [i for i in found if polygon_contains(query_geom, self.geometries[i])]
+
+        if self.all_points:
+            points = self.point_coords[found]
+            if query_geom["kind"] == "point":
+                nearest = np.sqrt(((points[:, None, :] - query_geom["vertices"][None, :, :]) ** 2)
+                                  .sum(axis=2)).min(axis=1)
+            else:
+                nearest = point_segment_distances(points, query_geom["segments"])
+                if query_geom["kind"] == "polygon":
+                    nearest[points_in_polygon(points, query_geom["segments"])] = 0.0
+            return list(found[nearest <= reach])
+
+        return [i for i in found if geometry_distance(query_geom, self.geometries[i]) <= reach]
+
+    def contains(self, geometry):
+        """Indexed features that lie inside the query polygon."""
+        return [self.features[i] for i in self.query(geometry, "contains")]
+
+    def intersects(self, geometry):
+        """Indexed features that touch or cross the query geometry (within JOIN_TOLERANCE)."""
+        return [self.features[i] for i in self.query(geometry, "intersects")]
+
+    def within_distance(self, geometry, distance):
+        """Indexed features within the given distance of the query geometry."""
+        return [self.features[i] for i in self.query(geometry, "within_distance", distance)]
+
+    def bulk_query(self, geometries, predicate="intersects", distance=0.0):
+        """Runs one predicate for many query geometries, returning a list of matching features per geometry."""
+        return [[self.features[i] for i in self.query(geometry, predicate, distance)] for geometry in geometries]
+
+
+def load_mdu_boundaries(fdh_geometry, stage="MDU Exclusion"):
+    """Fetches the MDU polygons touching the FDH boundary. Repeat calls for the same FDH hit the query cache."""
+    return query_layer(mdu_boundary_id, stage, **stage_query("Addresses", mdu_boundary_id, fdh_geometry)).features
+
+
+def representative_point(prepared):
+    """A single point used to place a feature: the point itself, the halfway point of a line or a polygon's
+    vertex average."""
+    vertices = prepared["vertices"]
+    if prepared["kind"] == "point":
+        return vertices[0]
+    if prepared["kind"] == "polygon":
+        return vertices.mean(axis=0)
+
+    segments = prepared["segments"]
+    if not len(segments):
+        return vertices[0]
+    lengths = np.hypot(segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1])
+    if lengths.sum() == 0:
+        return vertices[0]
+    halfway = lengths.sum() / 2
+    cumulative = np.cumsum(lengths)
+    i = int(np.searchsorted(cumulative, halfway))
+    fraction = (halfway - (cumulative[i] - lengths[i])) / lengths[i] if lengths[i] else 0.0
+    return segments[i, :2] + fraction * (segments[i, 2:] - segments[i, :2])
+
+
+def tag_mdu_features(fdh_geometry):
+    """Tags every feature fetched or planned for the FDH with an '_in_mdu' attribute using one local join against
+    the MDU polygons. A feature is inside an MDU when its representative point is. Returns the number tagged inside."""
+    mdu_polygons = [prepare_geometry(mdu.geometry) for mdu in load_mdu_boundaries(fdh_geometry)]
+    mdu_polygons = [polygon for polygon in mdu_polygons if polygon is not None]
+
+    context = bom_context()
+    features = {}
+    for result in list(context.query_cache.values()):
+        for feature in getattr(result, "features", None) or []:
+            features[id(feature)] = feature
+    for plan in list(context.planned_reads.values()):  # Partitions of a Serv_Area read are not in query_cache
+        for feature in plan["features"]:
+            features[id(feature)] = feature
+    features = list(features.values())
+
+    prepared = [prepare_geometry(feature.geometry) for feature in features]
+    has_geometry = np.array([geom is not None for geom in prepared], dtype=bool)
+    points = np.array([representative_point(geom) if geom is not None else (np.nan, np.nan) for geom in prepared],
+                      dtype=float).reshape(-1, 2)
+
+    in_mdu = np.zeros(len(features), dtype=bool)
+    for polygon in mdu_polygons:
+        xmin, ymin, xmax, ymax = polygon["bbox"]
+        in_box = (has_geometry & (points[:, 0] >= xmin) & (points[:, 0] <= xmax) &
+                  (points[:, 1] >= ymin) & (points[:, 1] <= ymax))
+        in_mdu[in_box] |= points_in_polygon(points[in_box], polygon["segments"])
+
+    for feature, inside in zip(features, in_mdu):
+        feature.attributes["_in_mdu"] = bool(inside)
+
+    return int(in_mdu.sum())
+
+
+def compare_mdu_values(values_with_mdu, values_without_mdu):
+    """Pairs every numeric BOM quantity with and without MDU features and reports the ones that changed."""
+    cab_id = bom_context().cab_id
+    comparison = {}
+    for key, with_mdu in values_with_mdu.items():
+        without_mdu = values_without_mdu.get(key)
+        if isinstance(with_mdu, (int, float)) and isinstance(without_mdu, (int, float)):
+            comparison[key] = (with_mdu, without_mdu)
+
+    changed = [f"► {key}: {with_mdu:.2f} with MDU | {without_mdu:.2f} without MDU"
+               for key, (with_mdu, without_mdu) in comparison.items() if with_mdu != without_mdu]
+    arcpy.AddMessage(f"*** BOM Quantities Changed by Excluding MDU Features Within {cab_id}: ***\n"
+                     f"------------------------------------------------------------------\n" +
+                     ("\n".join(changed) if changed else "► No quantities changed") +
+                     "\n")
+    return comparison
+
+
+def line_segments(features):
+    """Flattens the paths of many line features into one (n, 4) segment array plus the owning feature index."""
+    coords = []
+    path_lengths = []
+    owners = []
+    for i, feature in enumerate(features):
+        geometry = getattr(feature, "geometry", None) or {}
+        for path in geometry.get("paths") or []:
+            coords.extend((vertex[0], vertex[1]) for vertex in path)
+            path_lengths.append(len(path))
+            owners.append(i)
+
+    if not coords:
+        return np.empty((0, 4)), np.empty(0, dtype=int)
+
+    points = np.asarray(coords, dtype=float)
+    path_lengths = np.asarray(path_lengths)
+    is_last_vertex = np.zeros(len(points), dtype=bool)
+    is_last_vertex[np.cumsum(path_lengths) - 1] = True
+    keep = ~is_last_vertex[:-1]  # A segment may not join the end of one path to the start of the next
+
+    segments = np.hstack([points[:-1], points[1:]])[keep]
+    segment_owners = np.repeat(np.asarray(owners), np.maximum(path_lengths - 1, 0))
+    return segments, segment_owners
+
+
+def geodesic_segment_lengths(segments):
+    """Ellipsoidal (WGS 1984) length in meters of many short Web Mercator segments at once."""
+    radius = 6378137.0
+    eccentricity_sq = 0.00669437999014
+    lon1, lon2 = segments[:, 0] / radius, segments[:, 2] / radius
+    lat1 = np.pi / 2 - 2 * np.arctan(np.exp(-segments[:, 1] / radius))
+    lat2 = np.pi / 2 - 2 * np.arctan(np.exp(-segments[:, 3] / radius))
+
+    sin_mid = np.sin((lat1 + lat2) / 2)
+    w = 1 - eccentricity_sq * sin_mid ** 2
+    meridian = radius * (1 - eccentricity_sq) / w ** 1.5  # Radius of curvature north-south
+    prime_vertical = radius / np.sqrt(w)  # Radius of curvature east-west
+    return np.hypot(meridian * (lat2 - lat1), prime_vertical * np.cos((lat1 + lat2) / 2) * (lon2 - lon1))
+
+
+def segment_inside_fractions(segments, polygon_segments):
+    """Fraction of each segment's length that lies inside a polygon, for many segments at once.
+
+    A coarse grid marks the cells the polygon boundary passes through. Segments that never touch a marked cell
+    take the inside/outside status of their cell, and only the few segments near the boundary are intersected
+    with the polygon edges exactly.
+    """
+    fractions = np.zeros(len(segments))
+    if not len(segments) or not len(polygon_segments):
+        return fractions
+
+    xmin = min(polygon_segments[:, 0].min(), polygon_segments[:, 2].min())
+    xmax = max(polygon_segments[:, 0].max(), polygon_segments[:, 2].max())
+    ymin = min(polygon_segments[:, 1].min(), polygon_segments[:, 3].min())
+    ymax = max(polygon_segments[:, 1].max(), polygon_segments[:, 3].max())
+
+    seg_xmin = np.minimum(segments[:, 0], segments[:, 2])
+    seg_xmax = np.maximum(segments[:, 0], segments[:, 2])
+    seg_ymin = np.minimum(segments[:, 1], segments[:, 3])
+    seg_ymax = np.maximum(segments[:, 1], segments[:, 3])
+    overlaps = (seg_xmax >= xmin) & (seg_xmin <= xmax) & (seg_ymax >= ymin) & (seg_ymin <= ymax)
+
+    # Mark every grid cell within one cell of the boundary
+    grid = int(np.clip(8 * np.sqrt(len(polygon_segments)), 16, 512))
+    cell_w = max((xmax - xmin) / grid, 1e-9)
+    cell_h = max((ymax - ymin) / grid, 1e-9)
+    edge_lengths = np.hypot(polygon_segments[:, 2] - polygon_segments[:, 0],
+                            polygon_segments[:, 3] - polygon_segments[:, 1])
+    samples = np.ceil(edge_lengths / (0.5 * min(cell_w, cell_h))).astype(int) + 1
+    t = np.concatenate([np.linspace(0, 1, n) for n in samples])
+    edge_of_sample = np.repeat(np.arange(len(polygon_segments)), samples)
+    sample_x = polygon_segments[edge_of_sample, 0] + t * (polygon_segments[edge_of_sample, 2] -
+                                                          polygon_segments[edge_of_sample, 0])
+    sample_y = polygon_segments[edge_of_sample, 1] + t * (polygon_segments[edge_of_sample, 3] -
+                                                          polygon_segments[edge_of_sample, 1])
+
+    marked = np.zeros((grid + 2, grid + 2), dtype=bool)  # One cell of padding on every side for the dilation
+    cx = np.clip(((sample_x - xmin) / cell_w).astype(int), 0, grid - 1) + 1
+    cy = np.clip(((sample_y - ymin) / cell_h).astype(int), 0, grid - 1) + 1
+    marked[cy, cx] = True
+    dilated = marked.copy()
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            dilated[1:-1, 1:-1] |= marked[1 + dy:grid + 1 + dy, 1 + dx:grid + 1 + dx]
+    marked = dilated[1:-1, 1:-1]
+    marked_area = np.pad(marked.astype(int).cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+
+    # Cells away from the boundary are entirely inside or entirely outside. Count, per grid row, the edge crossings
+    # of a horizontal ray through the cell centers; an odd count to the left of an unmarked cell puts it inside.
+    row_y = ymin + (np.arange(grid) + 0.5) * cell_h
+    y1, y2 = polygon_segments[None, :, 1], polygon_segments[None, :, 3]
+    x1, x2 = polygon_segments[None, :, 0], polygon_segments[None, :, 2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        spans_row = (y1 > row_y[:, None]) != (y2 > row_y[:, None])
+        crossing_x = (x2 - x1) * (row_y[:, None] - y1) / (y2 - y1) + x1
+    rows_hit, edges_hit = np.nonzero(spans_row)
+    crossing_cols = np.clip(((crossing_x[rows_hit, edges_hit] - xmin) / cell_w).astype(int), 0, grid - 1)
+    crossings = np.zeros((grid, grid), dtype=int)
+    np.add.at(crossings, (rows_hit, crossing_cols), 1)
+    cell_inside = np.hstack([np.zeros((grid, 1), dtype=int), np.cumsum(crossings, axis=1)[:, :-1]]) % 2 == 1
+
+    def grid_status(px, py):
+        in_bbox = (px >= xmin) & (px <= xmax) & (py >= ymin) & (py <= ymax)
+        col = np.clip(((px - xmin) / cell_w).astype(int), 0, grid - 1)
+        row = np.clip(((py - ymin) / cell_h).astype(int), 0, grid - 1)
+        return in_bbox & cell_inside[row, col], in_bbox & marked[row, col]
+
+    ix0 = np.clip(((seg_xmin - xmin) / cell_w).astype(int), 0, grid - 1)
+    ix1 = np.clip(((seg_xmax - xmin) / cell_w).astype(int), 0, grid - 1)
+    iy0 = np.clip(((seg_ymin - ymin) / cell_h).astype(int), 0, grid - 1)
+    iy1 = np.clip(((seg_ymax - ymin) / cell_h).astype(int), 0, grid - 1)
+    near_boundary = overlaps & ((marked_area[iy1 + 1, ix1 + 1] - marked_area[iy0, ix1 + 1] -
+                                 marked_area[iy1 + 1, ix0] + marked_area[iy0, ix0]) > 0)
+
+    interior = overlaps & ~near_boundary
+    fractions[interior] = grid_status((segments[interior, 0] + segments[interior, 2]) / 2,
+                                      (segments[interior, 1] + segments[interior, 3]) / 2)[0]
+
+    # Exact clipping for segments near the boundary: split each at its edge crossings and keep the pieces inside
+    candidates = np.flatnonzero(near_boundary)
+    qx, qy = polygon_segments[:, 0], polygon_segments[:, 1]
+    ex, ey = polygon_segments[:, 2] - qx, polygon_segments[:, 3] - qy
+    q_cross_e = qx * ey - qy * ex
+    chunk = max(1, 2_000_000 // len(polygon_segments))
+    for start in range(0, len(candidates), chunk):
+        rows = candidates[start:start + chunk]
+        px, py = segments[rows, 0], segments[rows, 1]
+        dx, dy = segments[rows, 2] - px, segments[rows, 3] - py
+
+        # Cross products written as outer products so no (segments x edges x 2) temporaries are built
+        denom = np.multiply.outer(dx, ey) - np.multiply.outer(dy, ex)
+        t_num = q_cross_e[None, :] - (np.multiply.outer(px, ey) - np.multiply.outer(py, ex))
+        u_num = (np.multiply.outer(dy, qx) - np.multiply.outer(dx, qy)) - (px * dy - py * dx)[:, None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = t_num / denom
+            u = u_num / denom
+        crossing_row, crossing_edge = np.nonzero((denom != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1))
+
+        # Sparse breakpoints: 0, every crossing and 1 for each segment, sorted by segment then position
+        break_row = np.concatenate([np.arange(len(rows)), crossing_row, np.arange(len(rows))])
+        break_t = np.concatenate([np.zeros(len(rows)), t[crossing_row, crossing_edge], np.ones(len(rows))])
+        order = np.lexsort((break_t, break_row))
+        break_row, break_t = break_row[order], break_t[order]
+
+        piece = (break_row[:-1] == break_row[1:]) & (break_t[1:] > break_t[:-1])
+        piece_row = break_row[:-1][piece]
+        lo, hi = break_t[:-1][piece], break_t[1:][piece]
+        mid_t = (lo + hi) / 2
+        mid_x = px[piece_row] + mid_t * dx[piece_row]
+        mid_y = py[piece_row] + mid_t * dy[piece_row]
+
+        inside, uncertain = grid_status(mid_x, mid_y)
+        inside[uncertain] = points_in_polygon(np.column_stack([mid_x[uncertain], mid_y[uncertain]]),
+                                              polygon_segments)
+        fractions[rows] = np.bincount(piece_row, weights=(hi - lo) * inside, minlength=len(rows))
+
+    return fractions
+
+
+def clipped_geodesic_lengths(features, clip_geometry):
+    """Full and clipped geodesic lengths in feet for every line feature, computed in one vectorized pass."""
+    full_ft = np.zeros(len(features))
+    clipped_ft = np.zeros(len(features))
+    clip_polygon = prepare_geometry(clip_geometry)
+    segments, owners = line_segments(features)
+    if not len(segments) or clip_polygon is None:
+        return full_ft, clipped_ft
+
+    segment_ft = geodesic_segment_lengths(segments) * FEET_PER_METER
+    inside = segment_inside_fractions(segments, clip_polygon["segments"])
+    full_ft += np.bincount(owners, weights=segment_ft, minlength=len(features))
+    clipped_ft += np.bincount(owners, weights=segment_ft * inside, minlength=len(features))
+    return full_ft, clipped_ft
+
+
+def check_stored_lengths(item_id, features):
+    """Flags line features whose stored footage no longer matches their geometry.
+
+    Runs once per fetched result, so the geometries the stages already requested are measured in one vectorized
+    pass. With USE_RECOMPUTED_LENGTHS the stale attribute is overwritten with the geodesic length in feet.
+    """
+    layer_label, field = LENGTH_FIELDS[item_id]
+    features = [feature for feature in features if field in feature.attributes]
+    segments, owners = line_segments(features)
+    if not len(segments):
+        return 0
+
+    geodesic_ft = np.bincount(owners, weights=geodesic_segment_lengths(segments) * FEET_PER_METER,
+                              minlength=len(features))
+    stored_ft = np.array([float(feature.attributes[field] or 0) for feature in features])
+    tolerance = np.maximum(LENGTH_TOLERANCE_FT, geodesic_ft * LENGTH_TOLERANCE_PCT / 100)
+    stale = np.flatnonzero(np.abs(stored_ft - geodesic_ft) > tolerance)
+
+    for i in stale:
+        attributes = features[i].attributes
+        object_id = attributes.get("OBJECTID", attributes.get("objectid"))
+        bom_context().stale_lengths[(layer_label, object_id)] = (round(float(stored_ft[i]), 2),
+                                                                 round(float(geodesic_ft[i]), 2))
+        if USE_RECOMPUTED_LENGTHS:
+            attributes[field] = round(float(geodesic_ft[i]), 2)
+    return len(stale)
+
+
+def report_stale_lengths():
+    """Summarizes stale footage attributes per layer and lists the worst offenders."""
+    context = bom_context()
+    if not context.stale_lengths:
+        if VALIDATE_LENGTHS:
+            arcpy.AddMessage("✅ Stored footage matches the geometry of every cable, strand, conduit and drop.\n")
+        return
+
+    per_layer = defaultdict(int)
+    for layer_label, _ in context.stale_lengths:
+        per_layer[layer_label] += 1
+    worst = sorted(context.stale_lengths.items(), key=lambda item: -abs(item[1][0] - item[1][1]))[:10]
+
+    action = "Recomputed lengths were used in the BOM." if USE_RECOMPUTED_LENGTHS else \
+        "Stored lengths were used in the BOM. Recalculate geometry or set USE_RECOMPUTED_LENGTHS."
+    arcpy.AddWarning(f"⚠️ Stale footage found on {len(context.stale_lengths)} features: " +
+                     ", ".join(f"{layer_label} {count}" for layer_label, count in per_layer.items()) + "\n" +
+                     "\n".join(f"► {layer_label} OBJECTID {object_id}: stored {stored:,.2f} ft, "
+                                f"geometry {geodesic:,.2f} ft"
+                                for (layer_label, object_id), (stored, geodesic) in worst) +
+                     f"\n{action}\n")
+
+
+def clip_factors(features, fdh_geometry):
+    """Share of each line feature's length inside the FDH, used to scale its footage attributes."""
+    full_ft, clipped_ft = clipped_geodesic_lengths(features, join_geometry(fdh_geometry))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(full_ft > 0, clipped_ft / full_ft, 1.0)
+
+
+# Engineering sheet cells written for each value, also used to list changed cells
+ENGINEERING_CELLS = {
+    "total_fiber_footage_ug_linear": ["F9"],
+    "total_fiber_footage_ae_linear": ["F13"],
+    "total_linear_footage": ["F7", "F15"],
+    "e_epmrt_1": ["F19"]  # If it needs to be written to multiple places
+}
+
+# Summary sheet cells written for each value
+SUMMARY_CELLS = {
+    "total_ug1ft": ['D66', 'D67', 'D131'],
+    "total_ug2ft": ["D68"],
+    "total_1in_conduit": ["D126"],
+    "total_2in_conduit": ["D125"],
+    "total_4in_conduit": ["D127"],
+    "total_sp1": ["D93"],
+    "total_sp2": ["D94"],
+    "total_sp3_excluding_f1": ["D95"],
+    "fiber_12": ["D108"],
+    "fiber_24": ["D107"],
+    "fiber_48": ["D106"],
+    "fiber_96": ["D105"],
+    "fiber_144": ["D104"],
+    "fiber_288": ["D103"],
+    "fiber_432": ["D110"],
+    "total_heatshrink": ["D132"],
+    "fp_count": ["D79", "D123"],
+    "sv_count": ["D74", "D118"],
+    "mv_count": ["D75", "D119"],
+    "lv_count": ["D76", "D120"],
+    "xl_count": ["D77", "D121"],
+    "xsv_count": ["D73", "D117"],
+    "nid_count": ["D142"],
+    "axl_count": ["D122"],
+    "coyote_count": ["D133"],
+    "x17_count": ["D134"],
+    "x22_count": ["D135"],
+    "x28_count": ["D137"],
+    "x19_count": ["D136"],
+    "runt_count": ["D138"],
+    "total_closure_count": ["D89"],
+    "hanger_bracket": ["D140"],
+    "offset_bracket": ["D141"],
+    "lash_closure_count": ["D91"],
+    "drop_count": ["C25"],
+    "total_hhp_mdu": ["C24"],
+    "total_strand_ftg": ['D49', "D50", "D113", "D114"],
+    "est_total_miles": ['C28'],
+    "ae_bom_miles": ['C29'],
+    "ug_bom_miles": ['C30'],
+    "percent_ae": ['C31'],
+    "percent_ug": ['C32'],
+    "total_hhp": ['C26'],
+    "total_f1_miles": ["C35"],
+    "total_f2_miles": ["C38"],
+    "total_f2_ug": ["C40"],
+    "total_f2_ae": ["C39"],
+    "total_ae_ftg": ["C33"],
+    "total_ug_ftg": ["C34"],
+    "total_f1_ae": ["C36"],
+    "total_f1_ug": ["C37"],
+    "pfd_1": ['D71'],
+    "passive_144": ["D149"],
+    "passive_288": ["D150"],
+    "passive_432": ["D151"],
+    "passive_576": ["D152"],
+    "ug_closure_count": ["D147", "D148"],
+    "snowshoes": ["D92", "D113"],
+    "conduit_couplers_1in": ["D128"],
+    "conduit_couplers_2in": ["D129"],
+    "conduit_couplers_4in": ["D130"],
+    "pfa_2": ["D51"],
+    "total_risers": ["D58", "D112"],
+    "cab_id": ["F2"],
+    "serv_area": ["F3"],
+    "city_code": ["F4"],
+    "total_strand_ftg_reareasment_y": ["D52"],
+    "total_cabinets": ["C42"],
+    "count_over_600ft": ["C41"],
+    "average_calcfootage": ["C44"],
+    "total_pole_count": ["C27"],
+    "mr_filtered_pole_count": ["D59"],
+    "active_cabinet_count": ["C43", "D86", "D87", "D78", "D122"],
+    "grounded_poles": ["D57"],
+    "tree_trimming": ["D53"],
+    "total_ug1ft_reareasment_Y": ["D72"],
+    "down_count": ["D54"],
+    "dirt_count": ["D55"],
+    "rock_count": ["D56"],
+    "total_anchors": ["D144"],
+    "uguard_adapter": ["D111"],
+    "lashing_wire": ["D116"],
+    "special_crossing": ["D70"]
+}
+
+# Rate card line items (RATE_CARD_ITEM_COLUMN codes) priced per unit of a BOM quantity, per rate card sheet. Every
+# priced row of a rate card must be listed and every code must be on it, RateCards refuses the template otherwise.
+RATE_CARD_LINES = {
+    "RateCard": {
+        "UG1": "total_ug1ft",
+        "UG2": "total_ug2ft",
+        "CON1": "total_1in_conduit",
+        "CON2": "total_2in_conduit",
+        "CON4": "total_4in_conduit",
+        "CPL1": "conduit_couplers_1in",
+        "CPL2": "conduit_couplers_2in",
+        "CPL4": "conduit_couplers_4in",
+        "SPX": "special_crossing",
+        "F12": "fiber_12",
+        "F24": "fiber_24",
+        "F48": "fiber_48",
+        "F96": "fiber_96",
+        "F144": "fiber_144",
+        "F288": "fiber_288",
+        "F432": "fiber_432",
+        "SP1": "total_sp1",
+        "SP2": "total_sp2",
+        "SP3": "total_sp3_excluding_f1",
+        "HS": "total_heatshrink",
+        "FP": "fp_count",
+        "SV": "sv_count",
+        "MV": "mv_count",
+        "LV": "lv_count",
+        "XL": "xl_count",
+        "XSV": "xsv_count",
+        "AXL": "axl_count",
+        "NID": "nid_count",
+        "COY": "coyote_count",
+        "X17": "x17_count",
+        "X19": "x19_count",
+        "X22": "x22_count",
+        "X28": "x28_count",
+        "RUNT": "runt_count",
+        "LASHCL": "lash_closure_count",
+        "UGCL": "ug_closure_count",
+        "HB": "hanger_bracket",
+        "OB": "offset_bracket",
+        "SNOW": "snowshoes",
+        "STR": "total_strand_ftg",
+        "LASH": "lashing_wire",
+        "TRIM": "tree_trimming",
+        "GRD": "grounded_poles",
+        "MR": "mr_filtered_pole_count",
+        "RSR": "total_risers",
+        "DOWN": "down_count",
+        "DIRT": "dirt_count",
+        "ROCK": "rock_count",
+        "UGA": "uguard_adapter",
+        "PFD1": "pfd_1",
+        "PFA2": "pfa_2",
+        "PC144": "passive_144",
+        "PC288": "passive_288",
+        "PC432": "passive_432",
+        "PC576": "passive_576",
+        "AC": "active_cabinet_count",
+    },
+    "RateCard_E": {
+        "ENG": "total_linear_footage",
+        "EPM": "e_epmrt_1",
+    },
+}
+
+
 def export_to_excel(template_path, output_path, values_dict, construction_vendor_rate, design_vendor_rate):
     """Exports calculated values and fiber slack sums to specific cells in an existing Excel template."""
 
@@ -148,12 +2472,7 @@ def export_to_excel(template_path, output_path, values_dict, construction_vendor
             return  # Exit function if the sheet is missing
 
         # ✅ **New Mapping for Engineering Sheet**
-        engineering_mapping = {
-            "total_fiber_footage_ug_linear": ["F9"],
-            "total_fiber_footage_ae_linear": ["F13"],
-            "total_linear_footage": ["F7", "F15"],
-            "e_epmrt_1": ["F19"]  # If it needs to be written to multiple places
-        }
+        engineering_mapping = ENGINEERING_CELLS
 
         # **Ensure the "Engineering" sheet exists and update values**
         if "Engineering" in wb.sheetnames:
@@ -172,91 +2491,7 @@ def export_to_excel(template_path, output_path, values_dict, construction_vendor
             arcpy.AddError("❌ 'Engineering' sheet not found in the Excel template.")
 
         # **Base mapping of fixed values to specific Excel cells**
-        cell_mapping = {
-            "total_ug1ft": ['D66', 'D67', 'D131'],
-            "total_ug2ft": ["D68"],
-            "total_1in_conduit": ["D126"],
-            "total_2in_conduit": ["D125"],
-            "total_4in_conduit": ["D127"],
-            "total_sp1": ["D93"],
-            "total_sp2": ["D94"],
-            "total_sp3_excluding_f1": ["D95"],
-            "fiber_12": ["D108"],
-            "fiber_24": ["D107"],
-            "fiber_48": ["D106"],
-            "fiber_96": ["D105"],
-            "fiber_144": ["D104"],
-            "fiber_288": ["D103"],
-            "fiber_432": ["D110"],
-            "total_heatshrink": ["D132"],
-            "fp_count": ["D79", "D123"],
-            "sv_count": ["D74", "D118"],
-            "mv_count": ["D75", "D119"],
-            "lv_count": ["D76", "D120"],
-            "xl_count": ["D77", "D121"],
-            "xsv_count": ["D73", "D117"],
-            "nid_count": ["D142"],
-            "axl_count": ["D122"],
-            "coyote_count": ["D133"],
-            "x17_count": ["D134"],
-            "x22_count": ["D135"],
-            "x28_count": ["D137"],
-            "x19_count": ["D136"],
-            "runt_count": ["D138"],
-            "total_closure_count": ["D89"],
-            "hanger_bracket": ["D140"],
-            "offset_bracket": ["D141"],
-            "lash_closure_count": ["D91"],
-            "drop_count": ["C25"],
-            "total_hhp_mdu": ["C24"],
-            "total_strand_ftg": ['D49', "D50", "D113", "D114"],
-            "est_total_miles": ['C28'],
-            "ae_bom_miles": ['C29'],
-            "ug_bom_miles": ['C30'],
-            "percent_ae": ['C31'],
-            "percent_ug": ['C32'],
-            "total_hhp": ['C26'],
-            "total_f1_miles": ["C35"],
-            "total_f2_miles": ["C38"],
-            "total_f2_ug": ["C40"],
-            "total_f2_ae": ["C39"],
-            "total_ae_ftg": ["C33"],
-            "total_ug_ftg": ["C34"],
-            "total_f1_ae": ["C36"],
-            "total_f1_ug": ["C37"],
-            "pfd_1": ['D71'],
-            "passive_144": ["D149"],
-            "passive_288": ["D150"],
-            "passive_432": ["D151"],
-            "passive_576": ["D152"],
-            "ug_closure_count": ["D147", "D148"],
-            "snowshoes": ["D92", "D113"],
-            "conduit_couplers_1in": ["D128"],
-            "conduit_couplers_2in": ["D129"],
-            "conduit_couplers_4in": ["D130"],
-            "pfa_2": ["D51"],
-            "total_risers": ["D58", "D112"],
-            "cab_id": ["F2"],
-            "serv_area": ["F3"],
-            "city_code": ["F4"],
-            "total_strand_ftg_reareasment_y": ["D52"],
-            "total_cabinets": ["C42"],
-            "count_over_600ft": ["C41"],
-            "average_calcfootage": ["C44"],
-            "total_pole_count": ["C27"],
-            "mr_filtered_pole_count": ["D59"],
-            "active_cabinet_count": ["C43", "D86", "D87", "D78", "D122"],
-            "grounded_poles": ["D57"],
-            "tree_trimming": ["D53"],
-            "total_ug1ft_reareasment_Y": ["D72"],
-            "down_count": ["D54"],
-            "dirt_count": ["D55"],
-            "rock_count": ["D56"],
-            "total_anchors": ["D144"],
-            "uguard_adapter": ["D111"],
-            "lashing_wire": ["D116"],
-            "special_crossing": ["D70"]
-        }
+        cell_mapping = SUMMARY_CELLS
 
         # Write values to all specified cells
         for key, cell_list in cell_mapping.items():
@@ -267,6 +2502,40 @@ def export_to_excel(template_path, output_path, values_dict, construction_vendor
             else:
                 arcpy.AddMessage(f"⚠ {key} not found in values_dict. Skipping.")
 
+        # Flag an incomplete BOM inside the workbook so failed stages are not read as zero quantities
+        if values_dict.get("failed_stages"):
+            status_sheet = wb.create_sheet("Run_Status", 0)
+            status_sheet["A1"] = "BOM INCOMPLETE - the following stages FAILED and their quantities are unknown:"
+            for row, (stage, error) in enumerate(values_dict["failed_stages"].items(), start=2):
+                status_sheet[f"A{row}"] = stage
+                status_sheet[f"B{row}"] = error
+            arcpy.AddWarning("⚠ Workbook includes a 'Run_Status' sheet listing the failed stages.")
+
+        # Side-by-side quantities when the BOM was calculated with the MDU exclusion
+        if values_dict.get("mdu_comparison"):
+            mdu_sheet = wb.create_sheet("MDU_Comparison")
+            mdu_sheet.append(["Quantity", "Including MDU Features", "Excluding MDU Features"])
+            for key, (with_mdu, without_mdu) in values_dict["mdu_comparison"].items():
+                mdu_sheet.append([key, with_mdu, without_mdu])
+
+        # The moment the layers were read at, and the layers that may not match it
+        if values_dict.get("snapshot"):
+            snapshot = values_dict["snapshot"]
+            snapshot_sheet = wb.create_sheet("Read_Snapshot")
+            snapshot_sheet.append(["Layers Read As Of (UTC)", snapshot["moment"]])
+            for label, key in (("Historic Moment", "historic_moment"), ("GDB Version", "gdb_version"),
+                               ("Read As Is, Checked For Edits", "local"),
+                               ("Not Checked (No Editor Tracking)", "unchecked"),
+                               ("EDITED WHILE READ", "edited_during_read")):
+                snapshot_sheet.append([label, ", ".join(snapshot[key])])
+
+        # Features whose stored footage does not match their geometry
+        if values_dict.get("stale_lengths"):
+            length_sheet = wb.create_sheet("Stale_Lengths")
+            length_sheet.append(["Layer", "OBJECTID", "Stored FT", "Geometry FT"])
+            for (layer_label, object_id), (stored, geodesic) in values_dict["stale_lengths"].items():
+                length_sheet.append([layer_label, object_id, stored, geodesic])
+
         if "RateCard" in wb.sheetnames:
             wb["RateCard"].sheet_state = "hidden"  # ✅ Hide the sheet
             # arcpy.AddMessage("👀 'RateCard' sheet hidden.")
@@ -284,41 +2553,254 @@ def export_to_excel(template_path, output_path, values_dict, construction_vendor
         arcpy.AddError(f"❌ Error exporting to Excel: {e}")
 
 
+class CostError(Exception):
+    """A rate card the BOM cannot be priced from: a missing sheet, vendor list or vendor, line items that do not
+    match RATE_CARD_LINES, or totals that do not match the template's own."""
+
+
+def rate_value(value):
+    """A rate card cell as a number, NaN when it holds no numeric rate."""
+    if isinstance(value, bool) or value is None:
+        return np.nan
+    try:
+        return float(str(value).replace("$", "").replace(",", "")) if isinstance(value, str) else float(value)
+    except ValueError:
+        return np.nan
+
+
+def item_key(item):
+    """A line item name compared without case or surrounding spaces."""
+    return str(item).strip().upper() if item is not None else ""
+
+
+class RateCards:
+    """The BOM Template's RateCard / RateCard_E tables, read once as vendor x line item rate matrices.
+
+    The vendors of a rate card are the choices of its vendor cell (VENDOR_CELL), each the header of a rate column
+    in RATE_CARD_HEADER_ROW. Every RATE_CARD_LINES line item costs its vendor rate times its BOM quantity. A line
+    without a numeric rate for a vendor is left unpriced and reported, it is never counted as zero. The template is
+    refused when its rate cards and RATE_CARD_LINES list different line items, or when pricing the quantities the
+    template was last calculated with does not give its own totals (RATE_CARD_TOTAL_CELLS).
+    """
+
+    def __init__(self, template_path):
+        workbook = openpyxl.load_workbook(template_path, data_only=True)  # Rates kept as Excel last calculated them
+        self.vendors, self.rates = {}, {}
+        item_column = column_index_from_string(RATE_CARD_ITEM_COLUMN)
+        for rate_sheet in RATE_CARD_SHEETS:
+            if rate_sheet not in workbook.sheetnames:
+                raise CostError(f"'{rate_sheet}' sheet not found in the template")
+            sheet = workbook[rate_sheet]
+            vendors = self.vendor_choices(workbook, sheet)
+            header = {item_key(cell.value): cell.column for cell in sheet[RATE_CARD_HEADER_ROW]}
+            absent = [vendor for vendor in vendors if item_key(vendor) not in header]
+            if not vendors or absent:
+                raise CostError(f"'{rate_sheet}'!{VENDOR_CELL} offers no vendors" if not vendors else
+                                f"{', '.join(absent)} not found in row {RATE_CARD_HEADER_ROW} of '{rate_sheet}'")
+
+            rows = {}
+            for row in sheet.iter_rows(min_row=RATE_CARD_HEADER_ROW + 1, values_only=True):
+                item = row[item_column - 1] if len(row) >= item_column else None
+                if item_key(item) and item_key(item) not in rows:
+                    rows[item_key(item)] = [rate_value(row[header[item_key(vendor)] - 1])
+                                            if len(row) >= header[item_key(vendor)] else np.nan for vendor in vendors]
+
+            items = list(RATE_CARD_LINES.get(rate_sheet, {}))
+            missing = [item for item in items if item_key(item) not in rows]
+            unlisted = sorted(item for item, rates in rows.items()
+                              if not np.isnan(rates).all() and item not in map(item_key, items))
+            if missing or unlisted:
+                raise CostError(f"RATE_CARD_LINES does not match the '{rate_sheet}' rate card: " + "; ".join(
+                    filter(None, [missing and f"{', '.join(missing)} not on the rate card",
+                                  unlisted and f"{', '.join(unlisted)} priced on the rate card but not listed"])))
+            self.vendors[rate_sheet] = vendors
+            self.rates[rate_sheet] = np.array([rows[item_key(item)] for item in items],
+                                              dtype=float).reshape(len(items), len(vendors))
+        self.check_template_totals(workbook)
+
+    @staticmethod
+    def vendor_choices(workbook, sheet):
+        """The vendors offered in a rate card's vendor cell: a data validation list, or the cells it references."""
+        for validation in sheet.data_validations.dataValidation:
+            if VENDOR_CELL not in validation.sqref or not validation.formula1:
+                continue
+            choices = validation.formula1.lstrip("=")
+            if choices.startswith('"'):
+                return [choice.strip() for choice in choices.strip('"').split(",") if choice.strip()]
+            source, _, reference = choices.rpartition("!")
+            source = workbook[source.strip("'").replace("''", "'")] if source else sheet
+            min_column, min_row, max_column, max_row = range_boundaries(reference.replace("$", ""))
+            return [str(value).strip() for row in source.iter_rows(min_row, max_row, min_column, max_column,
+                                                                   values_only=True)
+                    for value in row if value not in (None, "")]
+        return []
+
+    def check_template_totals(self, workbook):
+        """Prices the quantities the template was last calculated with for its selected vendors and compares the
+        totals with the template's own (RATE_CARD_TOTAL_CELLS), so the costs follow the template's formulas."""
+        quantities = {}
+        for sheet_name, mapping in (("Summary", SUMMARY_CELLS), ("Engineering", ENGINEERING_CELLS)):
+            if sheet_name not in workbook.sheetnames:
+                raise CostError(f"'{sheet_name}' sheet not found in the template")
+            for key, cell_list in mapping.items():
+                quantities[key] = workbook[sheet_name][cell_list[0]].value or 0  # Blank cells count as 0 in Excel
+
+        selected = {rate_sheet: [workbook[rate_sheet][VENDOR_CELL].value] for rate_sheet in RATE_CARD_LINES}
+        for rate_sheet, cost in self.price([quantities], selected).items():
+            reference = RATE_CARD_TOTAL_CELLS.get(rate_sheet)
+            if not reference:
+                raise CostError(f"RATE_CARD_TOTAL_CELLS names no cell of the template's '{rate_sheet}' total, the "
+                                f"costs cannot be checked against the template")
+            sheet_name, _, cell = reference.rpartition("!")
+            sheet_name = sheet_name.strip("'")
+            if sheet_name not in workbook.sheetnames:
+                raise CostError(f"'{sheet_name}' sheet of {reference} not found in the template")
+            total = rate_value(workbook[sheet_name][cell].value)
+            if np.isnan(total):
+                raise CostError(f"{reference} holds no total, open and save the template in Excel to calculate it")
+            priced = cost["totals"][0, 0]
+            if cost["unpriced"].any() or not np.isclose(priced, total, rtol=0, atol=0.01):
+                raise CostError(f"'{rate_sheet}' prices the template's quantities at ${priced:,.2f} but {reference} "
+                                f"totals ${total:,.2f}, RATE_CARD_LINES does not match the template's formulas")
+
+    def price(self, rows, vendors=None):
+        """Prices rows of BOM values (one dict per FDH) for every vendor of every rate card.
+
+        Returns {rate card: {"vendors": [...], "items": [...], "lines": array (items, vendors, FDHs), "totals":
+        array (vendors, FDHs) of the priced lines, "unpriced": bool array (items, vendors, FDHs)}}. A line is
+        unpriced (NaN in "lines") when its quantity is not zero and its rate or quantity is missing. vendors
+        ({rate card: vendor names}) defaults to every vendor on the rate card.
+        """
+        costs = {}
+        for rate_sheet, lines in RATE_CARD_LINES.items():
+            sheet_vendors = (vendors or {}).get(rate_sheet) or self.vendors[rate_sheet]
+            offered = [item_key(vendor) for vendor in self.vendors[rate_sheet]]
+            absent = [vendor for vendor in sheet_vendors if item_key(vendor) not in offered]
+            if absent:
+                raise CostError(f"{', '.join(map(str, absent))} not on the '{rate_sheet}' rate card")
+
+            rates = self.rates[rate_sheet][:, [offered.index(item_key(vendor)) for vendor in sheet_vendors]]
+            quantities = np.array([[rate_value(row.get(quantity)) for row in rows] for quantity in lines.values()],
+                                  dtype=float).reshape(len(lines), len(rows))
+            with np.errstate(invalid="ignore"):
+                amounts = np.where(quantities[:, None, :] == 0, 0.0, rates[:, :, None] * quantities[:, None, :])
+            unpriced = np.isnan(amounts)
+            costs[rate_sheet] = {"vendors": sheet_vendors, "items": list(lines), "lines": amounts,
+                                 "totals": np.where(unpriced, 0.0, amounts).sum(axis=0), "unpriced": unpriced}
+        return costs
+
+    def unpriced_lines(self, rate_sheet, cost, vendor_index, fdh_index=0):
+        """'item (reason)' for every line of one vendor and FDH that could not be priced."""
+        reasons = []
+        for item_index, item in enumerate(cost["items"]):
+            if not cost["unpriced"][item_index, vendor_index, fdh_index]:
+                continue
+            if np.isnan(self.rates[rate_sheet][item_index, [item_key(vendor) for vendor in self.vendors[rate_sheet]]
+                                                 .index(item_key(cost["vendors"][vendor_index]))]):
+                reasons.append(f"{item} (no {cost['vendors'][vendor_index]} rate)")
+            else:
+                reasons.append(f"{item} (no {RATE_CARD_LINES[rate_sheet][item]} quantity)")
+        return reasons
+
+
+def cost_model(template_path):
+    """The template's rate cards, read once per template."""
+    if template_path not in cost_models:
+        cost_models[template_path] = RateCards(template_path)
+    return cost_models[template_path]
+
+
+def report_fdh_costs(template_path, values_dict, construction_vendor_rate, design_vendor_rate):
+    """Prints the construction and design cost of one FDH for the selected vendors."""
+    try:
+        model = cost_model(template_path)
+        costs = model.price([values_dict], {"RateCard": [construction_vendor_rate],
+                                            "RateCard_E": [design_vendor_rate]})
+        arcpy.AddMessage(f"*** Estimated Cost of {values_dict.get('cab_id')}: ***\n" + "\n".join(
+            f"► {RATE_CARD_SHEETS[rate_sheet]} ({cost['vendors'][0]}): ${cost['totals'][0, 0]:,.2f}" +
+            (" (INCOMPLETE)" if cost["unpriced"][:, 0, 0].any() else "")
+            for rate_sheet, cost in costs.items()) + "\n")
+        for rate_sheet, cost in costs.items():
+            unpriced = model.unpriced_lines(rate_sheet, cost, 0)
+            if unpriced:
+                arcpy.AddWarning(f"⚠ {RATE_CARD_SHEETS[rate_sheet]} cost leaves out {len(unpriced)} lines that "
+                                 f"could not be priced: {', '.join(unpriced)}")
+    except Exception as e:
+        arcpy.AddWarning(f"⚠ Could not price the BOM from the template's rate cards: {e}")
+
+
+def run_cost_report(template_path):
+    """Prices every FDH cached in the local database for every vendor of both rate cards and saves the matrices."""
+    graphs = cached_graph_values()
+    if not graphs:
+        arcpy.AddError("❌ No FDHs are cached in the local database yet, run with INCREMENTAL_REFRESH first.")
+        return None
+
+    try:
+        model = cost_model(template_path)
+        start = time.perf_counter()
+        costs = model.price([{**values, "cab_id": cab_id} for cab_id, values in graphs.items()])
+    except Exception as e:
+        arcpy.AddError(f"❌ Could not price the cached FDHs from the template's rate cards: {e}")
+        return None
+    arcpy.AddMessage(f"*** {len(graphs)} FDHs priced in {time.perf_counter() - start:.2f}s ***\n")
+
+    output_path = os.path.join(os.path.dirname(LOCAL_DB),
+                               f"BOM_Costs_{datetime.now().strftime('%m-%d-%Y_%H%M%S')}.csv")
+    with open(output_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["Cost", "Vendor", "cab_id", "Line", "Quantity", "Amount"])
+        for rate_sheet, cost in costs.items():
+            lines = RATE_CARD_LINES[rate_sheet]
+            for i, vendor in enumerate(cost["vendors"]):
+                for j, cab_id in enumerate(graphs):
+                    writer.writerows([RATE_CARD_SHEETS[rate_sheet], vendor, cab_id, item, lines[item],
+                                      "UNPRICED" if cost["unpriced"][k, i, j] else round(cost["lines"][k, i, j], 2)]
+                                     for k, item in enumerate(cost["items"])
+                                     if cost["unpriced"][k, i, j] or cost["lines"][k, i, j])
+                    writer.writerow([RATE_CARD_SHEETS[rate_sheet], vendor, cab_id,
+                                     "Total (INCOMPLETE)" if cost["unpriced"][:, i, j].any() else "Total", "",
+                                     round(cost["totals"][i, j], 2)])
+                incomplete = int(cost["unpriced"][:, i, :].any(axis=0).sum())
+                arcpy.AddMessage(f"► {RATE_CARD_SHEETS[rate_sheet]} - {vendor}: "
+                                 f"${cost['totals'][i].sum():,.2f} over {len(graphs)} FDHs")
+                if incomplete:
+                    unpriced = sorted({line for j in range(len(graphs))
+                                       for line in model.unpriced_lines(rate_sheet, cost, i, j)})
+                    arcpy.AddWarning(f"⚠ {incomplete} {vendor} totals leave out lines that could not be priced: "
+                                     f"{', '.join(unpriced)}")
+    arcpy.AddMessage(f"✅ Vendor costs saved: {output_path}")
+    return costs
+
+
 def count_addresses(fdh_geometry):
     try:
         # Query Address Points within FDH Boundary
-        address_layer_item = gis.content.get(address_master_id)
-        if not address_layer_item:
+        address_layer = get_portal_layer(address_master_id, "Addresses")
+        if address_layer is None:
             arcpy.AddError("❌ Address Master layer not found in Portal.")
-            return 0, 0, 0, 0, 0, 0
+            return 0, 0, 0, 0, 0
 
-        address_layer = address_layer_item.layers[0]  # Assuming first layer is correct
-        address_query = address_layer.query(
-            geometry_filter=filters.contains(fdh_geometry),
-            out_fields="*",
-            return_geometry=True
-        )
+        address_query = query_layer(
+            address_master_id, "Addresses", **stage_query("Addresses", address_master_id, fdh_geometry))
 
         total_addresses = len(address_query.features)
 
         # Query MDU Polygon within FDH Boundary
-        mdu_layer_item = gis.content.get(mdu_boundary_id)
-        if not mdu_layer_item:
+        mdu_layer = get_portal_layer(mdu_boundary_id, "Addresses")
+        if mdu_layer is None:
             arcpy.AddError("❌ MDU Boundary layer not found in Portal.")
-            return total_addresses, 0, 0, 0, 0, 0, 0
+            return total_addresses, 0, 0, 0, 0
 
-        mdu_layer = mdu_layer_item.layers[0]
-        mdu_query = mdu_layer.query(
-            geometry_filter=filters.contains(fdh_geometry),
-            out_fields="*",
-            return_geometry=True
-        )
+        # The MDU polygons are fetched once per FDH and shared with the MDU exclusion
+        mdu_features = FeatureIndex(load_mdu_boundaries(fdh_geometry, "Addresses")).contains(
+            join_geometry(fdh_geometry))
 
-        mdu_boundary_count = len(mdu_query.features)
+        mdu_boundary_count = len(mdu_features)
 
         # Sum hhp_count values for MDU polygons within FDH boundary
         total_hhp_mdu = 0
-        for mdu_feature in mdu_query.features:
+        for mdu_feature in mdu_features:
             hhp_value_raw = mdu_feature.attributes.get('hhp_count', '0')
             try:
                 hhp_value = int(hhp_value_raw)
@@ -327,30 +2809,22 @@ def count_addresses(fdh_geometry):
             total_hhp_mdu += hhp_value
 
         # Query Do Not Build Polygon within FDH Boundary
-        dnb_layer_item = gis.content.get(do_not_build_id)
-        if not dnb_layer_item:
+        dnb_layer = get_portal_layer(do_not_build_id, "Addresses")
+        if dnb_layer is None:
             arcpy.AddError("❌ Do Not Build Boundary layer not found in Portal.")
-            return total_addresses, total_hhp_mdu, 0
+            return total_addresses, total_hhp_mdu, 0, mdu_boundary_count, 0
 
-        dnb_layer = dnb_layer_item.layers[0]
-        dnb_query = dnb_layer.query(
-            geometry_filter=filters.contains(fdh_geometry),
-            out_fields="*",
-            return_geometry=True
-        )
+        dnb_query = query_layer(
+            do_not_build_id, "Addresses", **stage_query("Addresses", do_not_build_id, fdh_geometry))
 
         dnb_boundary_count = len(dnb_query.features)
 
-        # Count address points in each Do Not Build polygon
-        total_dnb_addresses = 0
-        for dnb_feature in dnb_query.features:
-            dnb_geometry = dnb_feature.geometry
-            address_query_dnb = address_layer.query(
-                geometry_filter=filters.contains(dnb_geometry),
-                out_fields="*",
-                return_geometry=True
-            )
-            total_dnb_addresses += len(address_query_dnb.features)
+        # Count address points in each Do Not Build polygon. The DNB polygons lie inside the FDH, so the
+        # addresses already fetched for the FDH are joined to them locally.
+        address_index = FeatureIndex(address_query.features)
+        total_dnb_addresses = sum(
+            len(addresses) for addresses in address_index.bulk_query(
+                [dnb_feature.geometry for dnb_feature in dnb_query.features], "contains"))
 
         # arcpy.AddMessage(f"🚫 Total Do Not Build Polygons: {dnb_boundary_count}")
         # arcpy.AddMessage(f"🚫 Total Addresses in Do Not Build Polygons: {total_dnb_addresses}")
@@ -359,7 +2833,30 @@ def count_addresses(fdh_geometry):
 
     except Exception as e:
         arcpy.AddError(f"❌ Error processing address counts: {e}")
-        return 0, 0, 0, 0, 0, 0  # Ensure function always returns three values
+        mark_stage_failed("Addresses", e)
+        return 0, 0, 0, 0, 0  # Ensure function always returns five values
+
+
+def batch_fdh_features(fdh_boundary_id, cab_ids):
+    """The FDH boundary features of several cab_ids, from the local index first and one Portal query for the rest."""
+    # FDHs found in the local index need no Portal request
+    features = []
+    if USE_FDH_INDEX:
+        indexed = [fdh_index_feature(cid) for cid in cab_ids]
+        features = [feature for feature in indexed if feature is not None]
+        cab_ids = [cid for cid, feature in zip(cab_ids, indexed) if feature is None]
+
+    # Query portal layer for all selected cab_ids
+    if cab_ids:
+        cab_ids_sql = f"cab_id IN ({','.join(repr(cid) for cid in cab_ids)})"
+        query_result = query_layer(
+            fdh_boundary_id, "FDH Selection",
+            where=cab_ids_sql,
+            out_fields="*",
+            return_geometry=True
+        )
+        features.extend(query_result.features)
+    return features
 
 
 def fdh_boundary_selection_multiple(fdh_boundary_id):
@@ -384,13 +2881,11 @@ def fdh_boundary_selection_multiple(fdh_boundary_id):
         arcpy.AddMessage(f"🔍 Found {selected_count} selected FDH_Boundary features.")
 
         # Retrieve full layer from Portal
-        fdh_item = gis.content.get(fdh_boundary_id)
-        if not fdh_item:
+        portal_layer = get_portal_layer(fdh_boundary_id, "FDH Selection")
+        if portal_layer is None:
             arcpy.AddError("❌ FDH_Boundary layer not found in Portal.")
             return []
 
-        portal_layer = fdh_item.layers[0]
-
         # Get list of selected cab_ids from local selection
         cab_ids = []
         with arcpy.da.SearchCursor(fdh_layer, ["cab_id"]) as cursor:
@@ -399,20 +2894,14 @@ def fdh_boundary_selection_multiple(fdh_boundary_id):
 
         arcpy.AddMessage(f"📋 Selected cab_ids: {cab_ids}")
 
-        # Query portal layer for all selected cab_ids
-        cab_ids_sql = f"cab_id IN ({','.join(repr(cid) for cid in cab_ids)})"
-        query_result = portal_layer.query(
-            where=cab_ids_sql,
-            out_fields="*",
-            return_geometry=True
-        )
+        features = batch_fdh_features(fdh_boundary_id, cab_ids)
 
-        if not query_result.features:
+        if not features:
             arcpy.AddError("❌ No matching features found in portal layer.")
             return []
 
         selected_data = []
-        for feature in query_result.features:
+        for feature in features:
             selected_data.append({
                 "object_id": feature.attributes.get("OBJECTID"),
                 "geometry": feature.geometry,
@@ -420,7 +2909,8 @@ def fdh_boundary_selection_multiple(fdh_boundary_id):
                 "serv_area": feature.attributes.get("Serv_Area"),
                 "city_code": feature.attributes.get("City_Code"),
                 "hhp_count": feature.attributes.get("hhp_count"),
-                "db_status": feature.attributes.get("DB_Status")
+                "db_status": feature.attributes.get("DB_Status"),
+                "const_ven": feature.attributes.get("Const_Ven")
             })
 
         return selected_data
@@ -476,17 +2966,34 @@ def fdh_boundary_selection(fdh_boundary_id):
             arcpy.AddError("❌ No FDH name entered. Please enter a valid cab_id.")
             return None, None, None, None, None, None
 
+        return find_fdh(fdh_boundary_id, cab_id)
+
+    except Exception as e:
+        arcpy.AddError(f"❌ Error retrieving FDH boundary: {e}")
+        return None, None, None, None, None, None
+
+
+def find_fdh(fdh_boundary_id, cab_id):
+    """OBJECTID, geometry, cab_id, Serv_Area, City_Code and Const_Ven of the FDH boundary with a cab_id."""
+    try:
+        # Look the FDH up in the local index first, no Portal request needed
+        indexed = fdh_index_feature(cab_id) if USE_FDH_INDEX else None
+        if indexed is not None:
+            attributes = indexed.attributes
+            return (attributes.get("OBJECTID", "Unknown"), indexed.geometry, attributes.get("cab_id", cab_id),
+                    attributes.get("Serv_Area", "Unknown"), attributes.get("City_Code", "Unknown"),
+                    attributes.get("Const_Ven", "Unknown"))
+
         # Retrieve the FDH_Boundary layer from portal
-        fdh_item = gis.content.get(fdh_boundary_id)
-        if not fdh_item:
+        fdh_layer = get_portal_layer(fdh_boundary_id, "FDH Selection")
+        if fdh_layer is None:
             arcpy.AddError("FDH_Boundary layer not found in Portal.")
             return None, None, None, None, None, None
-
-        fdh_layer = fdh_item.layers[0]  # Assuming first layer is correct
         # arcpy.AddMessage(f"Found FDH_Boundary layer: {fdh_layer.url}")
 
         # Query the layer for the specified cab_id
-        query_result = fdh_layer.query(
+        query_result = query_layer(
+            fdh_boundary_id, "FDH Selection",
             where=f"cab_id = '{cab_id}'",
             out_fields="OBJECTID, cab_id, Serv_Area, City_Code, Const_Ven",
             return_geometry=True
@@ -518,14 +3025,12 @@ def fdh_boundary_selection(fdh_boundary_id):
 
 def query_conduit_from_portal(conduit_id, fdh_geometry):
     """Queries a Portal feature layer using its ID, retrieving only features within the selected FDH boundary."""
+    cab_id = bom_context().cab_id
     try:
         # Retrieve the layer from ArcGIS Portal
-        conduit_layer_item = gis.content.get(conduit_id)
-        if not conduit_layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{conduit_id}' not found in ArcGIS Portal.")
+        portal_layer = get_portal_layer(conduit_id, "Conduit")
+        if portal_layer is None:
             return 0, 0, 0, 0, 0, 0
-
-        portal_layer = conduit_layer_item.layers[0]  # Assuming the correct layer
         # arcpy.AddMessage(f"✅ Found layer in Portal: {portal_layer.url}")
 
         # ✅ Ensure geometry is in Esri JSON format
@@ -538,17 +3043,12 @@ def query_conduit_from_portal(conduit_id, fdh_geometry):
             return 0, 0, 0, 0, 0, 0
 
         # ✅ Ensure spatial reference matches the Portal layer
-        spatial_ref = {"wkid": 4326}  # Default to WGS 1984 (Lat/Lon)
+        spatial_ref = {"wkid": JOIN_SR}  # The FDH boundary is fetched in JOIN_SR
         if "spatialReference" not in fdh_geometry:
             fdh_geometry["spatialReference"] = spatial_ref
 
-        query_result = portal_layer.query(
-            geometry_filter=arcgis.geometry.filters.intersects(fdh_geometry),  # Use selected boundary
-            geometry_type="esriGeometryPolygon",
-            spatial_rel="esriSpatialRelContains",  # Ensures only features within the polygon are selected
-            out_fields="UG1FT, LaborFootage, BOMCalc, reareasment, Cond_Diam",
-            return_geometry=True
-        )
+        # When clipping, conduit crossing the FDH edge is fetched too and only its share inside the FDH is counted
+        query_result = query_layer(conduit_id, "Conduit", **stage_query("Conduit", conduit_id, fdh_geometry))
 
         if not query_result.features:
             arcpy.AddMessage(f"⚠ No features found in {portal_layer.properties.name} within the selected boundary.")
@@ -556,6 +3056,10 @@ def query_conduit_from_portal(conduit_id, fdh_geometry):
 
         # arcpy.AddMessage(f"✅ Retrieved {len(query_result.features)} features from {portal_layer.properties.name}")
 
+        # Share of each conduit's geodesic length inside the FDH (1.0 for every feature when not clipping)
+        factors = clip_factors(query_result.features, fdh_geometry) if CLIP_TO_FDH else \
+            np.ones(len(query_result.features))
+
         # Initialize the values for ug1, ug2, total_conduit, and special crossing
         total_ug1ft = 0
         total_ug2ft = 0
@@ -564,12 +3068,12 @@ def query_conduit_from_portal(conduit_id, fdh_geometry):
         total_4in_conduit = 0
         total_ug1ft_reareasment_Y = 0
 
-        for feature in query_result.features:
+        for feature, factor in zip(query_result.features, factors):
             properties = feature.attributes  # Extract feature attributes
 
-            ug1ft = properties.get("UG1FT", 0) or 0
-            laborfootage = properties.get("LaborFootage", 0) or 0
-            bomcalc = properties.get("BOMCalc", 0) or 0
+            ug1ft = (properties.get("UG1FT", 0) or 0) * factor
+            laborfootage = (properties.get("LaborFootage", 0) or 0) * factor
+            bomcalc = (properties.get("BOMCalc", 0) or 0) * factor
             reareasment = str(properties.get("reareasment", "")).strip().upper()
             cond_diam = str(properties.get("Cond_Diam", "")).strip()
 
@@ -601,6 +3105,10 @@ def query_conduit_from_portal(conduit_id, fdh_geometry):
                          f'► Total Special Crossing Footage: {total_4in_conduit:.2f} feet\n'
                          f'\n')
 
+        if CLIP_TO_FDH:
+            crossing = int(((factors > 0) & (factors < 1)).sum())
+            arcpy.AddMessage(f"✂ Clipped {crossing} conduit features crossing the {cab_id} boundary.\n")
+
         return (total_ug1ft,
                 total_ug2ft,
                 total_1in_conduit,
@@ -610,18 +3118,17 @@ def query_conduit_from_portal(conduit_id, fdh_geometry):
 
     except Exception as e:
         arcpy.AddError(f"Error: {e}")
+        mark_stage_failed("Conduit", e)
         return 0, 0, 0, 0, 0, 0
 
 
 def query_structures_from_portal(structures_id, fdh_geometry):
+    cab_id = bom_context().cab_id
     try:
         # Retrieve the layer from ArcGIS Portal
-        layer_item = gis.content.get(structures_id)
-        if not layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{structures_id}' not found in ArcGIS Portal.")
-            return 0, 0, 0, 0, 0, 0, 0
-
-        portal_layer = layer_item.layers[0]  # Assuming the correct layer
+        portal_layer = get_portal_layer(structures_id, "Structures")
+        if portal_layer is None:
+            return 0, 0, 0, 0, 0, 0, 0, 0
         # arcpy.AddMessage(f"✅ Found layer in Portal: {portal_layer.url}")
 
         # ✅ Ensure geometry is in Esri JSON format
@@ -631,23 +3138,19 @@ def query_structures_from_portal(structures_id, fdh_geometry):
             geometry_json = fdh_geometry.JSON  # Convert ArcPy Geometry to JSON
         else:
             arcpy.AddError("❌ Invalid geometry format.")
-            return 0, 0, 0, 0, 0, 0, 0
+            return 0, 0, 0, 0, 0, 0, 0, 0
 
         # ✅ Ensure spatial reference matches the Portal layer
-        spatial_ref = {"wkid": 4326}  # Default to WGS 1984 (Lat/Lon)
+        spatial_ref = {"wkid": JOIN_SR}  # The FDH boundary is fetched in JOIN_SR
         if "spatialReference" not in fdh_geometry:
             fdh_geometry["spatialReference"] = spatial_ref
 
-        query_extent = fdh_geometry
-        query_filter = arcgis.geometry.filters.contains(query_extent, sr=102100)
-
-        query_result = portal_layer.query(
-            geometry_filter=query_filter,
-            out_fields="structuretype", as_df=False)
+        query_result = query_layer(
+            structures_id, "Structures", **stage_query("Structures", structures_id, fdh_geometry), as_df=False)
 
         if not query_result.features:
             arcpy.AddMessage(f"⚠ No features found in {portal_layer.properties.name} within the selected boundary.")
-            return 0, 0, 0, 0, 0, 0, 0
+            return 0, 0, 0, 0, 0, 0, 0, 0
 
         # arcpy.AddMessage(f"✅ Retrieved {len(query_result.features)} features from {portal_layer.properties.name}")
 
@@ -695,18 +3198,17 @@ def query_structures_from_portal(structures_id, fdh_geometry):
 
     except Exception as e:
         arcpy.AddError(f"❌ Error: {e}")
-    return 0, 0, 0, 0, 0, 0, 0  # Ensure function always returns all values
+        mark_stage_failed("Structures", e)
+    return 0, 0, 0, 0, 0, 0, 0, 0  # Ensure function always returns all values
 
 
 def query_splice_sizes_from_portal(splice_enclosure_id, fdh_geometry):
+    cab_id = bom_context().cab_id
     try:
         # Retrieve the layer from ArcGIS Portal
-        layer_item = gis.content.get(splice_enclosure_id)
-        if not layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{splice_enclosure_id}' not found in ArcGIS Portal.")
+        portal_layer = get_portal_layer(splice_enclosure_id, "Splice Enclosures")
+        if portal_layer is None:
             return 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
-
-        portal_layer = layer_item.layers[0]  # Assuming the correct layer
         # arcpy.AddMessage(f"✅ Found layer in Portal: {portal_layer.url}")
 
         # ✅ Ensure geometry is in Esri JSON format
@@ -719,19 +3221,15 @@ def query_splice_sizes_from_portal(splice_enclosure_id, fdh_geometry):
             return 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
 
         # ✅ Ensure spatial reference matches the Portal layer
-        spatial_ref = {"wkid": 4326}  # Default to WGS 1984 (Lat/Lon)
+        spatial_ref = {"wkid": JOIN_SR}  # The FDH boundary is fetched in JOIN_SR
         if "spatialReference" not in fdh_geometry:
             fdh_geometry["spatialReference"] = spatial_ref
 
         # 🔹 Debugging messages
         # arcpy.AddMessage(f"🔍 Using Spatial Query with Geometry: {geometry_json}")
 
-        query_extent = fdh_geometry
-        query_filter = arcgis.geometry.filters.contains(query_extent, sr=102100)
-
-        query_result = portal_layer.query(
-            geometry_filter=query_filter,
-            out_fields="splicesize, placementtype", as_df=False)
+        query_result = query_layer(splice_enclosure_id, "Splice Enclosures",
+                                   **stage_query("Splice Enclosures", splice_enclosure_id, fdh_geometry), as_df=False)
 
         if not query_result.features:
             arcpy.AddMessage(f"⚠ No features found in {portal_layer.properties.name} within the selected boundary.")
@@ -803,18 +3301,17 @@ def query_splice_sizes_from_portal(splice_enclosure_id, fdh_geometry):
 
     except Exception as e:
         arcpy.AddError(f"❌ Error: {e}")
+        mark_stage_failed("Splice Enclosures", e)
         return 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
 
 
 def query_cables_from_portal(cable_id, fdh_geometry):
+    cab_id = bom_context().cab_id
     try:
         # Retrieve the layer from ArcGIS Portal
-        layer_item = gis.content.get(cable_id)
-        if not layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{cable_id}' not found in ArcGIS Portal.")
+        portal_layer = get_portal_layer(cable_id, "Cables")
+        if portal_layer is None:
             return (0,) * 26
-
-        portal_layer = layer_item.layers[0]  # Assuming the correct layer
         # arcpy.AddMessage(f"✅ Found layer in Portal: {portal_layer.url}")
 
         # ✅ Ensure geometry is in Esri JSON format
@@ -827,17 +3324,11 @@ def query_cables_from_portal(cable_id, fdh_geometry):
             return (0,) * 26
 
         # ✅ Ensure spatial reference matches the Portal layer
-        spatial_ref = {"wkid": 4326}  # Default to WGS 1984 (Lat/Lon)
+        spatial_ref = {"wkid": JOIN_SR}  # The FDH boundary is fetched in JOIN_SR
         if "spatialReference" not in fdh_geometry:
             fdh_geometry["spatialReference"] = spatial_ref
 
-        query_extent = fdh_geometry
-        query_filter = arcgis.geometry.filters.contains(query_extent, sr=102100)
-
-        query_result = portal_layer.query(
-            geometry_filter=query_filter,
-            out_fields="cable_name, placementtype, fibercount, hierarchy, LengthFT, SpliceSlack, "
-                       "SP1, SP2, SP3", as_df=False)
+        query_result = query_layer(cable_id, "Cables", **stage_query("Cables", cable_id, fdh_geometry), as_df=False)
 
         if not query_result.features:
             arcpy.AddMessage(f"⚠ No features found in {portal_layer.properties.name} within the selected boundary.")
@@ -973,18 +3464,17 @@ def query_cables_from_portal(cable_id, fdh_geometry):
 
     except Exception as e:
         arcpy.AddError(f"❌ Error: {e}")
+        mark_stage_failed("Cables", e)
         return (0,) * 26
 
 
 def query_slackloops_from_portal(slackloop_id, fdh_geometry):
+    cab_id = bom_context().cab_id
     try:
         # Retrieve the layer from ArcGIS Portal
-        layer_item = gis.content.get(slackloop_id)
-        if not layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{slackloop_id}' not found in ArcGIS Portal.")
+        portal_layer = get_portal_layer(slackloop_id, "Slackloops")
+        if portal_layer is None:
             return {}, 0, 0
-
-        portal_layer = layer_item.layers[0]  # Assuming the correct layer
         # arcpy.AddMessage(f"✅ Found layer in Portal: {portal_layer.url}")
 
         # ✅ Ensure geometry is in Esri JSON format
@@ -997,16 +3487,12 @@ def query_slackloops_from_portal(slackloop_id, fdh_geometry):
             return {}, 0, 0
 
         # ✅ Ensure spatial reference matches the Portal layer
-        spatial_ref = {"wkid": 4326}  # Default to WGS 1984 (Lat/Lon)
+        spatial_ref = {"wkid": JOIN_SR}  # The FDH boundary is fetched in JOIN_SR
         if "spatialReference" not in fdh_geometry:
             fdh_geometry["spatialReference"] = spatial_ref
 
-        query_extent = fdh_geometry
-        query_filter = arcgis.geometry.filters.contains(query_extent, sr=102100)
-
-        query_result = portal_layer.query(
-            geometry_filter=query_filter,
-            out_fields="cable_capacity, placement, loop_length, type", as_df=False)
+        query_result = query_layer(
+            slackloop_id, "Slackloops", **stage_query("Slackloops", slackloop_id, fdh_geometry), as_df=False)
 
         if not query_result.features:
             arcpy.AddMessage(f"⚠ No features found in {portal_layer.properties.name} within the selected boundary.\n")
@@ -1058,33 +3544,20 @@ def query_slackloops_from_portal(slackloop_id, fdh_geometry):
 
     except Exception as e:
         arcpy.AddError(f"❌ Error processing Slackloop features: {e}")
+        mark_stage_failed("Slackloops", e)
         return {}, 0, 0  # Ensure function always returns expected values
 
 
 def query_strand_and_poles_from_portal(strand_id, poles_id, conduit_id, fdh_geometry):
+    cab_id = bom_context().cab_id
     try:
-        # Retrieve the strand layer from ArcGIS Portal
-        strand_layer_item = gis.content.get(strand_id)
-        if not strand_layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{strand_id}' not found in ArcGIS Portal.")
-            return 0, 0, 0, 0, 0
-
-        # Retrieve the pole layer from ArcGIS Portal
-        pole_layer_item = gis.content.get(poles_id)
-        if not pole_layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{poles_id}' not found in ArcGIS Portal.")
+        # Retrieve the strand, pole and conduit layers from ArcGIS Portal
+        portal_strand_layer = get_portal_layer(strand_id, "Strand and Poles")
+        portal_pole_layer = get_portal_layer(poles_id, "Strand and Poles")
+        portal_conduit_layer = get_portal_layer(conduit_id, "Strand and Poles")
+        if portal_strand_layer is None or portal_pole_layer is None or portal_conduit_layer is None:
             return 0, 0, 0, 0, 0
 
-        # Retrieve the layer from ArcGIS Portal
-        conduit_layer_item = gis.content.get(conduit_id)
-        if not conduit_layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{conduit_id}' not found in ArcGIS Portal.")
-            return 0, 0, 0, 0, 0
-
-        portal_strand_layer = strand_layer_item.layers[0]  # Assuming the correct layer index
-        portal_pole_layer = pole_layer_item.layers[0]  # Assuming the correct layer index
-        portal_conduit_layer = conduit_layer_item.layers[0]
-
         # ✅ Ensure geometry is in Esri JSON format
         if isinstance(fdh_geometry, dict):
             geometry_json = json.dumps(fdh_geometry)  # Convert dict to JSON string
@@ -1092,19 +3565,16 @@ def query_strand_and_poles_from_portal(strand_id, poles_id, conduit_id, fdh_geom
             geometry_json = fdh_geometry.JSON  # Convert ArcPy Geometry to JSON
         else:
             arcpy.AddError("❌ Invalid geometry format.")
-            return {}
+            return 0, 0, 0, 0, 0
 
         # ✅ Ensure spatial reference matches the Portal layer
-        spatial_ref = {"wkid": 4326}  # Default to WGS 1984 (Lat/Lon)
+        spatial_ref = {"wkid": JOIN_SR}  # The FDH boundary is fetched in JOIN_SR
         if "spatialReference" not in fdh_geometry:
             fdh_geometry["spatialReference"] = spatial_ref
 
         # Query the strand layer against the FDH-Boundary geometry
-        query_result_strand = portal_strand_layer.query(
-            geometry_filter=arcgis.geometry.filters.contains(fdh_geometry, sr=102100),
-            return_geometry=True,
-            as_df=False
-        )
+        query_result_strand = query_layer(
+            strand_id, "Strand and Poles", **stage_query("Strand and Poles", strand_id, fdh_geometry), as_df=False)
 
         if not query_result_strand.features:
             arcpy.AddMessage(f"\n ⚠ No features found in {portal_strand_layer.properties.name} "
@@ -1116,11 +3586,15 @@ def query_strand_and_poles_from_portal(strand_id, poles_id, conduit_id, fdh_geom
         total_strand_ftg_reareasment_y = 0  # Strand footage where reareasment = 'Y'
         strand_geometries = []  # Store strand geometries for intersection check
 
+        # Share of each strand's geodesic length inside the FDH (1.0 for every feature when not clipping)
+        factors = clip_factors(query_result_strand.features, fdh_geometry) if CLIP_TO_FDH else \
+            np.ones(len(query_result_strand.features))
+
         # Iterate through the retrieved strand features from the Portal
-        for feature in query_result_strand.features:
+        for feature, factor in zip(query_result_strand.features, factors):
             properties = feature.attributes
             strand_geometry = feature.geometry
-            strand_ftg = properties.get("calcfootage", 0) or 0
+            strand_ftg = (properties.get("calcfootage", 0) or 0) * factor
             reareasment = str(properties.get("reareasment", "UNKNOWN")).strip().upper()
 
             total_strand_ftg += strand_ftg
@@ -1130,16 +3604,16 @@ def query_strand_and_poles_from_portal(strand_id, poles_id, conduit_id, fdh_geom
             if strand_geometry:
                 strand_geometries.append(strand_geometry)  # Store for pole intersection check
 
+        # Fetch every pole touching the FDH once and join it to the strands locally.
+        # Strand is contained by the FDH, so any pole on a strand intersects the boundary.
+        pole_index = FeatureIndex(query_layer(
+            poles_id, "Strand and Poles", **stage_query("Strand and Poles", poles_id, fdh_geometry), as_df=False
+        ).features)
+
         intersecting_poles = []  # Store pole features that intersect strands
 
-        for strand_geom in strand_geometries:
-            query_result_poles = portal_pole_layer.query(
-                geometry_filter=arcgis.geometry.filters.intersects(strand_geom, sr=102100),
-                out_fields="MR_Level",
-                return_geometry=True,
-                as_df=False
-            )
-            intersecting_poles.extend(query_result_poles.features)  # Append results
+        for poles_on_strand in pole_index.bulk_query(strand_geometries, "intersects"):
+            intersecting_poles.extend(poles_on_strand)  # Append results, one entry per strand a pole touches
 
         total_pole_count = len(intersecting_poles)  # Total poles intersecting strands
 
@@ -1150,28 +3624,19 @@ def query_strand_and_poles_from_portal(strand_id, poles_id, conduit_id, fdh_geom
             if mr_level in [1, 2]:  # Check if MR_Level is 1 or 2
                 mr_filtered_pole_count += 1
 
-        total_strand_ftg *= 1.10
-        total_strand_ftg_reareasment_y *= 1.10
+        # Get pole features within the FDH Boundary from the poles already fetched, both in JOIN_SR
+        pole_features = pole_index.contains(join_geometry(fdh_geometry))
 
-        # Get pole features within the FDH Boundary
-        pole_features = portal_pole_layer.query(
-            geometry_filter=arcgis.geometry.filters.contains(fdh_geometry, sr=102100),
-            out_fields="OBJECTID",  # Only field needed since we just want a count of poles
-            return_geometry=True,  # required for intersect
-            as_df=False
-        ).features
+        # Fetch the conduit touching the FDH once and join it to the poles locally
+        conduit_index = FeatureIndex(query_layer(
+            conduit_id, "Strand and Poles", **stage_query("Strand and Poles", conduit_id, fdh_geometry), as_df=False
+        ).features)
 
         uguard_adapter = 0
 
         # Iterating through the retrieved pole features
-        for pole in pole_features:
-            pole_geom = pole.geometry
-            conduits_at_pole = portal_conduit_layer.query(  # Get the ducts intersecting poles
-                geometry_filter=arcgis.geometry.filters.intersects(pole_geom, sr=102100),
-                out_fields="duct_count",
-                return_geometry=False
-            ).features
-
+        for pole, conduits_at_pole in zip(pole_features,
+                                          conduit_index.bulk_query([pole.geometry for pole in pole_features])):
             # Initialize variable to count the ducts at the poles
             duct_sum = 0
 
@@ -1188,13 +3653,15 @@ def query_strand_and_poles_from_portal(strand_id, poles_id, conduit_id, fdh_geom
 
         arcpy.AddMessage(f"\n*** Strand and Poles Within {cab_id}: ***\n"
                          f"--------------------------------------------\n"
-                         f"► Total Strand Footage (including sag): {total_strand_ftg:.2f} feet\n"
+                         f"► Total Strand Footage (including sag): "
+                         f"{total_strand_ftg * BOM_FACTORS['strand_sag']:.2f} feet\n"
                          f"► Total Strand Footage (where reareasment='Y', including sag): "
-                         f"{total_strand_ftg_reareasment_y:.2f} feet\n"
+                         f"{total_strand_ftg_reareasment_y * BOM_FACTORS['strand_sag']:.2f} feet\n"
                          f"► Total Poles Intersecting Strand: {total_pole_count}\n"
                          f"► Total Poles Requiring Make Ready: {mr_filtered_pole_count}\n"
                          f"\n")
 
+        # Sag is added with the other BOM factors
         return (total_strand_ftg,
                 total_strand_ftg_reareasment_y,
                 total_pole_count,
@@ -1204,25 +3671,18 @@ def query_strand_and_poles_from_portal(strand_id, poles_id, conduit_id, fdh_geom
 
     except Exception as e:
         arcpy.AddError(f"❌ Error processing Strand and Pole features: {e}")
+        mark_stage_failed("Strand and Poles", e)
         return 0, 0, 0, 0, 0  # Ensure function always returns three values
 
 
 def query_cabinets_from_portal(passive_id, active_id, fdh_geometry):
+    cab_id = bom_context().cab_id
     try:
-        # Retrieve the passive_cabinet layer from ArcGIS Portal
-        passive_layer_item = gis.content.get(passive_id)
-        if not passive_layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{passive_id}' not found in ArcGIS Portal.")
-            return 0, 0, 0, 0, 0
-
-        # Retrieve the active_cabinet layer from ArcGIS Portal
-        active_layer_item = gis.content.get(active_id)
-        if not active_layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{active_id}' not found in ArcGIS Portal.")
+        # Retrieve the passive_cabinet and active_cabinet layers from ArcGIS Portal
+        portal_passive_layer = get_portal_layer(passive_id, "Cabinets")
+        portal_active_layer = get_portal_layer(active_id, "Cabinets")
+        if portal_passive_layer is None or portal_active_layer is None:
             return 0, 0, 0, 0, 0
-
-        portal_passive_layer = passive_layer_item.layers[0]  # Assuming the correct layer index
-        portal_active_layer = active_layer_item.layers[0]  # Assuming the correct layer index
         # arcpy.AddMessage(f"✅ Found layer in Portal: {portal_passive_layer.url}")
         # arcpy.AddMessage(f"✅ Found layer in Portal: {portal_active_layer.url}")
 
@@ -1236,17 +3696,13 @@ def query_cabinets_from_portal(passive_id, active_id, fdh_geometry):
         #     return {}
 
         # ✅ Ensure spatial reference matches the Portal layer
-        spatial_ref = {"wkid": 4326}  # Default to WGS 1984 (Lat/Lon)
+        spatial_ref = {"wkid": JOIN_SR}  # The FDH boundary is fetched in JOIN_SR
         if "spatialReference" not in fdh_geometry:
             fdh_geometry["spatialReference"] = spatial_ref
 
         # Query the strand layer against the FDH-Boundary geometry
-        query_result_passive = portal_passive_layer.query(
-            geometry_filter=arcgis.geometry.filters.contains(fdh_geometry, sr=102100),
-            out_fields="Cab_Size",
-            return_geometry=True,
-            as_df=False
-        )
+        query_result_passive = query_layer(
+            passive_id, "Cabinets", **stage_query("Cabinets", passive_id, fdh_geometry), as_df=False)
 
         if not query_result_passive.features:
             arcpy.AddMessage(f"⚠ No features found in {portal_passive_layer.properties.name} "
@@ -1280,12 +3736,8 @@ def query_cabinets_from_portal(passive_id, active_id, fdh_geometry):
                          f"\n")
 
         # Query the active_cabinet layer from the Portal
-        query_result_active = portal_active_layer.query(
-            geometry_filter=arcgis.geometry.filters.contains(fdh_geometry, sr=102100),
-            out_fields="*",
-            return_geometry=True,
-            as_df=False
-        )
+        query_result_active = query_layer(
+            active_id, "Cabinets", **stage_query("Cabinets", active_id, fdh_geometry), as_df=False)
 
         if not query_result_active.features:
             arcpy.AddMessage(f"⚠ No features found in {portal_active_layer.properties.name} "
@@ -1305,33 +3757,28 @@ def query_cabinets_from_portal(passive_id, active_id, fdh_geometry):
 
     except Exception as e:
         arcpy.AddError(f"❌ Error processing Active Cabinets or Passive Cabinets: {e}")
+        mark_stage_failed("Cabinets", e)
         return 0, 0, 0, 0, 0  # Ensure function always returns a value
 
 
 def query_risers_from_portal(riser_id, fdh_geometry):
+    cab_id = bom_context().cab_id
     try:
         # Retrieve the riser layer from ArcGIS Portal
-        riser_layer_item = gis.content.get(riser_id)
-        if not riser_layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{riser_id}' not found in ArcGIS Portal.")
+        portal_riser_layer = get_portal_layer(riser_id, "Risers")
+        if portal_riser_layer is None:
             return 0
-
-        portal_riser_layer = riser_layer_item.layers[0]  # Assuming the correct layer index
         # arcpy.AddMessage(f"✅ Found layer in Portal: {portal_riser_layer.url}")
 
 
         # ✅ Ensure spatial reference matches the Portal layer
-        spatial_ref = {"wkid": 4326}  # Default to WGS 1984 (Lat/Lon)
+        spatial_ref = {"wkid": JOIN_SR}  # The FDH boundary is fetched in JOIN_SR
         if "spatialReference" not in fdh_geometry:
             fdh_geometry["spatialReference"] = spatial_ref
 
         # Query the riser layer against the FDH-Boundary geometry
-        query_result_riser = portal_riser_layer.query(
-            geometry_filter=arcgis.geometry.filters.contains(fdh_geometry, sr=102100),
-            out_fields="*",
-            return_geometry=True,
-            as_df=False
-        )
+        query_result_riser = query_layer(
+            riser_id, "Risers", **stage_query("Risers", riser_id, fdh_geometry), as_df=False)
 
         if not query_result_riser.features:
             arcpy.AddMessage(f"⚠ No features found in {portal_riser_layer.properties.name} "
@@ -1349,20 +3796,19 @@ def query_risers_from_portal(riser_id, fdh_geometry):
         return total_risers
 
     except Exception as e:
-        arcpy.AddError(f"❌ Error processing Active Cabinets or Passive Cabinets: {e}")
+        arcpy.AddError(f"❌ Error processing Risers: {e}")
+        mark_stage_failed("Risers", e)
         return 0  # Ensure function always returns a value
 
 
 def query_guys_from_portal(guys_id, fdh_geometry):
+    cab_id = bom_context().cab_id
     try:
-        # Retrieve the riser layer from ArcGIS Portal
-        guys_layer_item = gis.content.get(guys_id)
-        if not guys_layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{guys_id}' not found in ArcGIS Portal.")
+        # Retrieve the guys layer from ArcGIS Portal
+        portal_guys_layer = get_portal_layer(guys_id, "Guys")
+        if portal_guys_layer is None:
             return 0, 0, 0
 
-        portal_guys_layer = guys_layer_item.layers[0]  # Assuming the correct layer index
-
         # # ✅ Ensure geometry is in Esri JSON format
         # if isinstance(fdh_geometry, dict):
         #     geometry_json = json.dumps(fdh_geometry)  # Convert dict to JSON string
@@ -1373,16 +3819,11 @@ def query_guys_from_portal(guys_id, fdh_geometry):
         #     return {}
 
         # ✅ Ensure spatial reference matches the Portal layer
-        spatial_ref = {"wkid": 4326}  # Default to WGS 1984 (Lat/Lon)
+        spatial_ref = {"wkid": JOIN_SR}  # The FDH boundary is fetched in JOIN_SR
         if "spatialReference" not in fdh_geometry:
             fdh_geometry["spatialReference"] = spatial_ref
 
-        query_result_guys = portal_guys_layer.query(
-            geometry_filter=arcgis.geometry.filters.contains(fdh_geometry, sr=102100),
-            out_fields="Guy_Type",
-            return_geometry=True,
-            as_df=False
-        )
+        query_result_guys = query_layer(guys_id, "Guys", **stage_query("Guys", guys_id, fdh_geometry), as_df=False)
 
         if not query_result_guys.features:
             arcpy.AddMessage(f"⚠ No features found in {portal_guys_layer.properties.name} "
@@ -1416,32 +3857,26 @@ def query_guys_from_portal(guys_id, fdh_geometry):
 
     except Exception as e:
         arcpy.AddError(f"❌ Error: {e}")
+        mark_stage_failed("Guys", e)
     return 0, 0, 0
 
 
 def query_drops_from_portal(drop_id, fdh_geometry):
+    cab_id = bom_context().cab_id
     try:
         # Retrieve the drop layer from ArcGIS Portal
-        drop_layer_item = gis.content.get(drop_id)
-        if not drop_layer_item:
-            arcpy.AddError(f"❌ Layer with ID '{drop_id}' not found in ArcGIS Portal.")
+        portal_drop_layer = get_portal_layer(drop_id, "Drops")
+        if portal_drop_layer is None:
             return 0, 0, 0
-
-        portal_drop_layer = drop_layer_item.layers[0]  # Assuming the correct layer index
         # arcpy.AddMessage(f"✅ Found layer in Portal: {portal_drop_layer.url}")
 
         # ✅ Ensure spatial reference matches the Portal layer
-        spatial_ref = {"wkid": 4326}  # Default to WGS 1984 (Lat/Lon)
+        spatial_ref = {"wkid": JOIN_SR}  # The FDH boundary is fetched in JOIN_SR
         if "spatialReference" not in fdh_geometry:
             fdh_geometry["spatialReference"] = spatial_ref
 
         # Query the drop layer against the FDH-Boundary geometry
-        query_result_drops = portal_drop_layer.query(
-            geometry_filter=arcgis.geometry.filters.contains(fdh_geometry, sr=102100),
-            out_fields="*",
-            return_geometry=True,
-            as_df=False
-        )
+        query_result_drops = query_layer(drop_id, "Drops", **stage_query("Drops", drop_id, fdh_geometry), as_df=False)
 
         if not query_result_drops.features:
             arcpy.AddMessage(f"⚠ No features found in {portal_drop_layer.properties.name}"
@@ -1484,345 +3919,1097 @@ def query_drops_from_portal(drop_id, fdh_geometry):
 
     except Exception as e:
         arcpy.AddError(f"❌ Error analyzing drops: {e}")
+        mark_stage_failed("Drops", e)
         return 0, 0, 0  # Ensure function always returns expected values
 
 
-if __name__ == "__main__":
+FIBER_COUNTS = (12, 24, 48, 96, 144, 288, 432)
 
-    fdh_boundary_id = "577f024964b844b7836402bf1f84b01f"
-    conduit_id = "cd6de7b04ed144fe833317fd7fd7731e"
-    structures_id = "47f9081030fa4c50a9ea13b12e5a27e8"
-    splice_enclosure_id = "65482deab3594b5d9c572b8b41715519"
-    cable_id = "d8380eadf1514800ba303842456798b1"
-    slackloop_id = "8124b9d500c240749221ece33c785763"
-    strand_id = "a1950b90b7214b30867bd57bb7760626"
-    poles_id = "bc21b517ca3b4594b27b41ede3b5eb6a"
-    passive_id = "f1bd84729048403fa02153fe1af54bc9"
-    active_id = "8a42d8a5d7b649109101b15647a2235d"
-    riser_id = "8f42330d5a264cdca3bd692cc4b268fe"
-    drop_id = "9f7962eb211a451da43748fd21122911"
-    mdu_boundary_id = "54ec733402cc40c3b95415cdf5005a8a"
-    do_not_build_id = "1c0e4200a5c84664b8c73ccda21acc08"
-    address_master_id = "dfb329f0de874dbca01eee76133c250d"
-    guys_id = "3de8975d28034f53a2680d51279bae67"
-    addresses_id = "0e3a2268b3434e2a8d39a208eba032a6"
 
-    # Returning attributes from the selected FDH_Boundary
-    object_id, fdh_geometry, cab_id, serv_area, city_code, const_ven = (
-        fdh_boundary_selection(fdh_boundary_id))
+def query_slackloop_footage(slackloop_id, fdh_geometry):
+    """The slackloop stage flattened to one UG and one AE footage per fiber count, plus the loop counts."""
+    slackloop_sums, total_ug_slackloops, total_ae_slackloops = (
+        query_slackloops_from_portal(slackloop_id, fdh_geometry))
+    footage = [slackloop_sums.get(str(count), {}).get(placement, 0)
+               for count in FIBER_COUNTS for placement in ("UG", "AE")]
+    return (*footage, total_ug_slackloops, total_ae_slackloops)
+
+
+# The stages feeding the BOM: (stage, function, layer-id globals it is called with, values it returns).
+# Every returned value is a source node of the derivation graph.
+BOM_STAGES = (
+    ("Conduit", query_conduit_from_portal, ("conduit_id",),
+     ("total_ug1ft", "total_ug2ft", "total_1in_conduit", "total_ug1ft_reareasment_Y", "total_4in_conduit",
+      "total_2in_conduit")),
+    ("Structures", query_structures_from_portal, ("structures_id",),
+     ("fp_count", "sv_count", "mv_count", "lv_count", "xl_count", "xsv_count", "nid_count", "axl_count")),
+    ("Splice Enclosures", query_splice_sizes_from_portal, ("splice_enclosure_id",),
+     ("coyote_count", "x17_count", "x22_count", "x28_count", "x19_count", "runt_count", "total_closure_count",
+      "hanger_bracket", "offset_bracket", "ug_closure_count", "lash_closure_count")),
+    ("Cables", query_cables_from_portal, ("cable_id",),
+     ("fiber_12_ug", "fiber_12_ae", "fiber_24_ug", "fiber_24_ae", "fiber_48_ug", "fiber_48_ae", "fiber_96_ug",
+      "fiber_96_ae", "fiber_144_ug", "fiber_144_ae", "fiber_288_ug", "fiber_288_ae", "total_fiber_footage_ug",
+      "total_fiber_footage_ae", "total_f1_ug", "total_f1_ae", "total_f2_ug", "total_f2_ae",
+      "total_fiber_footage_ug_linear", "total_fiber_footage_ae_linear", "total_sp1", "total_sp2",
+      "total_sp3_excluding_f1", "total_heatshrink", "fiber_432_ug", "fiber_432_ae")),
+    ("Slackloops", query_slackloop_footage, ("slackloop_id",),
+     (*(f"slackloop_{count}_{placement}" for count in FIBER_COUNTS for placement in ("ug", "ae")),
+      "total_ug_slackloops", "total_ae_slackloops")),
+    # Strand footage before sag and anchor strand, the strand totals are derived from it
+    ("Strand and Poles", query_strand_and_poles_from_portal, ("strand_id", "poles_id", "conduit_id"),
+     ("strand_calcfootage", "strand_calcfootage_reareasment_y", "total_pole_count", "mr_filtered_pole_count",
+      "uguard_adapter")),
+    ("Guys", query_guys_from_portal, ("guys_id",), ("down_count", "dirt_count", "rock_count")),
+    ("Cabinets", query_cabinets_from_portal, ("passive_id", "active_id"),
+     ("passive_144", "passive_288", "passive_432", "passive_576", "active_cabinet_count")),
+    ("Risers", query_risers_from_portal, ("riser_id",), ("total_risers",)),
+    ("Drops", query_drops_from_portal, ("drop_id",), ("count_over_600ft", "average_calcfootage", "drop_count")),
+    ("Addresses", count_addresses, (),
+     ("total_addresses", "total_hhp_mdu", "total_dnb_addresses", "mdu_boundary_count", "dnb_boundary_count")),
+)
+
+# Derived BOM values: name -> (input node names, function of those inputs in order). Inputs are stage values, BOM
+# factors or other derived values. The functions only use arithmetic and numpy so they evaluate a single FDH or a
+# whole batch of FDHs and factor values (arrays that broadcast against each other) alike.
+DERIVATIONS = {}
+
+
+def add_derivation(name, inputs, function):
+    """Registers a derived value computed from the named source or derived values."""
+    DERIVATIONS[name] = (tuple(inputs), function)
+
+
+def ratio(numerator, denominator):
+    """numerator / denominator, or 0 where the denominator is zero."""
+    denominator = np.asarray(denominator, dtype=float)
+    return np.where(denominator == 0, 0, numerator / np.where(denominator == 0, 1, denominator))
+
+
+def couplers(conduit_ftg, spacing):
+    """One coupler per spacing feet of conduit, none for less than half of it."""
+    count = np.round(np.asarray(conduit_ftg, dtype=float) / spacing).astype(int)
+    return np.where(count < 1, 0, count)
+
+
+add_derivation("strand_ftg", ("strand_calcfootage", "strand_sag"), lambda strand, sag: strand * sag)
+add_derivation("total_strand_ftg_reareasment_y", ("strand_calcfootage_reareasment_y", "strand_sag"),
+               lambda strand, sag: strand * sag)
+add_derivation("total_anchors", ("down_count", "dirt_count", "rock_count"), lambda down, dirt, rock: down + dirt + rock)
+add_derivation("est_total_miles", ("strand_ftg", "total_ug1ft"), lambda ae, ug: np.round((ae + ug) / 5280, 2))
+add_derivation("ae_bom_miles", ("strand_ftg",), lambda ae: np.round(ae / 5280, 2))
+add_derivation("ug_bom_miles", ("total_ug1ft",), lambda ug: np.round(ug / 5280, 2))
+add_derivation("percent_ae", ("strand_ftg", "total_ug1ft"), lambda ae, ug: ratio(ae, ae + ug) * 100)
+add_derivation("percent_ug", ("strand_ftg", "total_ug1ft"), lambda ae, ug: ratio(ug, ae + ug) * 100)
+# Total HHP is F2 fed plus F1 fed
+add_derivation("total_hhp", ("drop_count", "total_hhp_mdu"), lambda drops, mdu: drops + mdu)
+# Snowshoes (a pair) per AE slackloop and lashed closure
+add_derivation("snowshoes", ("total_ae_slackloops", "lash_closure_count"), lambda loops, closures: loops + closures)
+# Additional fiber lashed to strand, a negative value is reported and set to 0
+add_derivation("pfa_2", ("total_fiber_footage_ae", "strand_ftg"), lambda fiber, strand: np.maximum(fiber - strand, 0))
+
+for count in FIBER_COUNTS:
+    # Maintenance loop footage regardless of placement (the splice slack is already in the cable footage), and
+    # the fiber material total per fiber count including it
+    add_derivation(f"slackloop_{count}", (f"slackloop_{count}_ug", f"slackloop_{count}_ae"), lambda ug, ae: ug + ae)
+    add_derivation(f"fiber_{count}", (f"slackloop_{count}", f"fiber_{count}_ug", f"fiber_{count}_ae"),
+                   lambda slack, ug, ae: slack + ug + ae)
+
+for feeder in ("f1", "f2"):
+    add_derivation(f"total_{feeder}", (f"total_{feeder}_ug", f"total_{feeder}_ae"), lambda ug, ae: ug + ae)
+    for suffix in ("", "_ae", "_ug"):
+        add_derivation(f"total_{feeder}{suffix}_miles", (f"total_{feeder}{suffix}",),
+                       lambda footage: np.round(footage / 5280, 2))
+
+add_derivation("total_ae_ftg", tuple(f"fiber_{count}_ae" for count in FIBER_COUNTS), lambda *ae: sum(ae))
+add_derivation("total_ug_ftg", tuple(f"fiber_{count}_ug" for count in FIBER_COUNTS), lambda *ug: sum(ug))
+# Pull-through fiber footage: UG fiber plus the UG maintenance loops
+add_derivation("pfd_1", ("total_fiber_footage_ug", *(f"slackloop_{count}_ug" for count in FIBER_COUNTS)),
+               lambda fiber, *slack: fiber + sum(slack))
+add_derivation("conduit_couplers_1in", ("total_1in_conduit", "coupler_spacing_ft"), couplers)
+add_derivation("conduit_couplers_2in", ("total_2in_conduit", "coupler_spacing_ft"), couplers)
+add_derivation("conduit_couplers_4in", ("total_4in_conduit", "coupler_spacing_ft"), couplers)
+add_derivation("total_cabinets", ("passive_144", "passive_288", "passive_432", "passive_576"), lambda *cab: sum(cab))
+add_derivation("total_linear_footage", ("total_fiber_footage_ug_linear", "total_fiber_footage_ae_linear"),
+               lambda ug, ae: ug + ae)
+# Strand footage plus 25' per anchor
+add_derivation("anchor_strand", ("total_anchors", "anchor_strand_ft"), lambda anchors, feet: anchors * feet)
+add_derivation("total_strand_ftg", ("strand_ftg", "anchor_strand"), lambda strand, anchor: strand + anchor)
+add_derivation("grounded_poles", ("total_pole_count", "grounded_pole_ratio"), lambda poles, share: poles * share)
+add_derivation("tree_trimming", ("total_strand_ftg", "tree_trimming_ratio"), lambda strand, share: strand * share)
+# Engineering Project Manager - Run Time Engineering
+add_derivation("e_epmrt_1", (), lambda: 10)
+add_derivation("lashing_wire", ("total_strand_ftg", "lashing_wire_ratio"),
+               lambda strand, share: np.round(strand * share, 2))
+# Special Crossing footage is 4" conduit + 50
+add_derivation("special_crossing", ("total_4in_conduit", "special_crossing_ft"),
+               lambda conduit, feet: np.where(conduit > 0, conduit + feet, 0))
+add_derivation("total_sp3", ("total_sp3_excluding_f1", "sp3_base"), lambda sp3, base: sp3 + base)
+
+
+def derivation_order():
+    """Derived value names ordered so every value comes after the derived values it reads."""
+    order, visiting = [], set()
+
+    def visit(name):
+        if name in order or name not in DERIVATIONS:
+            return
+        if name in visiting:
+            raise ValueError(f"Derivation cycle through '{name}'")
+        visiting.add(name)
+        for input_name in DERIVATIONS[name][0]:
+            visit(input_name)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in DERIVATIONS:
+        visit(name)
+    return order
+
+
+def downstream(names):
+    """The derived values that read any of the named values, directly or through other derived values."""
+    affected = set(names)
+    for name in derivation_order():
+        if affected & set(DERIVATIONS[name][0]):
+            affected.add(name)
+    return affected - set(names)
+
+
+def to_python(value):
+    """A numpy scalar or 0-d array as the plain Python number the export and the comparisons expect."""
+    return value.item() if isinstance(value, (np.generic, np.ndarray)) and np.ndim(value) == 0 else value
+
+
+def evaluate_derivations(values, changed=None):
+    """Adds every derived value to a copy of values (source values by name) and returns it.
+
+    With changed (names of source values or BOM factors that changed since values were derived) only the derived
+    values downstream of them are recomputed, the rest are kept as they are. Values may be arrays, one element per
+    FDH. BOM factors missing from values are taken from BOM_FACTORS.
+    """
+    values = {**BOM_FACTORS, **values}
+    stale = None if changed is None else downstream(changed)
+    for name in derivation_order():
+        if stale is not None and name not in stale and name in values:
+            continue
+        inputs, function = DERIVATIONS[name]
+        values[name] = to_python(function(*(values[input_name] for input_name in inputs)))
+    return values
+
+
+def evaluate_batch(rows, changed=None):
+    """Evaluates the derivation graph once for many FDHs: rows is a list of value dicts, one per FDH.
 
-    # Returning calculations from the conduit within the selected FDH_Boundary
-    total_ug1ft, total_ug2ft, total_1in_conduit, total_ug1ft_reareasment_Y, total_4in_conduit, total_2in_conduit = (
-        query_conduit_from_portal(conduit_id, fdh_geometry))
+    With changed only the derived values downstream of those names are recomputed (the rows must then hold the
+    values derived before), the same rule evaluate_derivations applies to one FDH.
+    """
+    if not rows:
+        return []
+    names = set.intersection(*(set(row) for row in rows))
+    columns = {name: np.array([row[name] for row in rows]) for name in names
+               if all(isinstance(row[name], (int, float, np.number)) for row in rows)}
+    recomputed = set(DERIVATIONS) if changed is None else downstream(changed)
+    derived = {name: np.broadcast_to(value, len(rows))
+               for name, value in evaluate_derivations(columns, changed).items() if name in recomputed}
+    return [{**row, **{name: to_python(value[i]) for name, value in derived.items()}} for i, row in enumerate(rows)]
+
+
+def report_derivation_warnings(values, cab_id):
+    """Warns about derived values that usually point at bad data in the FDH."""
+    if values["strand_ftg"] + values["total_ug1ft"] == 0:
+        arcpy.AddWarning(f"- {cab_id}: The formula for calculating AE Percentage is "
+                         "  Dividing by Zero!\n"
+                         " - Recalculate geometry of Strand and Conduit"
+                         " OR run with VALIDATE_LENGTHS to find the stale features")
+
+    if values["total_fiber_footage_ae"] - values["strand_ftg"] < 0:
+        arcpy.AddWarning(f"⚠️ PFA-2 is negative in {cab_id}!\n"
+                         f"- This may indicate there are still strand features in a 100% UG Boundary\n"
+                         f" OR\n"
+                         f"- This may indicate the cable and strand footage need to be re-calculated\n"
+                         f"  (VALIDATE_LENGTHS lists the features whose footage no longer matches the geometry)\n"
+                         f"- Please review the data in the FDH Boundary and try again.\n"
+                         f" ** Setting PFA-2 to 0 **")
 
-    fp_count, sv_count, mv_count, lv_count, xl_count, xsv_count, nid_count, axl_count = (
-        query_structures_from_portal(structures_id, fdh_geometry))
+    if values["total_cabinets"] == 0:
+        arcpy.AddWarning(f"⚠️ The total cabinets in the FDH Boundary {cab_id} is zero!\n"
+                         f"- This may indicate the Cabinet Size attribute is not populated.\n"
+                         f"- Please review the data in the map and try again!")
 
-    (coyote_count, x17_count, x22_count, x28_count, x19_count, runt_count, total_closure_count,
-        hanger_bracket, offset_bracket, ug_closure_count, lash_closure_count) = (
-            query_splice_sizes_from_portal(splice_enclosure_id, fdh_geometry))
+    if values["uguard_adapter"] > 0 and values["total_risers"] == 0:
+        arcpy.AddWarning(f"There are {values['uguard_adapter']} UGuard Adapters but {values['total_risers']} Risers "
+                         f"in {cab_id}. Verify Risers in FDH Boundary...")
 
-    (fiber_12_ug, fiber_12_ae, fiber_24_ug, fiber_24_ae, fiber_48_ug, fiber_48_ae, fiber_96_ug, fiber_96_ae,
-        fiber_144_ug, fiber_144_ae, fiber_288_ug, fiber_288_ae, total_fiber_footage_ug, total_fiber_footage_ae,
-        total_f1_ug, total_f1_ae, total_f2_ug, total_f2_ae, total_fiber_footage_ug_linear,
-        total_fiber_footage_ae_linear, total_sp1, total_sp2, total_sp3_excluding_f1, total_heatshrink,
-     fiber_432_ug, fiber_432_ae) = (
-            query_cables_from_portal(cable_id, fdh_geometry))
+    if values["total_anchors"] == 0 and values["total_strand_ftg"] > 0:
+        arcpy.AddWarning(f"There are Strand Features intersecting Pole Features, but no Anchors in {cab_id}! "
+                         f"Please verify FDH Boundary Data...")
 
-    slackloop_sums, total_ug_slackloops, total_ae_slackloops = (
-        query_slackloops_from_portal(slackloop_id, fdh_geometry))
 
-    total_strand_ftg, total_strand_ftg_reareasment_y, total_pole_count, mr_filtered_pole_count, uguard_adapter = (
-        query_strand_and_poles_from_portal(strand_id, poles_id, conduit_id, fdh_geometry))
+def run_stages(fdh_geometry, stages=None, previous=None):
+    """Runs the BOM stages for an FDH and returns their values by name.
 
-    down_count, dirt_count, rock_count = query_guys_from_portal(guys_id, fdh_geometry)
+    With stages (stage names) only those stages run and every other value is taken from previous, the source
+    values of an earlier run of the same FDH.
+    """
+    context = bom_context()
+    values = dict(previous or {})
+    for stage, function, layer_ids, outputs in BOM_STAGES:
+        if stages is None or stage in stages or not set(outputs) <= set(values):
+            start = time.perf_counter()
+            result = function(*(globals()[layer_id] for layer_id in layer_ids), fdh_geometry)
+            context.stage_timings[stage] += time.perf_counter() - start
+            values.update(zip(outputs, result if len(outputs) > 1 else (result,)))
+            if (context.stage_journal is not None and stage not in context.failed_stages and
+                    not context.mdu_filter_active):
+                context.stage_journal.stage_done(stage, {name: values[name] for name in outputs})
+    return values
 
-    total_anchors = down_count + dirt_count + rock_count
 
-    passive_144, passive_288, passive_432, passive_576, active_cabinet_count = (
-        query_cabinets_from_portal(passive_id, active_id, fdh_geometry))
+def stage_layers(stage):
+    """Item ids of the layers a stage reads."""
+    return {item_id for read_stage, item_id, _, _, _ in stage_reads() if read_stage == stage}
 
-    total_risers = query_risers_from_portal(riser_id, fdh_geometry)
 
-    count_over_600ft, average_calcfootage, drop_count = query_drops_from_portal(drop_id, fdh_geometry)
+def stage_outputs(stages=None):
+    """Names of the source values the given stages (every stage by default) return."""
+    return {output for stage, _, _, outputs in BOM_STAGES if stages is None or stage in stages for output in outputs}
 
-    total_addresses, total_hhp_mdu, total_dnb_addresses, mdu_boundary_count, dnb_boundary_count = (
-        count_addresses(fdh_geometry))
+
+def graph_values(values_dict):
+    """The source and derived values of a BOM, kept so it can be re-derived after only some stages are re-run."""
+    names = stage_outputs() | set(DERIVATIONS) | set(BOM_FACTORS)
+    return {name: to_python(value) for name, value in values_dict.items() if name in names}
+
+
+def stage_settings():
+    """The options that change what the stages return, stored values are only reused under the same options."""
+    return json.dumps([CLIP_TO_FDH, EXCLUDE_EXISTING, USE_RECOMPUTED_LENGTHS, EXCLUDE_MDU_FEATURES, JOIN_TOLERANCE])
+
+
+def build_bom_values(fdh_geometry, cab_id, serv_area, city_code, const_ven, previous=None):
+    """Runs every BOM stage for one FDH boundary and derives the values exported to the BOM Template. Stages whose
+    values are all in previous (from a journaled run of the FDH) are not run again."""
+    values_dict = run_stages(fdh_geometry, None if previous is None else set(), previous)
 
     arcpy.AddMessage(f"*** HHPs Within {cab_id}: ***\n"
                      f"---------------------------------\n"
-                     f"► Total HHPs with Drops: {drop_count}\n"
-                     f"► Total HHPs within MDU Boundaries within {cab_id}: {total_hhp_mdu}\n"
-                     f"► Total HHP's within DNB Boundaries within {cab_id}: {total_dnb_addresses}\n"
+                     f"► Total HHPs with Drops: {values_dict['drop_count']}\n"
+                     f"► Total HHPs within MDU Boundaries within {cab_id}: {values_dict['total_hhp_mdu']}\n"
+                     f"► Total HHP's within DNB Boundaries within {cab_id}: {values_dict['total_dnb_addresses']}\n"
                      f"\n")
 
-    # Various calculation for the BOM Template
-    est_total_miles = round(((total_strand_ftg + total_ug1ft) / 5280), 2)
-    ae_bom_miles = round((total_strand_ftg / 5280), 2)
-    ug_bom_miles = round((total_ug1ft / 5280), 2)
-    if total_strand_ftg + total_ug1ft == 0:
-        percent_ae = 0
-        percent_ug = 0
-        arcpy.AddWarning("- The formula for calculating AE Percentage is "
-                         "  Dividing by Zero!\n"
-                         " - Recalculate geometry of Strand and Conduit")
-    else:
-        percent_ae = (total_strand_ftg / (total_strand_ftg + total_ug1ft)) * 100
-        percent_ug = (total_ug1ft / (total_strand_ftg + total_ug1ft)) * 100
-
-    # Calculates total HHP which is F2 fed plus F1 fed
-    total_hhp = drop_count + total_hhp_mdu
-    # Counts total snowshoes (a pair)
-    snowshoes = total_ae_slackloops + lash_closure_count
-    # Calculates the additional fiber lashed to strand
-    pfa_2 = total_fiber_footage_ae - total_strand_ftg
-    if pfa_2 < 0:
-        arcpy.AddWarning(f"⚠️ PFA-2 is negative!\n"
-                         f"- This may indicate there are still strand features in a 100% UG Boundary\n"
-                         f" OR\n"
-                         f"- This may indicate the cable and strand footage need to be re-calculated\n"
-                         f"- Please review the data in the FDH Boundary and try again.\n"
-                         f" ** Setting PFA-2 to 0 **")
-        pfa_2 = 0
-
-    # Extract UG values for different fiber capacities for slackloops.
-    # This allows the total UG cable footage for the 'pull fiber' amount in the BOM to account for slacks
-    slackloop_12_ug = slackloop_sums.get("12", {}).get("UG", 0)
-    slackloop_24_ug = slackloop_sums.get("24", {}).get("UG", 0)
-    slackloop_48_ug = slackloop_sums.get("48", {}).get("UG", 0)
-    slackloop_96_ug = slackloop_sums.get("96", {}).get("UG", 0)
-    slackloop_144_ug = slackloop_sums.get("144", {}).get("UG", 0)
-    slackloop_288_ug = slackloop_sums.get("288", {}).get("UG", 0)
-    slackloop_432_ug = slackloop_sums.get("432", {}).get("UG", 0)
-
-    # Extract Slackloop UG + AE values
-    # This allows the summation of all cable footage + maintenance loops.
-    # The splice slack is already accounted for.
-    slackloop_12 = slackloop_sums.get("12", {}).get("UG", 0) + slackloop_sums.get("12", {}).get("AE", 0)
-    slackloop_24 = slackloop_sums.get("24", {}).get("UG", 0) + slackloop_sums.get("24", {}).get("AE", 0)
-    slackloop_48 = slackloop_sums.get("48", {}).get("UG", 0) + slackloop_sums.get("48", {}).get("AE", 0)
-    slackloop_96 = slackloop_sums.get("96", {}).get("UG", 0) + slackloop_sums.get("96", {}).get("AE", 0)
-    slackloop_144 = slackloop_sums.get("144", {}).get("UG", 0) + slackloop_sums.get("144", {}).get("AE", 0)
-    slackloop_288 = slackloop_sums.get("288", {}).get("UG", 0) + slackloop_sums.get("288", {}).get("AE", 0)
-    slackloop_432 = slackloop_sums.get("432", {}).get("UG", 0) + slackloop_sums.get("432", {}).get("AE", 0)
-
-    # Add Slackloop footage to fiber footage (final total per fiber count regardless of placement)
-    # This is for the material section of the BOM Template
-    fiber_12 = (slackloop_12 + fiber_12_ug + fiber_12_ae)
-    fiber_24 = (slackloop_24 + fiber_24_ug + fiber_24_ae)
-    fiber_48 = (slackloop_48 + fiber_48_ug + fiber_48_ae)
-    fiber_96 = (slackloop_96 + fiber_96_ug + fiber_96_ae)
-    fiber_144 = (slackloop_144 + fiber_144_ug + fiber_144_ae)
-    fiber_288 = (slackloop_288 + fiber_288_ug + fiber_288_ae)
-    fiber_432 = (slackloop_432 + fiber_432_ug + fiber_432_ae)
-
-    # Step 15: Sum F1 and F2 fiber cable footage
-    total_f1 = total_f1_ug + total_f1_ae
-    total_f2 = total_f2_ug + total_f2_ae
-    total_f1_miles = round((total_f1 / 5280), 2)
-    total_f1_ae_miles = round((total_f1_ae / 5280), 2)
-    total_f1_ug_miles = round((total_f1_ug / 5280), 2)
-    total_f2_miles = round((total_f2 / 5280), 2)
-    total_f2_ae_miles = round((total_f2_ae / 5280), 2)
-    total_f2_ug_miles = round((total_f2_ug / 5280), 2)
-    total_ae_ftg = fiber_12_ae + fiber_24_ae + fiber_48_ae + fiber_96_ae + fiber_144_ae + fiber_288_ae + fiber_432_ae
-    total_ug_ftg = fiber_12_ug + fiber_24_ug + fiber_48_ug + fiber_96_ug + fiber_144_ug + fiber_288_ug + fiber_432_ug
-
-    # Add the total UG fiber footage with the UG slackloop footage (Maintenance Loops) to get the full amount of
-    # pull-through fiber footage
-    pfd_1 = total_fiber_footage_ug + (slackloop_12_ug + slackloop_24_ug + slackloop_48_ug + slackloop_96_ug +
-                                      slackloop_144_ug + slackloop_288_ug + slackloop_432_ug)
-
-    # 1.25" Coupler Calculation
-    conduit_couplers_1in = round(total_1in_conduit / 300)
-    if conduit_couplers_1in < 1:
-        conduit_couplers_1in = 0
-
-    # 2" Coupler Calculation
-    conduit_couplers_2in = round(total_2in_conduit / 300)
-    if conduit_couplers_2in < 1:
-        conduit_couplers_2in = 0
-
-    # 4" Coupler Calculation
-    conduit_couplers_4in = round(total_4in_conduit / 300)
-    if conduit_couplers_4in < 1:
-        conduit_couplers_4in = 0
-
-    # Passive_cabinet_count
-    total_cabinets = passive_144 + passive_288 + passive_432 + passive_576
-
-    if total_cabinets == 0:
-        arcpy.AddWarning(f"⚠️ The total cabinets in the FDH Boundary is zero!\n"
-                         f"- This may indicate the Cabinet Size attribute is not populated.\n"
-                         f"- Please review the data in the map and try again!")
+    # Report any stage that failed after retries so its zeros are not taken at face value
+    report_failed_stages()
 
-    # Total linear footage
-    total_linear_footage = total_fiber_footage_ug_linear + total_fiber_footage_ae_linear
+    values_dict.update(cab_id=cab_id, serv_area=serv_area, city_code=city_code, const_ven=const_ven)
+    values_dict = evaluate_derivations(values_dict)
+    report_derivation_warnings(values_dict, cab_id)
+    values_dict["failed_stages"] = dict(bom_context().failed_stages)
+    return values_dict
 
-    # Total Strand Footage plus 25' Per Anchor
-    anchor_strand = total_anchors * 25
-    total_strand_ftg = total_strand_ftg + anchor_strand  # Reassigns total strand
-    # footage to include the anchor strand footage
 
-    # Grounded Poles
-    grounded_poles = total_pole_count * 0.25
+def run_fdh_bom(fdh_geometry, cab_id, serv_area, city_code, const_ven, previous=None, moment=None):
+    """Builds the BOM for one FDH from one snapshot of the layers (SNAPSHOT_READS), recorded under "snapshot".
 
-    # Tree Trimming
-    tree_trimming = total_strand_ftg * 0.175
+    The reads are pinned to the newest edit of the source layers when the BOM starts, to the moment of the
+    Serv_Area batch its features were cut from, or to moment, that of the journaled stages in previous, so a
+    resumed BOM reads its other stages at the moment they were read at. When a layer that could only be read as it
+    is now was edited inside the FDH during the reads, the BOM is read again (every stage) at a new moment, up to
+    SNAPSHOT_RETRIES times, and the layers are listed if it still is.
+    """
+    bom_context().cab_id = cab_id  # Named in the stage messages
+    return read_at_snapshot(fdh_geometry, cab_id, lambda attempt: build_fdh_bom(
+        fdh_geometry, cab_id, serv_area, city_code, const_ven, None if attempt else previous),
+        moment if previous else None)
+
+
+def read_at_snapshot(fdh_geometry, cab_id, build, moment=None):
+    """Runs build(attempt), which reads the layers of one FDH and returns its values, at one snapshot moment
+    (SNAPSHOT_READS, see run_fdh_bom) and keeps the snapshot under "snapshot". moment is pinned for the first
+    attempt when given."""
+    context = bom_context()
+    if not SNAPSHOT_READS:
+        return build(0)
+
+    area_snapshot = dict(context.read_snapshot) if context.read_snapshot.get("area") else None
+    for attempt in range(SNAPSHOT_RETRIES + 1):
+        if attempt or area_snapshot is None:
+            pin_snapshot(moment=None if attempt else moment)
+        values_dict = build(attempt)
+        edited = check_snapshot(fdh_geometry)
+        if not edited or attempt == SNAPSHOT_RETRIES:
+            break
+        arcpy.AddWarning(f"⚠ {', '.join(edited)} edited inside {cab_id} while it was read, reading the BOM again.")
+        reset_fdh_state()
+
+    snapshot = values_dict["snapshot"] = snapshot_record(edited)
+    arcpy.AddMessage(f"📸 {cab_id} read as of {snapshot['moment']}: {len(snapshot['historic_moment'])} layers at the "
+                     f"historic moment" +
+                     (f", {len(snapshot['gdb_version'])} in version {SNAPSHOT_GDB_VERSION}" if SNAPSHOT_GDB_VERSION
+                      else "") +
+                     f", {len(snapshot['local'])} checked for edits since, {len(snapshot['unchecked'])} without "
+                     f"editor tracking\n")
+    if edited:
+        arcpy.AddWarning(f"⚠ {cab_id} may mix features before and after edits to {', '.join(edited)}.")
+    context.read_snapshot.clear()
+    context.read_snapshot.update(area_snapshot or {})  # The next FDH of the batch is cut from the same reads
+    return values_dict
+
+
+def build_fdh_bom(fdh_geometry, cab_id, serv_area, city_code, const_ven, previous=None):
+    """Builds the BOM for one FDH. With EXCLUDE_MDU_FEATURES the stages are re-aggregated from the cached
+    features without those inside MDU boundaries, and both versions are reported. previous holds the values of
+    stages already finished for the FDH, which are not run again."""
+    context = bom_context()
+    if PLAN_QUERIES:
+        prefetch_fdh_layers(fdh_geometry, cab_id, None if previous is None else {
+            stage for stage, _, _, outputs in BOM_STAGES if not set(outputs) <= set(previous)})
+
+    values_dict = build_bom_values(fdh_geometry, cab_id, serv_area, city_code, const_ven, previous)
+    report_stale_lengths()
+    values_dict["stale_lengths"] = dict(context.stale_lengths)
+    if not EXCLUDE_MDU_FEATURES:
+        report_request_counts(cab_id)
+        return values_dict
+
+    inside_count = tag_mdu_features(fdh_geometry)
+    arcpy.AddMessage(f"*** Re-calculating {cab_id} Excluding {inside_count} Features Inside MDU Boundaries ***\n"
+                     f"\n")
 
-    # Engineering Project Manager - Run Time Engineering
-    e_epmrt_1 = 10
+    context.mdu_filter_active = True
+    try:
+        values_without_mdu = build_bom_values(fdh_geometry, cab_id, serv_area, city_code, const_ven)
+    finally:
+        context.mdu_filter_active = False
 
-    # Lashing Wire Calculation
-    lashing_wire = round((total_strand_ftg * 1.5), 2)
+    values_without_mdu["mdu_comparison"] = compare_mdu_values(values_dict, values_without_mdu)
+    values_without_mdu["stale_lengths"] = values_dict["stale_lengths"]
+    report_request_counts(cab_id)
+    return values_without_mdu
 
-    # Special Crossing footage is 4" conduit + 50
-    if total_4in_conduit > 0:
-        special_crossing = total_4in_conduit + 50
-    else:
-        special_crossing = 0
 
-    # Warnings
-    if uguard_adapter > 0 and total_risers == 0:
-        arcpy.AddWarning(f"There are {uguard_adapter} UGuard Adapters but {total_risers} Risers. "
-                         f"Verify Risers in FDH Boundary...")
+def cell_values(values_dict):
+    """The values written to mapped BOM cells, in a form that can be stored as JSON."""
+    return {key: value.item() if isinstance(value, np.generic) else value
+            for key, value in values_dict.items() if key in SUMMARY_CELLS or key in ENGINEERING_CELLS}
 
-    if total_anchors == 0 and total_strand_ftg > 0:
-        arcpy.AddWarning(f"There are Strand Features intersecting Pole Features, but no Anchors! "
-                         f"Please verify FDH Boundary Data...")
 
-    # Store all variables in a dictionary to export to the BOM Template
-    values_dict = {
-            "total_ug1ft": total_ug1ft,
-            "total_ug2ft": total_ug2ft,
-            "total_1in_conduit": total_1in_conduit,
-            "total_2in_conduit": total_2in_conduit,
-            "total_4in_conduit": total_4in_conduit,
-            "conduit_couplers_1in": conduit_couplers_1in,
-            "conduit_couplers_2in": conduit_couplers_2in,
-            "conduit_couplers_4in": conduit_couplers_4in,
-            "total_sp1": total_sp1,
-            "total_sp2": total_sp2,
-            "total_sp3_excluding_f1": total_sp3_excluding_f1,
-            "fiber_12": fiber_12,
-            "fiber_24": fiber_24,
-            "fiber_48": fiber_48,
-            "fiber_96": fiber_96,
-            "fiber_144": fiber_144,
-            "fiber_288": fiber_288,
-            "fiber_432": fiber_432,
-            "total_heatshrink": total_heatshrink,
-            "fp_count": fp_count,
-            "sv_count": sv_count,
-            "mv_count": mv_count,
-            "lv_count": lv_count,
-            "xl_count": xl_count,
-            "xsv_count": xsv_count,
-            "nid_count": nid_count,
-            "axl_count": axl_count,
-            "coyote_count": coyote_count,
-            "x17_count": x17_count,
-            "x22_count": x22_count,
-            "x28_count": x28_count,
-            "x19_count": x19_count,
-            "runt_count": runt_count,
-            "total_closure_count": total_closure_count,
-            "hanger_bracket": hanger_bracket,
-            "offset_bracket": offset_bracket,
-            "drop_count": drop_count,
-            "total_hhp_mdu": total_hhp_mdu,
-            "total_dnb_addresses": total_dnb_addresses,
-            "slackloop_12_ug": slackloop_12_ug,
-            "slackloop_24_ug": slackloop_24_ug,
-            "slackloop_48_ug": slackloop_48_ug,
-            "slackloop_96_ug": slackloop_96_ug,
-            "slackloop_144_ug": slackloop_144_ug,
-            "slackloop_288_ug": slackloop_288_ug,
-            "pfd_1": pfd_1,
-            "total_strand_ftg": total_strand_ftg,
-            "est_total_miles": est_total_miles,
-            "ae_bom_miles": ae_bom_miles,
-            "ug_bom_miles": ug_bom_miles,
-            "percent_ae":  percent_ae,
-            "percent_ug": percent_ug,
-            "lash_closure_count": lash_closure_count,
-            "total_f1": total_f1,
-            "total_f2": total_f2,
-            "total_f1_miles": total_f1_miles,
-            "total_f1_ae_miles": total_f1_ae_miles,
-            "total_f1_ug_miles": total_f1_ug_miles,
-            "total_f2_miles": total_f2_miles,
-            "total_f2_ae_miles": total_f2_ae_miles,
-            "total_f2_ug_miles": total_f2_ug_miles,
-            "total_f2_ug": total_f2_ug,
-            "total_f2_ae": total_f2_ae,
-            "total_ae_ftg": total_ae_ftg,
-            "total_ug_ftg": total_ug_ftg,
-            "total_f1_ae": total_f1_ae,
-            "total_f1_ug": total_f1_ug,
-            "passive_144": passive_144,
-            "passive_288": passive_288,
-            "passive_432": passive_432,
-            "passive_576": passive_576,
-            "ug_closure_count": ug_closure_count,
-            "snowshoes": snowshoes,
-            "pfa_2": pfa_2,
-            "total_risers": total_risers,
-            "cab_id": cab_id,
-            "serv_area": serv_area,
-            "city_code": city_code,
-            "const_ven": const_ven,
-            "total_strand_ftg_reareasment_y": total_strand_ftg_reareasment_y,
-            "total_fiber_footage_ug_linear": total_fiber_footage_ug_linear,
-            "total_fiber_footage_ae_linear": total_fiber_footage_ae_linear,
-            "total_cabinets": total_cabinets,
-            "count_over_600ft": count_over_600ft,
-            "average_calcfootage": average_calcfootage,
-            "total_pole_count": total_pole_count,
-            "mr_filtered_pole_count": mr_filtered_pole_count,
-            "total_linear_footage": total_linear_footage,
-            "active_cabinet_count": active_cabinet_count,
-            "grounded_poles": grounded_poles,
-            "tree_trimming": tree_trimming,
-            "total_ug1ft_reareasment_Y": total_ug1ft_reareasment_Y,
-            "e_epmrt_1": e_epmrt_1,
-            "total_hhp": total_hhp,
-            "down_count": down_count,
-            "dirt_count": dirt_count,
-            "rock_count": rock_count,
-            "total_anchors": total_anchors,
-            "uguard_adapter": uguard_adapter,
-            "lashing_wire": lashing_wire,
-            "special_crossing": special_crossing
-        }
+def same_value(old, new):
+    """Compares two stored cell values, allowing for float round-off."""
+    if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+        return abs(old - new) <= 1e-6 * max(1.0, abs(old), abs(new))
+    return old == new
+
+
+def changed_cells(previous, current):
+    """(sheet, cell, quantity, old value, new value) for every BOM cell whose value changed."""
+    changes = []
+    for sheet, mapping in (("Summary", SUMMARY_CELLS), ("Engineering", ENGINEERING_CELLS)):
+        for key, cells in mapping.items():
+            old, new = (previous or {}).get(key), current.get(key)
+            if key in current and not same_value(old, new):
+                changes.extend((sheet, cell, key, old, new) for cell in cells)
+    return changes
+
+
+class BatchJournal:
+    """Append-only JSON-lines journal of a batch run, one line per finished step.
+
+    Each line is written with one call and flushed (and with JOURNAL_FSYNC synced) before the batch goes on, so a
+    crash loses at most the line being written; a torn last line is dropped when the journal is read back. A journal
+    whose batch finished is started over by the next run of the same batch.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        self.lock = threading.Lock()
+        self.cab_id = None  # FDH the finished stages belong to
+        self.versions = {}  # Layer edit versions the stages of that FDH are read at
+        torn = False
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as journal_file:
+                for line in journal_file:
+                    try:
+                        self.records.append(json.loads(line))
+                    except ValueError:
+                        torn = True  # Written when the process died, every line before it holds
+                        break
+        if any(record.get("event") == "finished" for record in self.records):
+            self.records, torn = [], True
+        if torn:
+            temporary_path = f"{path}.tmp"
+            with open(temporary_path, "w", encoding="utf-8") as journal_file:
+                journal_file.writelines(json.dumps(record) + "\n" for record in self.records)
+            os.replace(temporary_path, path)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, event, **record):
+        record = {"event": event, "at": datetime.now().isoformat(timespec="seconds"), **record}
+        with self.lock:
+            self.file.write(json.dumps(record, default=str) + "\n")
+            self.file.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(self.file.fileno())
+            self.records.append(record)
+
+    def stage_done(self, stage, outputs):
+        """Journals the source values of a stage that finished for the current FDH, with the edit versions of the
+        layers it read and the snapshot moment it was read at."""
+        self.write("stage", cab_id=self.cab_id, stage=stage,
+                   outputs={name: to_python(value) for name, value in outputs.items()},
+                   versions={item_id: self.versions.get(item_id) for item_id in stage_layers(stage)},
+                   moment=bom_context().read_snapshot.get("moment"))
+
+    def events(self, event, cab_id=None):
+        return [record for record in self.records
+                if record.get("event") == event and (cab_id is None or record.get("cab_id") == cab_id)]
+
+    def finished_stages(self, cab_id, versions, moment=None):
+        """The source values of every stage journaled as finished for an FDH that are still current: none of the
+        layers the stage read has been edited since (versions, as from layer_edit_versions) and it was read at the
+        same snapshot moment. A layer whose last edit date is unknown cannot be shown unchanged, so its stages run
+        again."""
+        current, stale = {}, set()
+        for record in self.events("stage", cab_id):  # The last record of a stage holds
+            journaled = record.get("versions") or {}
+            current.pop(record["stage"], None)
+            stale.add(record["stage"])
+            if (record.get("moment") == moment and set(journaled) == stage_layers(record["stage"]) and
+                    all(version is not None and versions.get(item_id) == version
+                        for item_id, version in journaled.items())):
+                current[record["stage"]] = record["outputs"]
+                stale.discard(record["stage"])
+        if stale:
+            arcpy.AddMessage(f"► {cab_id}: {', '.join(sorted(stale))} read before later edits (or at another "
+                             f"moment), running again")
+        return {name: value for outputs in current.values() for name, value in outputs.items()}
+
+    def stage_moment(self, cab_id):
+        """The snapshot moment the last journaled stage of an FDH was read at."""
+        stages = self.events("stage", cab_id)
+        return stages[-1].get("moment") if stages else None
+
+    def is_done(self, cab_id):
+        return bool(self.events("done", cab_id))
+
+    def close(self):
+        self.file.close()
+
+
+def journal_path(name):
+    """Path of a batch journal, next to the local database."""
+    return os.path.join(os.path.dirname(LOCAL_DB), f"BOM_{name}_Journal.jsonl")
+
+
+def refresh_changed_fdhs(fdh_boundary_id):
+    """Recomputes the BOM of only the FDHs touched by edits since the last run and lists the changed cells.
+
+    Edits are found from the editor-tracking dates of every source layer (through the membership table), and the
+    previous BOM of each FDH is kept in the local database to compare against. Only the stages reading an edited
+    layer are re-run, and the values derived from them are re-derived for all those FDHs in one batch. With
+    BATCH_JOURNAL the FDHs of a refresh that stopped (or failed) before its BOMs were stored are carried into the
+    next one, the membership sync has already moved past their edits.
+    """
+    context = bom_context()
+    affected = sync_membership(fdh_boundary_id)
+    if affected is None:
+        arcpy.AddError("❌ Could not determine which FDHs changed.")
+        return {}
+    journal = BatchJournal(journal_path("Refresh")) if BATCH_JOURNAL else None
+    if journal is not None:
+        carried = {}
+        for record in journal.records:
+            if record["event"] == "start":
+                for carried_cab_id, item_ids in record["affected"].items():
+                    carried.setdefault(carried_cab_id, set()).update(item_ids)
+            elif record["event"] == "stored":
+                for stored_cab_id in record["cab_ids"]:
+                    carried.pop(stored_cab_id, None)
+        if carried:
+            arcpy.AddMessage(f"► {len(carried)} FDHs of an unfinished refresh are re-calculated too "
+                             f"({journal.path})")
+        for carried_cab_id, item_ids in carried.items():
+            affected.setdefault(carried_cab_id, set()).update(item_ids)
+        if affected:
+            journal.write("start", affected={str(key): sorted(item_ids) for key, item_ids in affected.items()})
+    if not affected:
+        if journal is not None:
+            journal.close()
+        arcpy.AddMessage("✅ No edits since the last run, every BOM is up to date.")
+        return {}
+
+    arcpy.AddMessage(f"*** Re-calculating {len(affected)} FDHs touched by edits ***\n")
+    if PREFETCH_SERV_AREA and PLAN_QUERIES and len(affected) >= SERV_AREA_MIN_FDHS:
+        edited = set().union(*affected.values())
+        stages = None if fdh_boundary_id in edited or EXCLUDE_MDU_FEATURES else {
+            stage for stage, item_id, _, _, _ in stage_reads() if item_id in edited}
+        prefetch_area_layers([fdh_index_feature(affected_cab_id) for affected_cab_id in affected], stages)
+    settings = stage_settings()
+    changes, recomputed, changed_inputs, stage_timings_by_fdh = {}, {}, {}, {}
+    stored_cab_ids = []  # Deleted or recomputed FDHs, the ones left over are retried by the next refresh
+    connection = open_local_db()
+    try:
+        for cab_id in sorted(affected, key=str):
+            stored = connection.execute("SELECT values_json FROM bom_values WHERE cab_id = ?", (cab_id,)).fetchone()
+            previous = json.loads(stored[0]) if stored else None
+            feature = fdh_index_feature(cab_id)
+            if feature is None:
+                connection.execute("DELETE FROM bom_values WHERE cab_id = ?", (cab_id,))
+                connection.execute("DELETE FROM bom_graph WHERE cab_id = ?", (cab_id,))
+                remove_from_rollups(connection, cab_id)
+                changes[cab_id] = changed_cells(previous, {key: None for key in previous or {}})
+                stored_cab_ids.append(cab_id)
+                continue
+
+            reset_fdh_state()
+            attributes = feature.attributes
+            inputs = dict(cab_id=attributes.get("cab_id"), serv_area=attributes.get("Serv_Area"),
+                          city_code=attributes.get("City_Code"), const_ven=attributes.get("Const_Ven"))
+            graph = connection.execute("SELECT settings, values_json FROM bom_graph WHERE cab_id = ?",
+                                       (cab_id,)).fetchone()
+
+            # Whole FDHs are recomputed when the boundary moved, nothing is stored or the options changed
+            if graph is None or graph[0] != settings or fdh_boundary_id in affected[cab_id] or EXCLUDE_MDU_FEATURES:
+                values_dict = run_fdh_bom(feature.geometry, *inputs.values())
+            else:
+                stages = {stage for stage, item_id, _, _, _ in stage_reads() if item_id in affected[cab_id]}
+                arcpy.AddMessage(f"► {cab_id}: re-running {', '.join(sorted(stages))}")
+                stored_graph = json.loads(graph[1])
+
+                # The stored values of the other stages hold at any later moment, none of their layers changed here
+                def rerun_stages(attempt):
+                    if PLAN_QUERIES:
+                        prefetch_fdh_layers(feature.geometry, cab_id, stages)
+                    rerun = {**run_stages(feature.geometry, stages, stored_graph), **BOM_FACTORS, **inputs}
+                    report_failed_stages()
+                    rerun["failed_stages"] = dict(context.failed_stages)
+                    return rerun
+
+                context.cab_id = cab_id  # Named in the stage messages
+                values_dict = read_at_snapshot(feature.geometry, cab_id, rerun_stages)
+                changed_inputs[cab_id] = {name for name in stage_outputs() | set(BOM_FACTORS)
+                                          if values_dict.get(name) != stored_graph.get(name)}
+
+            stage_timings_by_fdh[cab_id] = dict(context.stage_timings)
+            if values_dict.get("failed_stages"):
+                arcpy.AddWarning(f"⚠ {cab_id} is incomplete and keeps its previous BOM, it will be retried next run.")
+                continue
+            recomputed[cab_id] = (previous, values_dict)
+
+        layer_versions = dict(connection.execute("SELECT item_id, last_edit FROM layer_sync").fetchall())
+
+        # Re-derive the FDHs whose stages were partly re-run in one batch
+        partial = [cab_id for cab_id in recomputed if cab_id in changed_inputs]
+        derived = evaluate_batch([recomputed[cab_id][1] for cab_id in partial], set().union(*changed_inputs.values()))
+        for cab_id, values_dict in zip(partial, derived):
+            report_derivation_warnings(values_dict, cab_id)
+            recomputed[cab_id] = (recomputed[cab_id][0], values_dict)
+
+        for cab_id, (previous, values_dict) in recomputed.items():
+            current = cell_values(values_dict)
+            changes[cab_id] = changed_cells(previous, current)
+            connection.execute("INSERT OR REPLACE INTO bom_values VALUES (?, ?, ?)",
+                               (cab_id, json.dumps(current, default=str), datetime.now().isoformat(timespec="seconds")))
+            connection.execute("INSERT OR REPLACE INTO bom_graph VALUES (?, ?, ?)",
+                               (cab_id, settings, json.dumps(graph_values(values_dict))))
+            if RECORD_RUNS:
+                insert_run(connection, values_dict, timings=stage_timings_by_fdh.get(cab_id, {}),
+                           layer_versions=layer_versions)
+        connection.commit()
+        if journal is not None:
+            stored_cab_ids.extend(recomputed)
+            journal.write("stored", cab_ids=[str(stored_cab_id) for stored_cab_id in stored_cab_ids])
+            if len(stored_cab_ids) == len(affected):
+                journal.write("finished")
+    finally:
+        connection.close()
+        end_area_reads()
+        if journal is not None:
+            journal.close()
+
+    report_changed_cells(changes)
+    return changes
+
+
+def report_changed_cells(changes):
+    """Prints the changed cells per FDH and writes them to a CSV next to the local database."""
+    output_path = os.path.join(os.path.dirname(LOCAL_DB),
+                               f"BOM_Changes_{datetime.now().strftime('%m-%d-%Y_%H%M%S')}.csv")
+    with open(output_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["cab_id", "Sheet", "Cell", "Quantity", "Old Value", "New Value"])
+        for cab_id, cells in changes.items():
+            writer.writerows([cab_id, *cell] for cell in cells)
+            arcpy.AddMessage(f"► {cab_id}: {len(cells)} cells changed" +
+                             "".join(f"\n   {sheet}!{cell} {key}: {old} → {new}"
+                                     for sheet, cell, key, old, new in cells))
+    arcpy.AddMessage(f"✅ Changed cells saved: {output_path}")
+
+
+def run_selected_fdhs(fdh_boundary_id, run_export, construction_vendor, design_vendor):
+    """Builds (and exports) the BOM of every FDH selected in the map's FDH_Boundary layer as one batch.
+
+    With BATCH_JOURNAL the finished stages, BOM and export of every cab_id are journaled, so running the same batch
+    again after a crash skips the FDHs that are done and re-runs only the failed or unfinished stages of the rest.
+    """
+    context = bom_context()
+    if USE_MEMBERSHIP_TABLE or (USE_FDH_INDEX and FDH_INDEX_REFRESH):
+        refresh_fdh_index(fdh_boundary_id)
+
+    selected = fdh_boundary_selection_multiple(fdh_boundary_id)
+    if not selected:
+        return {}
+    if USE_MEMBERSHIP_TABLE:
+        sync_membership(fdh_boundary_id, [fdh["cab_id"] for fdh in selected], refresh_index=False)
+    template_path = os.path.join(script_dir, "TEST_BOM_Template.xlsx")
+    run_export = run_export and construction_vendor and design_vendor and os.path.exists(template_path)
+
+    journal = None
+    if BATCH_JOURNAL:
+        # The same FDHs, vendors and options make the same batch, whose journal is picked up again
+        batch_key = hashlib.sha1(json.dumps([sorted(str(fdh["cab_id"]) for fdh in selected), construction_vendor,
+                                             design_vendor, bool(run_export), stage_settings()]).encode("utf-8"))
+        journal = BatchJournal(journal_path(f"Batch_{batch_key.hexdigest()[:12]}"))
+        skipped = [fdh["cab_id"] for fdh in selected if journal.is_done(fdh["cab_id"])]
+        if skipped:
+            arcpy.AddMessage(f"► Resuming the batch from {journal.path}: {len(skipped)} of {len(selected)} FDHs "
+                             f"are already done.")
+        if not journal.events("start"):
+            journal.write("start", cab_ids=[fdh["cab_id"] for fdh in selected])
+
+    if PREFETCH_SERV_AREA and PLAN_QUERIES:
+        pending = [fdh["cab_id"] for fdh in selected if journal is None or not journal.is_done(fdh["cab_id"])]
+        if len(pending) >= SERV_AREA_MIN_FDHS:
+            prefetch_area_layers(batch_fdh_features(fdh_boundary_id, pending))
+
+    results = {}
+    try:
+        for fdh in selected:
+            cab_id = fdh["cab_id"]
+            if journal is not None and journal.is_done(cab_id):
+                continue
+            reset_fdh_state()
+            previous = moment = None
+            if journal is not None:
+                journal.cab_id = cab_id
+                journal.versions = layer_edit_versions("Batch Journal")
+                context.stage_journal = journal
+                # A Serv_Area batch reads every FDH at its own moment, otherwise the BOM resumes at the journaled one
+                moment = context.read_snapshot.get("moment") or (
+                    journal.stage_moment(cab_id) if SNAPSHOT_READS else None)
+                previous = None if EXCLUDE_MDU_FEATURES else journal.finished_stages(
+                    cab_id, journal.versions, moment) or None
+                if previous:
+                    arcpy.AddMessage(f"► {cab_id}: re-using {len(previous)} values of the stages already finished")
+            try:
+                values_dict = run_fdh_bom(fdh["geometry"], cab_id, fdh["serv_area"], fdh["city_code"],
+                                          fdh["const_ven"], previous, moment)
+            finally:
+                context.stage_journal = None
+            results[cab_id] = values_dict
+            if RECORD_RUNS:
+                record_run(values_dict, construction_vendor, design_vendor)
+            if journal is not None:
+                journal.write("bom", cab_id=cab_id, failed_stages=values_dict["failed_stages"])
+            if values_dict["failed_stages"]:
+                arcpy.AddWarning(f"⚠ {cab_id} is incomplete, it will be retried when the batch is run again.")
+                continue
+
+            if run_export:
+                output_path = os.path.join(os.path.dirname(export_output_path(cab_id)),
+                                           f"BOM_{cab_id}_{datetime.now().strftime('%m-%d-%Y_%H%M%S')}.xlsx")
+                export_to_excel(template_path, output_path, values_dict, construction_vendor, design_vendor)
+                exported = os.path.exists(output_path)  # export_to_excel reports its own errors
+                if journal is not None:
+                    journal.write("export", cab_id=cab_id, path=output_path, ok=exported)
+                if not exported:
+                    arcpy.AddWarning(f"⚠ {cab_id} could not be exported, it will be retried when the batch is run "
+                                     f"again.")
+                    continue
+            if journal is not None:
+                journal.write("done", cab_id=cab_id)
+
+        unfinished = [fdh["cab_id"] for fdh in selected if journal is not None and not journal.is_done(fdh["cab_id"])]
+        if journal is not None and not unfinished:
+            journal.write("finished")
+        arcpy.AddMessage(f"✅ Batch of {len(selected)} FDHs: {len(selected) - len(unfinished)} done" +
+                         (f", {len(unfinished)} to retry: {', '.join(map(str, unfinished))}" if unfinished else ""))
+    finally:
+        end_area_reads()
+        if journal is not None:
+            journal.close()
+    return results
+
+
+def run_record(values_dict):
+    """values_dict in a form that can be stored as JSON."""
+    record = {}
+    for key, value in values_dict.items():
+        if key == "stale_lengths":
+            value = [[*feature, *lengths] for feature, lengths in value.items()]
+        elif key == "mdu_comparison":
+            value = {quantity: [to_python(with_mdu), to_python(without_mdu)]
+                     for quantity, (with_mdu, without_mdu) in value.items()}
+        record[key] = to_python(value)
+    return record
+
+
+def insert_run(connection, values_dict, construction_vendor=None, design_vendor=None, timings=None,
+               layer_versions=None):
+    """Appends one run of one FDH to the run history."""
+    connection.execute(
+        "INSERT INTO bom_runs (cab_id, serv_area, city_code, run_at, construction_vendor, design_vendor, complete, "
+        "values_json, stage_timings, layer_versions) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (values_dict.get("cab_id"), values_dict.get("serv_area"), values_dict.get("city_code"),
+         datetime.now().isoformat(timespec="seconds"), construction_vendor or None, design_vendor or None,
+         int(not values_dict.get("failed_stages")), json.dumps(run_record(values_dict), default=str),
+         json.dumps(timings if timings is not None else dict(bom_context().stage_timings)),
+         json.dumps(layer_versions or {})))
+    if UPDATE_ROLLUPS and not values_dict.get("failed_stages"):
+        update_rollups(connection, values_dict)
+
+
+def record_run(values_dict, construction_vendor=None, design_vendor=None):
+    """Keeps the BOM of a run, its stage timings and the source layers' edit versions in the run history."""
+    try:
+        layer_versions = layer_edit_versions()
+        connection = open_local_db()
+        try:
+            insert_run(connection, values_dict, construction_vendor, design_vendor, layer_versions=layer_versions)
+            connection.commit()
+        finally:
+            connection.close()
+    except Exception as e:
+        arcpy.AddWarning(f"⚠ The run could not be added to the run history: {e}")
+
+
+def latest_runs(serv_area=None, city_code=None, complete_only=True):
+    """The latest recorded run of every FDH (optionally of one Serv_Area or City_Code), as dicts by cab_id."""
+    conditions, parameters = ["complete = 1"] if complete_only else [], []
+    for column, value in (("serv_area", serv_area), ("city_code", city_code)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            parameters.append(value)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    connection = open_local_db()
+    try:
+        rows = connection.execute(
+            f"SELECT run_id, cab_id, serv_area, run_at, construction_vendor, design_vendor, values_json "
+            f"FROM bom_runs WHERE run_id IN (SELECT MAX(run_id) FROM bom_runs {where} GROUP BY cab_id) "
+            f"ORDER BY cab_id", parameters).fetchall()
+    finally:
+        connection.close()
+    return {cab_id: {"run_id": run_id, "serv_area": serv_area, "run_at": run_at,
+                     "construction_vendor": construction_vendor, "design_vendor": design_vendor,
+                     "values": json.loads(values_json)}
+            for run_id, cab_id, serv_area, run_at, construction_vendor, design_vendor, values_json in rows}
+
+
+def diff_runs(cab_id, older_run_id=None, newer_run_id=None):
+    """(quantity, older value, newer value) for every BOM value that differs between two runs of an FDH, by
+    default its last two. Returns the two run ids and the differences."""
+    connection = open_local_db()
+    try:
+        if older_run_id is None or newer_run_id is None:
+            run_ids = [row[0] for row in connection.execute(
+                "SELECT run_id FROM bom_runs WHERE cab_id = ? ORDER BY run_id DESC LIMIT 2", (cab_id,))]
+            if len(run_ids) < 2:
+                return None, None, []
+            newer_run_id, older_run_id = run_ids
+        runs = dict(connection.execute("SELECT run_id, values_json FROM bom_runs WHERE run_id IN (?, ?)",
+                                       (older_run_id, newer_run_id)).fetchall())
+    finally:
+        connection.close()
+
+    older, newer = json.loads(runs[older_run_id]), json.loads(runs[newer_run_id])
+    differences = [(key, older.get(key), newer.get(key)) for key in sorted(set(older) | set(newer), key=str)
+                   if not isinstance(older.get(key, newer.get(key)), (dict, list))
+                   and not same_value(older.get(key), newer.get(key))]
+    return older_run_id, newer_run_id, differences
+
+
+def report_run_diff(cab_id):
+    """Prints what changed between the last two recorded runs of an FDH."""
+    older_run_id, newer_run_id, differences = diff_runs(cab_id)
+    if older_run_id is None:
+        arcpy.AddWarning(f"⚠ {cab_id} has fewer than two recorded runs to compare.")
+        return []
+    arcpy.AddMessage(f"*** {cab_id}: Run {older_run_id} → Run {newer_run_id} ***\n" +
+                     ("\n".join(f"► {key}: {old} → {new}" for key, old, new in differences)
+                      if differences else "► No BOM values changed") + "\n")
+    return differences
+
+
+def report_latest_runs(serv_area):
+    """Prints the latest recorded BOM of every FDH in a Serv_Area."""
+    runs = latest_runs(serv_area)
+    arcpy.AddMessage(f"*** Latest BOMs in Serv_Area {serv_area}: {len(runs)} FDHs ***")
+    for cab_id, run in runs.items():
+        values = run["values"]
+        arcpy.AddMessage(f"► {cab_id} ({run['run_at']}, run {run['run_id']}): "
+                         f"{values.get('total_strand_ftg', 0):,.0f} ft strand, "
+                         f"{values.get('total_ug1ft', 0):,.0f} ft UG1, {values.get('total_hhp', 0)} HHP")
+    return runs
+
+
+def rollup_parents(city_code, serv_area):
+    """The rollup rows an FDH adds to: its Serv_Area, its City_Code and the whole market ("" at a level)."""
+    city_code, serv_area = str(city_code or ""), str(serv_area or "")
+    return [(city_code, serv_area), (city_code, ""), ("", "")] if serv_area or city_code else [("", "")]
+
+
+def add_to_rollups(connection, parents, contribution, sign):
+    connection.executemany(
+        "INSERT INTO bom_rollups VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (city_code, serv_area, quantity) DO UPDATE SET total = total + excluded.total",
+        [(*parent, quantity, sign * value) for parent in dict.fromkeys(parents)
+         for quantity, value in contribution.items()])
+
+
+def remove_from_rollups(connection, cab_id):
+    """Takes an FDH's last contribution out of its parents' totals."""
+    member = connection.execute("SELECT city_code, serv_area, values_json FROM rollup_members WHERE cab_id = ?",
+                                (cab_id,)).fetchone()
+    if member:
+        add_to_rollups(connection, rollup_parents(member[0], member[1]), json.loads(member[2]), -1)
+        connection.execute("DELETE FROM rollup_members WHERE cab_id = ?", (cab_id,))
+        connection.execute("DELETE FROM bom_rollups WHERE (city_code, serv_area) IN (SELECT city_code, serv_area "
+                           "FROM bom_rollups WHERE quantity = 'fdh_count' AND total < 0.5)")  # Levels left empty
+
+
+def update_rollups(connection, values_dict):
+    """Replaces an FDH's contribution to the City_Code, Serv_Area and market totals with its new BOM.
+
+    Only the difference is applied to the parents, so an update costs the same however many FDHs there are.
+    """
+    contribution = {quantity: to_python(values_dict.get(quantity) or 0) for quantity in ROLLUP_QUANTITIES}
+    contribution["fdh_count"] = 1
+    remove_from_rollups(connection, values_dict.get("cab_id"))
+    add_to_rollups(connection, rollup_parents(values_dict.get("city_code"), values_dict.get("serv_area")),
+                   contribution, 1)
+    connection.execute("INSERT INTO rollup_members VALUES (?, ?, ?, ?)",
+                       (values_dict.get("cab_id"), str(values_dict.get("city_code") or ""),
+                        str(values_dict.get("serv_area") or ""), json.dumps(contribution)))
+
+
+def rollup(city_code=None, serv_area=None, cab_id=None):
+    """The rolled-up quantities of the market, a City_Code, a Serv_Area within it, or one FDH, read by key."""
+    connection = open_local_db()
+    try:
+        if cab_id is not None:
+            member = connection.execute("SELECT values_json FROM rollup_members WHERE cab_id = ?",
+                                        (cab_id,)).fetchone()
+            totals = json.loads(member[0]) if member else {}
+        else:
+            totals = {quantity: round(total, 6) for quantity, total in connection.execute(
+                "SELECT quantity, total FROM bom_rollups WHERE city_code = ? AND serv_area = ?",
+                (str(city_code or ""), str(serv_area or "")))}  # Rounded, repeated updates leave float noise
+    finally:
+        connection.close()
+
+    # Miles and shares do not add up, they are derived from the summed footage as they are for one FDH
+    for name in ROLLUP_DERIVED:
+        inputs, function = DERIVATIONS[name]
+        if all(source in totals for source in inputs):
+            totals[name] = to_python(function(*(totals[source] for source in inputs)))
+    return totals
+
+
+def report_rollups():
+    """Prints the market, City_Code and Serv_Area totals."""
+    connection = open_local_db()
+    try:
+        levels = connection.execute("SELECT DISTINCT city_code, serv_area FROM bom_rollups "
+                                    "ORDER BY city_code, serv_area").fetchall()
+    finally:
+        connection.close()
+    for city_code, serv_area in levels:
+        totals = rollup(city_code, serv_area)
+        label = f"Serv_Area {city_code} / {serv_area}" if serv_area else f"City_Code {city_code}" if city_code \
+            else "Market"
+        arcpy.AddMessage(f"► {label}: {totals.get('fdh_count', 0):.0f} FDHs, "
+                         f"{totals.get('total_f1_miles', 0) + totals.get('total_f2_miles', 0):,.2f} fiber miles, "
+                         f"{totals.get('total_hhp', 0):,.0f} HHP, {totals.get('drop_count', 0):,.0f} drops, "
+                         f"{totals.get('total_cabinets', 0):,.0f} cabinets")
+    return levels
+
+
+def cached_graph_values():
+    """{cab_id: stage, factor and derived values} of every FDH kept in the local database by INCREMENTAL_REFRESH."""
+    connection = open_local_db()
+    try:
+        rows = connection.execute("SELECT cab_id, settings, values_json FROM bom_graph ORDER BY cab_id").fetchall()
+    finally:
+        connection.close()
+
+    other_settings = [cab_id for cab_id, settings, _ in rows if settings != stage_settings()]
+    if other_settings:
+        arcpy.AddWarning(f"⚠ {len(other_settings)} cached FDHs were computed with other stage options "
+                         f"(CLIP_TO_FDH, EXCLUDE_EXISTING, ...), their stage values are used as stored.")
+    return {cab_id: json.loads(values_json) for cab_id, _, values_json in rows}
+
+
+def sweep_factors(graphs, grid, quantities=None):
+    """Evaluates the BOM of every FDH under every combination of the BOM factor values in grid, without a query.
+
+    graphs is {cab_id: stored values} and grid {BOM factor: values to try}. The FDHs and the scenarios are the two
+    axes of one array evaluation of the derivation graph. Returns the scenarios (factor values of each) and
+    {quantity: array of shape (scenarios, FDHs)} for the quantities (by default the BOM cells the factors move).
+    """
+    unknown = set(grid) - set(BOM_FACTORS)
+    if unknown:
+        raise ValueError(f"Unknown BOM factors: {', '.join(sorted(unknown))}")
+
+    scenarios = [dict(zip(grid, combination)) for combination in itertools.product(*grid.values())]
+    rows = list(graphs.values())
+    names = set.intersection(*(set(row) for row in rows)) - set(BOM_FACTORS)
+    columns = {name: np.array([[row[name] for row in rows]]) for name in names
+               if all(isinstance(row[name], (int, float)) for row in rows)}
+    for factor in grid:
+        columns[factor] = np.array([[scenario[factor]] for scenario in scenarios])
+
+    # Only the values downstream of the swept factors (and of factors changed since the FDHs were cached) move
+    changed = set(grid) | {factor for factor, value in BOM_FACTORS.items()
+                           if any(row.get(factor) != value for row in rows)}
+    if not set(DERIVATIONS) <= set(columns):
+        changed = None
+
+    quantities = quantities or sorted(downstream(grid) & (set(SUMMARY_CELLS) | set(ENGINEERING_CELLS)))
+    derived = evaluate_derivations(columns, changed)
+    return scenarios, {quantity: np.broadcast_to(derived[quantity], (len(scenarios), len(rows)))
+                       for quantity in quantities}
+
+
+def report_sweep(cab_ids, scenarios, table):
+    """Prints the market total of every swept quantity per scenario and writes the per-FDH table to a CSV."""
+    output_path = os.path.join(os.path.dirname(LOCAL_DB),
+                               f"BOM_Sweep_{datetime.now().strftime('%m-%d-%Y_%H%M%S')}.csv")
+    factors = list(scenarios[0]) if scenarios else []
+    with open(output_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow([*factors, "cab_id", *table])
+        for i, scenario in enumerate(scenarios):
+            writer.writerows([*scenario.values(), cab_id, *(to_python(values[i, j]) for values in table.values())]
+                             for j, cab_id in enumerate(cab_ids))
+            # Percentages are averaged over the FDHs, everything else is summed
+            arcpy.AddMessage(f"► {', '.join(f'{factor} = {value}' for factor, value in scenario.items())}:" +
+                             "".join(f"\n   {quantity}: "
+                                     f"{values[i].mean() if quantity.startswith('percent') else values[i].sum():,.2f}"
+                                     for quantity, values in table.items()))
+    arcpy.AddMessage(f"✅ Sweep of {len(scenarios)} scenarios over {len(cab_ids)} FDHs saved: {output_path}")
+    return output_path
+
+
+def run_factor_sweep():
+    """Sweeps SWEEP_FACTORS over every FDH cached in the local database."""
+    graphs = cached_graph_values()
+    if not graphs:
+        arcpy.AddError("❌ No FDHs are cached in the local database yet, run with INCREMENTAL_REFRESH first.")
+        return None
+    start = time.perf_counter()
+    scenarios, table = sweep_factors(graphs, SWEEP_FACTORS)
+    arcpy.AddMessage(f"*** {len(scenarios)} scenarios x {len(graphs)} FDHs evaluated in "
+                     f"{time.perf_counter() - start:.2f}s ***\n")
+    return report_sweep(list(graphs), scenarios, table)
+
+
+if __name__ == "__main__":
+
+    fdh_boundary_id = "577f024964b844b7836402bf1f84b01f"
+    conduit_id = "cd6de7b04ed144fe833317fd7fd7731e"
+    structures_id = "47f9081030fa4c50a9ea13b12e5a27e8"
+    splice_enclosure_id = "65482deab3594b5d9c572b8b41715519"
+    cable_id = "d8380eadf1514800ba303842456798b1"
+    slackloop_id = "8124b9d500c240749221ece33c785763"
+    strand_id = "a1950b90b7214b30867bd57bb7760626"
+    poles_id = "bc21b517ca3b4594b27b41ede3b5eb6a"
+    passive_id = "f1bd84729048403fa02153fe1af54bc9"
+    active_id = "8a42d8a5d7b649109101b15647a2235d"
+    riser_id = "8f42330d5a264cdca3bd692cc4b268fe"
+    drop_id = "9f7962eb211a451da43748fd21122911"
+    mdu_boundary_id = "54ec733402cc40c3b95415cdf5005a8a"
+    do_not_build_id = "1c0e4200a5c84664b8c73ccda21acc08"
+    address_master_id = "dfb329f0de874dbca01eee76133c250d"
+    guys_id = "3de8975d28034f53a2680d51279bae67"
+    addresses_id = "0e3a2268b3434e2a8d39a208eba032a6"
+
+    if EMULATOR_DIR:
+        import portal_emulator
+        gis = portal_emulator.EmulatedGIS(sys.modules[__name__], EMULATOR_DIR)  # Layers read from GeoJSON files
+
+    reset_fdh_state()
+
+    if CASSETTE_MODE == "record":
+        atexit.register(run_cassette().save)  # Also saved when a mode below ends the run with sys.exit
+    elif CASSETTE_MODE == "replay":
+        atexit.register(run_cassette().report_replay)
+
+    if COMPARE_RUNS_FOR or LATEST_FOR_SERV_AREA or REPORT_ROLLUPS:
+        if COMPARE_RUNS_FOR:
+            report_run_diff(COMPARE_RUNS_FOR)  # Reads only the local database
+        if LATEST_FOR_SERV_AREA:
+            report_latest_runs(LATEST_FOR_SERV_AREA)
+        if REPORT_ROLLUPS:
+            report_rollups()
+        sys.exit(0)
+
+    if INCREMENTAL_REFRESH:
+        with request_priority("batch"):
+            refresh_changed_fdhs(fdh_boundary_id)  # Syncs the FDH index and membership table itself
+        sys.exit(0)
+
+    if SWEEP_FACTORS:
+        run_factor_sweep()  # Reads only the local database
+        sys.exit(0)
+
+    if PRICE_CACHED_FDHS:
+        run_cost_report(os.path.join(script_dir, "TEST_BOM_Template.xlsx"))  # Reads only the local database
+        sys.exit(0)
+
+    if RUN_SERVICE:
+        import bom_service
+        bom_service.serve_bom(sys.modules[__name__], fdh_boundary_id)  # Serves BOMs until the process is stopped
+        sys.exit(0)
+
+    if RUN_SELECTED_FDHS:
+        with request_priority("batch"):
+            run_selected_fdhs(fdh_boundary_id, arcpy.GetParameterAsText(1) == "Yes", arcpy.GetParameterAsText(2),
+                              arcpy.GetParameterAsText(3))
+        sys.exit(0)
+
+    # With a BOM service running the script tool only sends it the cab_id and writes what comes back
+    requested_cab_id = arcpy.GetParameterAsText(0).upper()
+    if USE_SERVICE and requested_cab_id:
+        import bom_service
+        if bom_service.service_available(sys.modules[__name__]) and \
+                bom_service.run_with_service(sys.modules[__name__], requested_cab_id):
+            sys.exit(0)
+
+    if USE_MEMBERSHIP_TABLE or (USE_FDH_INDEX and FDH_INDEX_REFRESH):
+        refresh_fdh_index(fdh_boundary_id)
+
+    # Returning attributes from the selected FDH_Boundary
+    object_id, fdh_geometry, cab_id, serv_area, city_code, const_ven = (
+        fdh_boundary_selection(fdh_boundary_id))
+    if USE_MEMBERSHIP_TABLE and cab_id:
+        sync_membership(fdh_boundary_id, [cab_id], refresh_index=False)
+
+    values_dict = run_fdh_bom(fdh_geometry, cab_id, serv_area, city_code, const_ven)
 
     # Exporting to Excel
     run_export = arcpy.GetParameterAsText(1)
     construction_vendor_rate = arcpy.GetParameterAsText(2)  
     design_vendor_rate = arcpy.GetParameterAsText(3)  
 
+    if RECORD_RUNS:
+        record_run(values_dict, construction_vendor_rate, design_vendor_rate)
+
     if run_export == "Yes":
-        from datetime import datetime
         if not construction_vendor_rate or not design_vendor_rate:
             arcpy.AddWarning("⚠️ Export selected, but Vendors were not provided. Skipping Excel export.\n")
         else:
-            # Fallback name
-            default_filename = "Exported_BOM.xlsx"
-            if cab_id:
-                timestamp = datetime.now().strftime("%m-%d-%Y_%H%M%S")
-                default_filename = f"BOM_{cab_id}_{timestamp}.xlsx"
-
-            output_path = arcpy.GetParameterAsText(4)
-
-            if not output_path:
-                # Build default path in OneDrive
-                one_drive_docs = get_one_drive_documents()
-                output_path = os.path.join(one_drive_docs, default_filename)
-                arcpy.AddMessage(f"No output path specified. Using default: {output_path}")
-
-            # Ensure it ends with .xlsx
-            if not output_path.lower().endswith(".xlsx"):
-                output_path += ".xlsx"
+            output_path = export_output_path(cab_id)
 
             # Locate the Excel template inside the "data" folder
             script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -1831,6 +5018,12 @@ if __name__ == "__main__":
             if not os.path.exists(template_path):
                 raise FileNotFoundError(f"Excel template not found: {template_path}")
 
+            if values_dict["failed_stages"]:
+                arcpy.AddWarning("⚠️ Exporting an INCOMPLETE BOM. See the 'Run_Status' sheet for the failed "
+                                 "stages.\n")
+
+            report_fdh_costs(template_path, values_dict, construction_vendor_rate, design_vendor_rate)
+
             arcpy.AddMessage("► Calling export_to_excel function now...")
 
             # call the primary function for the BOM
@@ -0,0 +1,372 @@
+"""Warm BOM service of BOM_Processing_v1.4.py on localhost (RUN_SERVICE), and the client the script tool uses to
+send it an FDH (USE_SERVICE).
+
+The service keeps the Portal session, layer handles, FDH index, parsed BOM Template and kept BOMs in memory between
+requests. Its settings (SERVICE_PORT, SERVICE_SYNC_SECONDS, ...) are read from the tool script, the module passed as
+tool, whose functions build the BOMs.
+"""
+import contextlib
+import io
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+import zipfile
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import arcpy
+
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+class BOMService:
+    """The state of the BOM service of one process and the BOM requests it answers."""
+
+    def __init__(self, tool, fdh_boundary_id):
+        self.tool = tool
+        self.fdh_boundary_id = fdh_boundary_id
+        self.turns = threading.Condition()  # The BOM of one FDH at a time, so requests share Portal fairly...
+        self.queue = defaultdict(int)  # ...interactive requests first: priority -> requests waiting for their turn
+        self.results = {}  # cab_id -> BOM kept until an edit touches the FDH (USE_MEMBERSHIP_TABLE)
+        self.state = {}  # Time of the last edit sync and the BOM Template bytes held in memory
+
+    def template_path(self):
+        """The BOM Template next to the script, the one the export fills."""
+        return os.path.join(self.tool.script_dir, "TEST_BOM_Template.xlsx")
+
+    def sync(self, cab_ids, force=False):
+        """Pulls Portal edits into the local index and membership table at most every SERVICE_SYNC_SECONDS, or at
+        once when a requested FDH is new to the membership table, and drops the kept BOMs of the FDHs they touch."""
+        tool = self.tool
+        synced_at = self.state.get("synced_at")
+        new_fdhs = {str(requested).upper() for requested in cab_ids} - self.state.setdefault("covered", set())
+        if not force and not (tool.USE_MEMBERSHIP_TABLE and new_fdhs) and synced_at is not None and \
+                time.monotonic() - synced_at < tool.SERVICE_SYNC_SECONDS:
+            return
+        if tool.USE_MEMBERSHIP_TABLE:
+            affected = tool.sync_membership(self.fdh_boundary_id, cab_ids)  # Refreshes the FDH index too
+            if affected is not None:
+                self.state["covered"] |= new_fdhs
+            if affected is None:
+                self.results.clear()
+            for edited in affected or {}:
+                self.results.pop(str(edited).upper(), None)
+        elif tool.USE_FDH_INDEX and tool.FDH_INDEX_REFRESH:
+            tool.refresh_fdh_index(self.fdh_boundary_id)
+        self.state["synced_at"] = time.monotonic()
+
+    def bom(self, requested_cab_id, construction_vendor=None, design_vendor=None, refresh=False):
+        """The BOM of one FDH, or None when no FDH boundary has the cab_id.
+
+        With USE_MEMBERSHIP_TABLE a complete BOM is kept until an edit touches the FDH, so a repeat request costs no
+        Portal queries.
+        """
+        tool = self.tool
+        requested_cab_id = requested_cab_id.upper()
+        if not refresh and requested_cab_id in self.results:
+            return self.results[requested_cab_id]
+
+        tool.reset_fdh_state()
+        object_id, fdh_geometry, cab_id, serv_area, city_code, const_ven = tool.find_fdh(self.fdh_boundary_id,
+                                                                                         requested_cab_id)
+        if fdh_geometry is None:
+            return None
+        values_dict = tool.run_fdh_bom(fdh_geometry, cab_id, serv_area, city_code, const_ven)
+        if tool.RECORD_RUNS:
+            tool.record_run(values_dict, construction_vendor, design_vendor)
+        if tool.USE_MEMBERSHIP_TABLE and not values_dict["failed_stages"]:
+            self.results[requested_cab_id] = values_dict
+        return values_dict
+
+    @contextlib.contextmanager
+    def turn(self, priority):
+        """Runs one step of a request alone. A batch waits while an interactive request is queued, so a single FDH
+        is answered between the FDHs of a batch instead of after all of them."""
+        with self.turns:
+            self.queue[priority] += 1
+            try:
+                self.turns.wait_for(lambda: not self.state.get("busy") and (
+                    priority == "interactive" or not self.queue["interactive"]))
+            finally:
+                self.queue[priority] -= 1
+            self.state["busy"] = True
+        try:
+            yield
+        finally:
+            with self.turns:
+                self.state["busy"] = False
+                self.turns.notify_all()
+
+    def boms(self, cab_ids, construction_vendor=None, design_vendor=None, refresh=False):
+        """The BOMs of several FDHs by cab_id, after one edit sync for the whole batch. With PREFETCH_SERV_AREA the
+        layers are read once per Serv_Area of the batch. A request for one FDH is interactive, its Portal requests
+        and its turn go before those of a batch. Each request builds its BOMs in its own BomContext, so a single FDH
+        answered between the FDHs of a batch neither sees nor clears the batch's Serv_Area reads and snapshot."""
+        tool = self.tool
+        priority = "interactive" if len(cab_ids) == 1 else "batch"
+        with tool.request_priority(priority), tool.bom_run():
+            try:
+                with self.turn(priority):
+                    self.sync(cab_ids, force=refresh)
+                    pending = [requested for requested in cab_ids if refresh or requested.upper() not in self.results]
+                    if tool.PREFETCH_SERV_AREA and tool.PLAN_QUERIES and len(pending) >= tool.SERV_AREA_MIN_FDHS:
+                        tool.prefetch_area_layers(tool.batch_fdh_features(self.fdh_boundary_id, pending))
+                results = {}
+                for requested in cab_ids:
+                    with self.turn(priority):
+                        results[requested] = self.bom(requested, construction_vendor, design_vendor, refresh)
+                return results
+            finally:
+                with self.turn(priority):
+                    tool.end_area_reads()
+
+    def costs(self, values_dict, construction_vendor, design_vendor):
+        """Construction and design cost of one FDH for the selected vendors, from the template's rate cards, with
+        the lines each total leaves out because they could not be priced."""
+        tool = self.tool
+        if not (construction_vendor and design_vendor) or not os.path.exists(self.template_path()):
+            return {}
+        try:
+            model = tool.cost_model(self.template_path())
+            costs = model.price([values_dict], {"RateCard": [construction_vendor], "RateCard_E": [design_vendor]})
+        except tool.CostError as e:
+            return {"error": str(e)}
+        return {tool.RATE_CARD_SHEETS[rate_sheet]: {"total": float(cost["totals"][0, 0]),
+                                                    "unpriced": model.unpriced_lines(rate_sheet, cost, 0)}
+                for rate_sheet, cost in costs.items()}
+
+    def workbook(self, values_dict, construction_vendor, design_vendor):
+        """The exported BOM Template of one FDH as .xlsx bytes, filled from the template held in memory."""
+        if "template" not in self.state:
+            with open(self.template_path(), "rb") as template:
+                self.state["template"] = template.read()
+        output = io.BytesIO()
+        self.tool.export_to_excel(io.BytesIO(self.state["template"]), output, values_dict, construction_vendor,
+                                  design_vendor)
+        if not output.getvalue():
+            raise RuntimeError(f"The BOM Template could not be filled for {values_dict.get('cab_id')}")
+        return output.getvalue()
+
+    def health(self):
+        """What the service holds in memory."""
+        tool = self.tool
+        return {"status": "ok", "indexed_fdhs": len(tool.fdh_index.get("features", [])),
+                "kept_boms": len(self.results), "layers": len(tool.portal_layers),
+                "template_loaded": "template" in self.state, "queued": dict(self.queue),
+                "governors": [governor.state() for governor in list(tool.host_governors.values())]}
+
+    def server(self, port):
+        """The HTTP server of the service on localhost, after the layers, FDH index and template are loaded."""
+        tool = self.tool
+        for item_id in sorted({item_id for _, item_id, _, _, _ in tool.stage_reads()} | {self.fdh_boundary_id}):
+            tool.get_portal_layer(item_id, "BOM Service")
+        self.sync([], force=True)
+        if tool.USE_FDH_INDEX:
+            tool.load_fdh_index()
+        if os.path.exists(self.template_path()):
+            try:
+                tool.cost_model(self.template_path())
+            except tool.CostError as e:
+                arcpy.AddWarning(f"⚠ The template's rate cards cannot price BOMs, no costs will be served: {e}")
+        else:
+            arcpy.AddWarning(f"⚠ Excel template not found: {self.template_path()}, only JSON BOMs can be served.")
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), BOMServiceHandler)
+        server.service = self
+        return server
+
+
+class BOMServiceHandler(BaseHTTPRequestHandler):
+    """HTTP API of the BOM service (self.server.service).
+
+    POST /bom/<cab_id> returns the BOM of one FDH, POST /bom with {"cab_ids": [...]} or {"serv_area": "..."} the BOMs
+    of several. Options go in the JSON body or the query string: construction_vendor, design_vendor, refresh and
+    format ("json", or "xlsx" for the filled BOM Template, a .zip of them for a batch). GET /health reports what is
+    held in memory.
+    """
+
+    def send_body(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, payload, headers=None):
+        self.send_body(status, json.dumps(payload, default=str).encode("utf-8"), headers=headers)
+
+    def log_message(self, format, *args):
+        arcpy.AddMessage(f"► BOM service: {format % args}")
+
+    def do_GET(self):
+        if urlsplit(self.path).path.rstrip("/") != "/health":
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        self.send_json(200, self.server.service.health())
+
+    def do_POST(self):
+        service = self.server.service
+        started = time.perf_counter()
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        if parts[0] != "bom" or len(parts) > 2:
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        except ValueError as e:
+            self.send_json(400, {"error": f"The request body is not JSON: {e}"})
+            return
+        if isinstance(body, list):
+            body = {"cab_ids": body}
+        options = {**{key: values[-1] for key, values in parse_qs(url.query).items()}, **body}
+
+        single = len(parts) == 2
+        if single:
+            cab_ids = [parts[1]]
+        elif options.get("serv_area"):
+            cab_ids = service.tool.fdhs_in_serv_area(options["serv_area"])
+        else:
+            cab_ids = options.get("cab_ids") or []
+        if not cab_ids:
+            self.send_json(400, {"error": "Give a cab_id in the path, or cab_ids or a serv_area in the body."})
+            return
+
+        construction_vendor, design_vendor = options.get("construction_vendor"), options.get("design_vendor")
+        as_workbook = options.get("format") == "xlsx"
+        if as_workbook and not (construction_vendor and design_vendor):
+            self.send_json(400, {"error": "A workbook needs construction_vendor and design_vendor."})
+            return
+
+        try:
+            results = service.boms(cab_ids, construction_vendor, design_vendor,
+                                   str(options.get("refresh", "")).lower() in ("1", "true", "yes"))
+            found = {requested: values_dict for requested, values_dict in results.items() if values_dict is not None}
+            missing = [requested for requested in results if requested not in found]
+            if single and missing:
+                self.send_json(404, {"error": f"No FDH Boundary found for cab_id: {parts[1]}"})
+                return
+
+            headers = {"X-BOM-Failed-Stages": ",".join(sorted({stage for values_dict in found.values()
+                                                                for stage in values_dict["failed_stages"]}))}
+            if as_workbook:
+                workbooks = {requested: service.workbook(values_dict, construction_vendor, design_vendor)
+                             for requested, values_dict in found.items()}
+                if single:
+                    body, content_type, filename = workbooks[cab_ids[0]], XLSX_CONTENT_TYPE, f"BOM_{parts[1]}.xlsx"
+                else:
+                    archive = io.BytesIO()
+                    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as boms:
+                        for requested, workbook in workbooks.items():
+                            boms.writestr(f"BOM_{requested}.xlsx", workbook)
+                    body, content_type, filename = archive.getvalue(), "application/zip", "BOMs.zip"
+                headers.update({"Content-Disposition": f'attachment; filename="{filename}"',
+                                "X-BOM-Seconds": f"{time.perf_counter() - started:.3f}"})
+                self.send_body(200, body, content_type, headers)
+                return
+
+            records = {requested: {**service.tool.run_record(values_dict),
+                                   "costs": service.costs(values_dict, construction_vendor, design_vendor)}
+                       for requested, values_dict in found.items()}
+            headers["X-BOM-Seconds"] = f"{time.perf_counter() - started:.3f}"
+            if single:
+                self.send_json(200, records[cab_ids[0]], headers)
+            else:
+                self.send_json(200, {"boms": records, "not_found": missing}, headers)
+        except Exception as e:
+            arcpy.AddError(f"❌ BOM service request {self.path} failed: {e}")
+            self.send_json(500, {"error": str(e)})
+
+
+def serve_bom(tool, fdh_boundary_id):
+    """Runs the BOM service on localhost until the process is stopped."""
+    start = time.perf_counter()
+    server = BOMService(tool, fdh_boundary_id).server(tool.SERVICE_PORT)
+    arcpy.AddMessage(f"✅ BOM service ready in {time.perf_counter() - start:.1f}s on "
+                     f"http://127.0.0.1:{tool.SERVICE_PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        arcpy.AddMessage("► BOM service stopped.")
+    finally:
+        server.server_close()
+
+
+def service_url(tool, path):
+    return f"http://127.0.0.1:{tool.SERVICE_PORT}{path}"
+
+
+def service_available(tool):
+    """True when a BOM service answers on SERVICE_PORT."""
+    try:
+        with urllib.request.urlopen(service_url(tool, "/health"), timeout=1) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+def request_bom(tool, cab_id, construction_vendor=None, design_vendor=None, as_workbook=False):
+    """Asks the BOM service for one FDH. Returns the BOM values (or the filled workbook's bytes) and the failed
+    stages."""
+    payload = {"construction_vendor": construction_vendor or None, "design_vendor": design_vendor or None,
+               "format": "xlsx" if as_workbook else "json"}
+    request = urllib.request.Request(service_url(tool, f"/bom/{quote(cab_id, safe='')}"),
+                                     data=json.dumps(payload).encode("utf-8"), method="POST",
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=tool.SERVICE_TIMEOUT) as response:
+        body = response.read()
+        failed = [stage for stage in response.headers.get("X-BOM-Failed-Stages", "").split(",") if stage]
+    return (body if as_workbook else json.loads(body)), failed
+
+
+def run_with_service(tool, cab_id):
+    """Runs the script tool as a thin client of the BOM service. Returns False when no service is listening, so the
+    BOM is run in this process instead. A service that is reached but does not answer in time is still building the
+    BOM, so the error is reported and the BOM is not built here too."""
+    run_export = arcpy.GetParameterAsText(1)
+    construction_vendor_rate = arcpy.GetParameterAsText(2)
+    design_vendor_rate = arcpy.GetParameterAsText(3)
+    as_workbook = bool(run_export == "Yes" and construction_vendor_rate and design_vendor_rate)
+    if run_export == "Yes" and not as_workbook:
+        arcpy.AddWarning("⚠️ Export selected, but Vendors were not provided. Skipping Excel export.\n")
+
+    arcpy.AddMessage(f"► Requesting {cab_id} from the BOM service on port {tool.SERVICE_PORT}")
+    start = time.perf_counter()
+    try:
+        result, failed = request_bom(tool, cab_id, construction_vendor_rate, design_vendor_rate, as_workbook)
+    except urllib.error.HTTPError as e:
+        try:
+            reason = json.loads(e.read()).get("error")
+        except ValueError:
+            reason = e.reason
+        arcpy.AddError(f"❌ The BOM service could not build {cab_id}: {reason}")
+        return True
+    except OSError as e:
+        if isinstance(getattr(e, "reason", e), ConnectionRefusedError):
+            arcpy.AddWarning(f"⚠ The BOM service is not running ({e}), running the BOM here instead.")
+            return False
+        arcpy.AddError(f"❌ The BOM service did not return {cab_id} ({e}). It is not built here as well, so Portal is "
+                       f"not read twice for it; run the tool again once the service has finished.")
+        return True
+
+    arcpy.AddMessage(f"✅ BOM of {cab_id} received from the BOM service in {time.perf_counter() - start:.2f}s\n")
+    for stage in failed:
+        arcpy.AddWarning(f"⚠ {stage} FAILED, its values in this BOM are incomplete.")
+
+    if as_workbook:
+        output_path = tool.export_output_path(cab_id)
+        with open(output_path, "wb") as workbook:
+            workbook.write(result)
+        arcpy.AddMessage(f"✅ Excel file successfully saved: {output_path}")
+        arcpy.SetParameter(4, output_path)
+    else:
+        arcpy.AddMessage("\n".join(f"► {quantity}: {result[quantity]}"
+                                   for quantity in (*tool.ROLLUP_QUANTITIES, *tool.ROLLUP_DERIVED)
+                                   if quantity in result) + "\n")
+    return True
@@ -0,0 +1,139 @@
+"""Record / replay of the Portal requests of a BOM_Processing_v1.4.py run (CASSETTE_MODE), a benchmarking tool.
+
+A recorded run saves every layer query with its response and duration to a gzipped JSON cassette. A replayed run
+answers the same queries from it, waiting the recorded time scaled by the tool's REPLAY_LATENCY_SCALE.
+"""
+import gzip
+import json
+import threading
+import time
+from datetime import datetime
+
+import arcgis
+import arcpy
+
+
+def request_key(item_id, query_kwargs):
+    """The query of a layer as it is matched between a recorded and a replayed run (the snapshot moment of the run
+    is left out, it differs every run)."""
+    query_kwargs = {key: value for key, value in query_kwargs.items() if key != "historic_moment"}
+    return json.dumps([item_id, query_kwargs], sort_keys=True, default=str)
+
+
+def response_record(response):
+    """A query response in a form that can be stored in the cassette."""
+    if hasattr(response, "features"):
+        spatial_reference = getattr(response, "spatial_reference", None)
+        return json.loads(json.dumps({
+            "features": [{"attributes": feature.attributes, "geometry": feature.geometry}
+                         for feature in response.features],
+            "spatial_reference": dict(spatial_reference) if spatial_reference else None}, default=str))
+    return {"value": json.loads(json.dumps(response, default=str))}
+
+
+class RecordingLayer:
+    """A Portal layer that adds every query it answers, with the response and its duration, to the cassette."""
+
+    def __init__(self, cassette, item_id, layer, seconds):
+        self.cassette = cassette
+        self.item_id = item_id
+        self.layer = layer
+        with cassette.lock:
+            cassette.records["layers"][item_id] = {
+                "properties": json.loads(json.dumps(dict(layer.properties), default=str)), "seconds": seconds}
+
+    def __getattr__(self, name):
+        return getattr(self.layer, name)
+
+    def query(self, **query_kwargs):
+        started = time.monotonic()
+        response = self.layer.query(**query_kwargs)
+        entry = {"item_id": self.item_id, "request": json.loads(json.dumps(query_kwargs, default=str)),
+                 "response": response_record(response), "seconds": time.monotonic() - started}
+        with self.cassette.lock:
+            self.cassette.records["requests"].append(entry)
+        return response
+
+
+class ReplayLayer:
+    """A stand-in for a Portal layer that answers queries from the cassette, waiting the recorded time of each
+    response scaled by REPLAY_LATENCY_SCALE. A query that was not recorded fails like an unreachable layer."""
+
+    def __init__(self, cassette, item_id, properties):
+        self.cassette = cassette
+        self.item_id = item_id
+        self.properties = cassette.tool.LayerProperties(properties)
+        self.url = f"cassette://replay/{item_id}"
+
+    def query(self, **query_kwargs):
+        cassette, tool = self.cassette, self.cassette.tool
+        key = request_key(self.item_id, json.loads(json.dumps(query_kwargs, default=str)))
+        with cassette.lock:
+            responses = cassette.replay_queues.get(key)
+            if not responses:
+                raise tool.LayerQueryError(f"Request to layer {self.item_id} is not in the cassette: {key[:300]}")
+            entry = responses.pop(0) if len(responses) > 1 else responses[0]  # The last response answers repeats
+            cassette.replayed += 1
+        time.sleep(entry["seconds"] * tool.REPLAY_LATENCY_SCALE)
+        return cassette.response_from_record(entry["response"])
+
+
+class Cassette:
+    """The recorded layer properties and requests of a run, in the cassette file at path. tool is the
+    BOM_Processing module whose layers are recorded or replayed."""
+
+    def __init__(self, tool, path):
+        self.tool = tool
+        self.path = path
+        self.records = {"layers": {}, "requests": []}
+        self.lock = threading.Lock()
+        self.replay_queues = {}  # Request key -> recorded responses not replayed yet
+        self.replayed = 0
+        self.loaded_at = None
+
+    def load(self):
+        """Reads the cassette for replay, once per run."""
+        with self.lock:
+            if self.loaded_at is None:
+                with gzip.open(self.path, "rt", encoding="utf-8") as cassette_file:
+                    self.records.update(json.load(cassette_file))
+                for entry in self.records["requests"]:
+                    self.replay_queues.setdefault(request_key(entry["item_id"], entry["request"]), []).append(entry)
+                self.loaded_at = time.monotonic()
+        return self.records
+
+    def save(self):
+        """Writes every recorded request and response of the run to the cassette file."""
+        with self.lock:
+            self.records["recorded_at"] = datetime.now().isoformat(timespec="seconds")
+            with gzip.open(self.path, "wt", encoding="utf-8") as cassette_file:
+                json.dump(self.records, cassette_file)
+            arcpy.AddMessage(f"📼 {len(self.records['requests'])} Portal requests recorded to {self.path} "
+                             f"({sum(entry['seconds'] for entry in self.records['requests']):.2f}s of responses)")
+
+    def report_replay(self):
+        """Prints how many recorded responses the replayed run used and how long it took."""
+        if self.loaded_at is not None:
+            arcpy.AddMessage(f"📼 {self.replayed} recorded Portal requests replayed in "
+                             f"{time.monotonic() - self.loaded_at:.2f}s (latency x{self.tool.REPLAY_LATENCY_SCALE})")
+
+    def recording_layer(self, item_id, layer, seconds):
+        """The Portal layer of an item, recording its queries. seconds is how long resolving the item took."""
+        return RecordingLayer(self, item_id, layer, seconds)
+
+    def replay_layer(self, item_id):
+        """The replayed layer of an item after its recorded resolve time, or None when it was not recorded."""
+        record = self.load()["layers"].get(item_id)
+        if record is None:
+            return None
+        time.sleep(record["seconds"] * self.tool.REPLAY_LATENCY_SCALE)
+        return ReplayLayer(self, item_id, record["properties"])
+
+    def response_from_record(self, record):
+        """A query response read back from the cassette: features (as a FeatureSet would hold them), a count or
+        ids."""
+        if "features" not in record:
+            return record["value"]
+        return self.tool.LayerResult([arcgis.features.Feature(geometry=json.loads(json.dumps(feature["geometry"])),
+                                                              attributes=dict(feature["attributes"]))
+                                      for feature in record["features"]], record["spatial_reference"])
@@ -0,0 +1,253 @@
+"""Local Portal emulator of BOM_Processing_v1.4.py (EMULATOR_DIR), a development and test stand-in for Portal.
+
+Each layer is a <item id>.geojson file (WGS84) answered like the first layer of a Portal item. The emulator settings
+(EMULATOR_LATENCY, EMULATOR_BANDWIDTH, EMULATOR_RATE_LIMIT, ...) are read from the tool script on every request, and
+its geometry helpers (project_geometry, FeatureIndex, ...) answer the spatial filters.
+"""
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import arcgis
+
+
+def geojson_to_esri(geometry):
+    """An Esri JSON geometry from a GeoJSON geometry (multi-part polygons become one polygon of all rings)."""
+    kind, coordinates = geometry.get("type"), geometry.get("coordinates")
+    if kind == "Point":
+        return {"x": coordinates[0], "y": coordinates[1]}
+    if kind == "MultiPoint":
+        return {"points": coordinates}
+    if kind == "LineString":
+        return {"paths": [coordinates]}
+    if kind == "MultiLineString":
+        return {"paths": coordinates}
+    if kind == "Polygon":
+        return {"rings": coordinates}
+    if kind == "MultiPolygon":
+        return {"rings": [ring for polygon in coordinates for ring in polygon]}
+    raise ValueError(f"Unsupported GeoJSON geometry type: {kind}")
+
+
+def emulator_where(where):
+    """A feature-service where clause in the SQLite dialect: TRIM(BOTH ...) and TIMESTAMP literals are rewritten."""
+    where = re.sub(r"TRIM\(BOTH '(.)' FROM ([^)]+)\)", r"TRIM(\2, '\1')", where or "1=1", flags=re.IGNORECASE)
+    return re.sub(r"(?:TIMESTAMP|DATE) '([^']+)'", lambda match: str(int(datetime.strptime(
+        match.group(1)[:19], "%Y-%m-%d %H:%M:%S" if len(match.group(1)) > 10 else "%Y-%m-%d").replace(
+        tzinfo=timezone.utc).timestamp() * 1000)), where, flags=re.IGNORECASE)
+
+
+class EmulatedLayer:
+    """One <item id>.geojson file served like the first layer of a Portal item (layers[0]).
+
+    Features are held in JOIN_SR with OBJECTIDs, their attributes in an in-memory SQLite table that evaluates
+    where clauses, and spatial filters are answered by a FeatureIndex. query takes the arguments of the arcgis
+    FeatureLayer.query the tool uses, and every REST request it stands for pays the emulator's latency and
+    bandwidth and can be throttled or fail.
+    """
+
+    def __init__(self, emulator, item_id, path):
+        tool = emulator.tool
+        with open(path, encoding="utf-8") as geojson_file:
+            collection = json.load(geojson_file)
+        self.emulator = emulator
+        self.url = f"emulator://localhost/{item_id}"
+        self.features = []
+        for number, feature in enumerate(collection.get("features", []), start=1):
+            attributes = dict(feature.get("properties") or {})
+            attributes.setdefault("OBJECTID", feature.get("id") if isinstance(feature.get("id"), int) else number)
+            geometry = tool.project_geometry(geojson_to_esri(feature["geometry"]), 4326, tool.JOIN_SR) \
+                if feature.get("geometry") else None
+            self.features.append(arcgis.features.Feature(geometry=geometry, attributes=attributes))
+        self.features.sort(key=lambda feature: feature.attributes["OBJECTID"])
+
+        self.fields = list(dict.fromkeys(["OBJECTID"] + [name for feature in self.features
+                                                        for name in feature.attributes]))
+        self.table = sqlite3.connect(":memory:", check_same_thread=False)
+        self.table.execute(f"CREATE TABLE features ({', '.join(json.dumps(name) for name in self.fields)})")
+        self.table.executemany(
+            f"INSERT INTO features VALUES ({', '.join('?' for _ in self.fields)})",
+            [[value if value is None or isinstance(value, (int, float, str)) else json.dumps(value)
+              for value in (feature.attributes.get(name) for name in self.fields)] for feature in self.features])
+        self.table_lock = threading.Lock()
+        self.index = tool.FeatureIndex(self.features)
+        self.positions = {id(feature): position for position, feature in enumerate(self.features)}
+
+        boxes = self.index.boxes
+        edit_field = next((name for name in self.fields if name.lower() == "editdate"), None)
+        self.properties = tool.LayerProperties({
+            "name": collection.get("name") or item_id,
+            "objectIdField": "OBJECTID",
+            "maxRecordCount": tool.EMULATOR_MAX_RECORD_COUNT,
+            "fields": [{"name": name} for name in self.fields],
+            "extent": {"xmin": float(boxes[:, 0].min()) if len(boxes) else 0,
+                       "ymin": float(boxes[:, 1].min()) if len(boxes) else 0,
+                       "xmax": float(boxes[:, 2].max()) if len(boxes) else 0,
+                       "ymax": float(boxes[:, 3].max()) if len(boxes) else 0,
+                       "spatialReference": {"wkid": tool.JOIN_SR, "latestWkid": 3857}},
+            "editFieldsInfo": {"editDateField": edit_field} if edit_field else None,
+            "editingInfo": {"lastEditDate": max((feature.attributes.get(edit_field) or 0 for feature in self.features),
+                                                default=None) if edit_field else None},
+        })
+
+    def matching(self, where, geometry_filter):
+        """Positions of the features matching a where clause and a spatial filter, in OBJECTID order."""
+        tool = self.emulator.tool
+        try:
+            with self.table_lock:
+                positions = [row[0] - 1 for row in self.table.execute(
+                    f"SELECT rowid FROM features WHERE {emulator_where(where)} ORDER BY rowid")]
+        except sqlite3.Error as e:
+            raise ValueError(f"Error code 400: Unable to perform query, invalid where clause '{where}': {e}")
+        if not geometry_filter:
+            return positions
+
+        geometry = geometry_filter["geometry"]
+        in_sr = geometry_filter.get("inSR") or geometry.get("spatialReference") or tool.JOIN_SR
+        geometry = tool.project_geometry(geometry, in_sr, tool.JOIN_SR)
+        relation = geometry_filter.get("spatialRel", "esriSpatialRelIntersects")
+        if relation == "esriSpatialRelEnvelopeIntersects":
+            geometry = tool.envelope_polygon(*tool.prepare_geometry(geometry)["bbox"])
+            relation = "esriSpatialRelIntersects"
+        relations = {"esriSpatialRelIntersects": "intersects", "esriSpatialRelContains": "contains"}
+        if relation not in relations:
+            raise ValueError(f"Error code 400: Spatial relationship {relation} is not supported by the emulator")
+        inside = {self.positions[id(self.index.features[i])] for i in self.index.query(geometry, relations[relation])}
+        return [position for position in positions if position in inside]
+
+    def out_feature(self, feature, out_fields, return_geometry, out_sr):
+        """A copy of a feature with the requested fields, and its geometry in out_sr."""
+        tool = self.emulator.tool
+        if out_fields is None:
+            attributes = dict(feature.attributes)
+        else:
+            attributes = {name: feature.attributes.get(name) for name in out_fields}
+        geometry = None
+        if return_geometry and feature.geometry:
+            geometry = tool.project_geometry(json.loads(json.dumps(feature.geometry)), tool.JOIN_SR,
+                                             out_sr or tool.JOIN_SR)
+        return arcgis.features.Feature(geometry=geometry, attributes=attributes)
+
+    def statistics(self, positions, out_statistics, group_by):
+        """Rows of outStatistics (count, sum, min, max, avg) per group of the matching features."""
+        groups = defaultdict(list)
+        group_fields = [field.strip() for field in (group_by or "").split(",") if field.strip()]
+        for position in positions:
+            attributes = self.features[position].attributes
+            groups[tuple(attributes.get(field) for field in group_fields)].append(attributes)
+
+        functions = {"count": len, "sum": sum, "min": min, "max": max, "avg": lambda values: sum(values) / len(values)}
+        rows = []
+        for key, members in groups.items():
+            row = dict(zip(group_fields, key))
+            for statistic in out_statistics:
+                values = [member.get(statistic["onStatisticField"]) for member in members]
+                values = [value for value in values if value is not None]
+                function = functions[statistic["statisticType"].lower()]
+                row[statistic.get("outStatisticFieldName") or statistic["statisticType"]] = \
+                    function(values) if values or function is len else None
+            rows.append(arcgis.features.Feature(attributes=row))
+        return self.emulator.tool.LayerResult(rows)
+
+    def query(self, where="1=1", out_fields="*", geometry_filter=None, return_geometry=True, out_sr=None,
+              return_count_only=False, return_ids_only=False, out_statistics=None,
+              group_by_fields_for_statistics=None, result_offset=None, result_record_count=None,
+              return_all_records=True, **unused):
+        tool = self.emulator.tool
+        positions = self.matching(where, geometry_filter)
+        if return_count_only:
+            self.emulator.request(16)
+            return len(positions)
+        if return_ids_only:
+            object_ids = [self.features[position].attributes["OBJECTID"] for position in positions]
+            self.emulator.request(12 * len(object_ids))
+            return {"objectIdFieldName": "OBJECTID", "objectIds": object_ids}
+        if out_statistics:
+            result = self.statistics(positions, out_statistics, group_by_fields_for_statistics)
+            self.emulator.request(len(json.dumps([row.attributes for row in result.features], default=str)))
+            return result
+
+        fields = None
+        if out_fields and out_fields.strip() != "*":
+            by_name = {name.lower(): name for name in self.fields}
+            requested = [field.strip() for field in out_fields.split(",") if field.strip()]
+            missing = [field for field in requested if field.lower() not in by_name]
+            if missing:
+                raise ValueError(f"Error code 400: Invalid field(s) in outFields: {', '.join(missing)}")
+            fields = list(dict.fromkeys(by_name[field.lower()] for field in requested))
+
+        # One REST request per page, the arcgis API pages through maxRecordCount unless one page is asked for
+        offset = result_offset or 0
+        page_size = min(result_record_count or tool.EMULATOR_MAX_RECORD_COUNT, tool.EMULATOR_MAX_RECORD_COUNT)
+        single_page = result_offset is not None or result_record_count is not None or not return_all_records
+        features = []
+        while True:
+            page = [self.out_feature(self.features[position], fields, return_geometry, out_sr)
+                    for position in positions[offset:offset + page_size]]
+            self.emulator.request(len(json.dumps([[feature.attributes, feature.geometry] for feature in page],
+                                                 default=str)))
+            features.extend(page)
+            offset += page_size
+            if single_page or offset >= len(positions):
+                break
+        return tool.LayerResult(features, {"wkid": tool.wkid_of(out_sr) or tool.JOIN_SR})
+
+
+class EmulatedItem:
+    def __init__(self, layer):
+        self.layers = [layer]
+
+
+class EmulatedContent:
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def get(self, item_id):
+        """The item of a <item id>.geojson file in the emulator folder, or None like a missing Portal item."""
+        path = os.path.join(self.emulator.folder, f"{item_id}.geojson")
+        self.emulator.request(256)
+        if not os.path.exists(path):
+            return None
+        with self.emulator.lock:
+            if item_id not in self.emulator.layers:
+                self.emulator.layers[item_id] = EmulatedLayer(self.emulator, item_id, path)
+        return EmulatedItem(self.emulator.layers[item_id])
+
+
+class EmulatedGIS:
+    """A local stand-in for the Portal GIS object (gis.content.get(item_id).layers[0]) backed by GeoJSON files, with
+    EMULATOR_LATENCY, EMULATOR_BANDWIDTH, EMULATOR_RATE_LIMIT (429) and EMULATOR_ERROR_RATE (503) of the tool script
+    (the module passed as tool) applied to every request."""
+
+    def __init__(self, tool, folder):
+        self.tool = tool
+        self.folder = folder
+        self.url = "emulator://localhost"
+        self.layers = {}
+        self.lock = threading.Lock()
+        self.recent = []  # Times of the requests answered in the last second
+        self.request_count = 0
+        self.content = EmulatedContent(self)
+
+    def request(self, response_bytes):
+        """Waits out one REST request, or raises the throttling or server error the emulator injects."""
+        tool = self.tool
+        with self.lock:
+            self.request_count += 1
+            now = time.monotonic()
+            self.recent = [started for started in self.recent if now - started < 1]
+            if tool.EMULATOR_RATE_LIMIT and len(self.recent) >= tool.EMULATOR_RATE_LIMIT:
+                raise ConnectionError("Error code 429: Too Many Requests (emulator rate limit)")
+            self.recent.append(now)
+        if random.random() < tool.EMULATOR_ERROR_RATE:
+            raise ConnectionError("Error code 503: Service Unavailable (emulator error injection)")
+        delay = tool.EMULATOR_LATENCY + random.uniform(0, tool.EMULATOR_JITTER)
+        if tool.EMULATOR_BANDWIDTH:
+            delay += response_bytes / tool.EMULATOR_BANDWIDTH
+        time.sleep(delay)
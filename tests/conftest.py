@@ -0,0 +1,121 @@
+"""Fixtures of the BOM tool tests: the tool script loaded as a module, and a small FDH design served from GeoJSON
+files by portal_emulator instead of Portal.
+
+The tool imports arcpy and the arcgis API, so the tests run in the ArcGIS Pro Python environment and are skipped
+without it. No test queries Portal.
+"""
+import copy
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Layer-id globals the BOM stages are called with -> item id of the emulated layer
+LAYER_IDS = {
+    "fdh_boundary_id": "fdh", "conduit_id": "conduit", "structures_id": "structures",
+    "splice_enclosure_id": "splice", "cable_id": "cable", "slackloop_id": "slackloop", "strand_id": "strand",
+    "poles_id": "poles", "passive_id": "passive", "active_id": "active", "riser_id": "riser", "drop_id": "drops",
+    "mdu_boundary_id": "mdu", "do_not_build_id": "dnb", "address_master_id": "address_master", "guys_id": "guys",
+    "addresses_id": "addresses",
+}
+
+FDH_RING = [[0, 0], [100, 0], [100, 100], [0, 100], [0, 0]]  # Web Mercator meters
+
+
+def line(*points):
+    return {"paths": [[list(point) for point in points]]}
+
+
+def point(x, y):
+    return {"x": x, "y": y}
+
+
+# One FDH (TEST) with a feature or two of every layer, geometries in Web Mercator meters. The MDU boundary covers
+# its north-east corner.
+DESIGN = {
+    "fdh": [({"cab_id": "TEST", "Serv_Area": "SA1", "City_Code": "CC", "Const_Ven": "V"}, {"rings": [FDH_RING]})],
+    "conduit": [
+        ({"UG1FT": 100, "LaborFootage": 90, "BOMCalc": 100, "reareasment": "Y", "Cond_Diam": "1.25", "duct_count": 1},
+         line((10, 10), (10, 50))),
+        ({"UG1FT": 40, "LaborFootage": 40, "BOMCalc": 40, "reareasment": "N", "Cond_Diam": "2", "duct_count": 3},
+         line((70, 70), (80, 80)))],
+    "structures": [({"structuretype": "FP"}, point(5, 5)), ({"structuretype": "SV"}, point(70, 70))],
+    "splice": [({"splicesize": "Coyote One", "placementtype": "AE"}, point(20, 20))],
+    "cable": [
+        ({"cable_name": "c1", "placementtype": "UG", "fibercount": "144", "hierarchy": "F1", "LengthFT": 500,
+          "SpliceSlack": 550, "SP1": 1, "SP2": 2, "SP3": 3}, line((0, 0), (50, 50))),
+        ({"cable_name": "c2", "placementtype": "AE", "fibercount": "48", "hierarchy": "F2", "LengthFT": 300,
+          "SpliceSlack": 320, "SP1": 1, "SP2": 0, "SP3": 4}, line((70, 70), (90, 90)))],
+    "slackloop": [
+        ({"cable_capacity": "144", "placement": "UG", "loop_length": 50, "type": "Maintenance Loop"}, point(10, 10)),
+        ({"cable_capacity": "48", "placement": "AE", "loop_length": 60, "type": "maintenance loop"}, point(80, 80))],
+    "strand": [({"calcfootage": 200, "reareasment": "N"}, line((70, 70), (90, 70)))],
+    "poles": [({"MR_Level": 1}, point(70, 70)), ({"MR_Level": 3}, point(90, 70))],
+    "passive": [({"Cab_Size": "288"}, point(50, 50))],
+    "active": [],
+    "riser": [({"riser": 1}, point(70, 70))],
+    "guys": [({"Guy_Type": "Down"}, point(90, 71))],
+    "drops": [({"calcfootage": 100}, line((1, 1), (2, 2))), ({"calcfootage": 700}, line((80, 80), (85, 85)))],
+    "mdu": [({"hhp_count": "12"}, {"rings": [[[60, 60], [100, 60], [100, 100], [60, 100], [60, 60]]]})],
+    "dnb": [],
+    "address_master": [({"address": 1}, point(1, 1))],
+    "addresses": [],
+}
+
+
+@pytest.fixture(scope="session")
+def bom():
+    """BOM_Processing_v1.4.py loaded as a module (its __main__ block does not run)."""
+    pytest.importorskip("arcpy")
+    pytest.importorskip("arcgis")
+    spec = importlib.util.spec_from_file_location("bom_processing", os.path.join(ROOT, "BOM_Processing_v1.4.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # The script hands itself to portal_emulator and portal_cassette
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_layers(bom, folder, design):
+    """Writes every layer of a design as <item id>.geojson (WGS84) into folder."""
+    for item_id, features in design.items():
+        collection = {"type": "FeatureCollection", "name": item_id, "features": []}
+        for attributes, geometry in features:
+            geometry = bom.project_geometry(copy.deepcopy(geometry), bom.JOIN_SR, 4326)
+            if "x" in geometry:
+                geojson = {"type": "Point", "coordinates": [geometry["x"], geometry["y"]]}
+            elif "paths" in geometry:
+                geojson = {"type": "MultiLineString", "coordinates": geometry["paths"]}
+            else:
+                geojson = {"type": "Polygon", "coordinates": geometry["rings"]}
+            collection["features"].append({"type": "Feature", "properties": attributes, "geometry": geojson})
+        with open(os.path.join(folder, f"{item_id}.geojson"), "w", encoding="utf-8") as geojson_file:
+            json.dump(collection, geojson_file)
+
+
+@pytest.fixture
+def portal(bom, tmp_path, monkeypatch):
+    """The emulated Portal of DESIGN, answering without latency, with the tool's layer ids pointing at it."""
+    import portal_emulator
+
+    write_layers(bom, tmp_path, DESIGN)
+    monkeypatch.setattr(bom, "EMULATOR_LATENCY", 0)
+    monkeypatch.setattr(bom, "EMULATOR_JITTER", 0)
+    for name, item_id in LAYER_IDS.items():
+        monkeypatch.setattr(bom, name, item_id, raising=False)
+    emulated = portal_emulator.EmulatedGIS(bom, str(tmp_path))
+    monkeypatch.setattr(bom, "gis", emulated)
+    bom.portal_layers.clear()
+    with bom.bom_run():
+        yield emulated
+    bom.portal_layers.clear()
+
+
+@pytest.fixture
+def fdh_geometry():
+    """The TEST FDH boundary as the tool reads it."""
+    return {"rings": [copy.deepcopy(FDH_RING)], "spatialReference": {"wkid": 102100}}
@@ -0,0 +1,50 @@
+"""Reading each layer once for the FDHs of a Serv_Area batch (PREFETCH_SERV_AREA) and partitioning it locally."""
+import pytest
+from conftest import DESIGN, write_layers
+
+
+@pytest.fixture
+def area_fdhs(bom, portal, monkeypatch):
+    """The FDHs of SA1: TEST and two empty neighbours east of it."""
+    monkeypatch.setattr(bom, "PLAN_QUERIES", True)
+    neighbours = [({"cab_id": cab_id, "Serv_Area": "SA1"},
+                   {"rings": [[[x, 0], [x + 100, 0], [x + 100, 100], [x, 100], [x, 0]]]})
+                  for cab_id, x in (("NEXT", 100), ("LAST", 200))]
+    write_layers(bom, portal.folder, {"fdh": DESIGN["fdh"] + neighbours})
+    fdhs = bom.fetch_layer_features(bom.fdh_boundary_id, "FDH Selection", out_fields="*")
+    assert len(fdhs) == bom.SERV_AREA_MIN_FDHS
+    return fdhs
+
+
+def run_area(bom, fdhs, requests_per_fdh=None):
+    """Values of every FDH of the Serv_Area, each cut from one read of the layers."""
+    bom.reset_fdh_state()
+    bom.prefetch_area_layers(fdhs)
+    assert set(bom.bom_context().request_counts.values()) == {1}  # One read of each layer for the three FDHs
+    values = {}
+    for fdh in fdhs:
+        bom.reset_fdh_state()
+        values[fdh.attributes["cab_id"]] = bom.run_fdh_bom(fdh.geometry, fdh.attributes["cab_id"], "SA1", "CC", "V")
+        if requests_per_fdh is not None:
+            assert bom.bom_context().request_counts == requests_per_fdh
+    bom.end_area_reads()
+    return values
+
+
+def test_fdhs_of_a_serv_area_are_cut_from_one_read(bom, area_fdhs, fdh_geometry):
+    expected = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    values = run_area(bom, area_fdhs, requests_per_fdh={})
+    assert {name: values["TEST"][name] for name in bom.stage_outputs()} == \
+        {name: expected[name] for name in bom.stage_outputs()}
+    assert values["NEXT"]["fp_count"] == values["LAST"]["total_pole_count"] == 0
+
+
+def test_mdu_features_are_left_out_of_the_partitions(bom, area_fdhs, fdh_geometry, monkeypatch):
+    monkeypatch.setattr(bom, "EXCLUDE_MDU_FEATURES", True)
+    expected = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert expected["sv_count"] == 0
+
+    values = run_area(bom, area_fdhs)
+    assert {name: values["TEST"][name] for name in bom.stage_outputs()} == \
+        {name: expected[name] for name in bom.stage_outputs()}
+    assert values["TEST"]["mdu_comparison"]["sv_count"] == (1, 0)
@@ -0,0 +1,48 @@
+"""The batch journal (BATCH_JOURNAL) a restarted batch resumes from."""
+import json
+
+
+def journaled_run(bom, fdh_geometry, path, versions):
+    """Runs every stage of the TEST FDH with its stages journaled to path, returns their values."""
+    journal = bom.BatchJournal(path)
+    journal.cab_id, journal.versions = "TEST", versions
+    context = bom.bom_context()
+    context.cab_id, context.stage_journal = "TEST", journal
+    try:
+        return bom.run_stages(fdh_geometry)
+    finally:
+        context.stage_journal = None
+        journal.close()
+
+
+def test_restart_reuses_the_stages_read_before_no_edits(bom, portal, fdh_geometry, tmp_path):
+    path = str(tmp_path / "BOM_Test_Journal.jsonl")
+    versions = {item_id: 1 for _, item_id, _, _, _ in bom.stage_reads()}
+    values = journaled_run(bom, fdh_geometry, path, versions)
+    with open(path, "a", encoding="utf-8") as journal_file:
+        journal_file.write('{"event": "stage", "cab_id": "TE')  # The process died while writing
+
+    journal = bom.BatchJournal(path)
+    assert journal.finished_stages("TEST", versions) == values
+    with open(path, encoding="utf-8") as journal_file:
+        assert all(json.loads(line) for line in journal_file)  # The torn line is gone
+
+    # Conduit is read by the Conduit and the Strand and Poles stages, both run again after it was edited
+    resumed = journal.finished_stages("TEST", {**versions, "conduit": 2})
+    assert "total_ug1ft" not in resumed and "strand_calcfootage" not in resumed and "fp_count" in resumed
+    assert bom.run_stages(fdh_geometry, stages=set(), previous=resumed) == values
+
+    assert "fp_count" not in journal.finished_stages("TEST", {**versions, "structures": None})  # Unknown edits
+    assert journal.finished_stages("TEST", versions, moment=1000) == {}  # Read at another snapshot moment
+    assert journal.finished_stages("OTHER", versions) == {}
+    journal.close()
+
+
+def test_finished_batch_starts_over(bom, portal, fdh_geometry, tmp_path):
+    path = str(tmp_path / "BOM_Test_Journal.jsonl")
+    journaled_run(bom, fdh_geometry, path, {})
+    journal = bom.BatchJournal(path)
+    assert journal.events("stage", "TEST")
+    journal.write("finished")
+    journal.close()
+    assert bom.BatchJournal(path).records == []
@@ -0,0 +1,79 @@
+"""The BOM service (RUN_SERVICE) and its client (USE_SERVICE), served from the emulated Portal."""
+import socket
+import threading
+import time
+import urllib.error
+
+import pytest
+
+
+@pytest.fixture
+def service(portal, bom, monkeypatch):
+    """A BOM service of the emulated Portal on a free localhost port."""
+    import bom_service
+
+    service = bom_service.BOMService(bom, "fdh")
+    server = service.server(0)
+    monkeypatch.setattr(bom, "SERVICE_PORT", server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield service
+    server.shutdown()
+    server.server_close()
+
+
+def test_bom_of_one_fdh(service, bom, fdh_geometry):
+    import bom_service
+
+    assert bom_service.service_available(bom)
+    values, failed = bom_service.request_bom(bom, "test")
+    assert failed == []
+    expected = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert {name: values[name] for name in bom.stage_outputs()} == \
+        {name: expected[name] for name in bom.stage_outputs()}
+
+    with pytest.raises(urllib.error.HTTPError) as error:
+        bom_service.request_bom(bom, "NOPE")
+    assert error.value.code == 404
+
+
+def test_requests_keep_their_own_context(service, bom):
+    bom.bom_context().cab_id = "BATCH"
+    assert service.boms(["TEST"])["TEST"]["cab_id"] == "TEST"
+    assert bom.bom_context().cab_id == "BATCH"
+
+
+def test_interactive_request_goes_before_a_waiting_batch(service):
+    order = []
+
+    def step(priority):
+        with service.turn(priority):
+            order.append(priority)
+
+    with service.turn("batch"):
+        waiting = [threading.Thread(target=step, args=("batch",))]
+        waiting[0].start()
+        time.sleep(0.05)
+        waiting.append(threading.Thread(target=step, args=("interactive",)))
+        waiting[1].start()
+        time.sleep(0.05)
+    for thread in waiting:
+        thread.join()
+    assert order == ["interactive", "batch"]
+    assert not service.state["busy"] and not any(service.queue.values())
+
+
+@pytest.mark.parametrize("error, fallback", [
+    (urllib.error.URLError(ConnectionRefusedError(111, "Connection refused")), True),
+    (urllib.error.URLError(socket.timeout("timed out")), False),
+    (socket.timeout("timed out"), False),  # The service took longer than SERVICE_TIMEOUT to build the BOM
+])
+def test_bom_is_built_here_only_when_no_service_is_running(bom, monkeypatch, error, fallback):
+    import bom_service
+
+    def request_bom(*args):
+        raise error
+
+    monkeypatch.setattr(bom_service, "request_bom", request_bom)
+    monkeypatch.setattr(bom_service.arcpy, "GetParameterAsText", lambda index: "")
+    assert bom_service.run_with_service(bom, "TEST") is not fallback
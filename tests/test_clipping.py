@@ -0,0 +1,30 @@
+"""Clipping strand and conduit to the FDH boundary (CLIP_TO_FDH) with vectorized geodesic lengths."""
+import numpy as np
+import pytest
+from conftest import line, write_layers
+
+
+def test_inside_fractions_match_dense_sampling(bom):
+    random = np.random.default_rng(29)
+    polygon = bom.prepare_geometry({"rings": [[[0, 0], [100, 0], [100, 60], [40, 100], [0, 60], [0, 0]],
+                                              [[30, 30], [60, 30], [60, 50], [30, 30]]]})  # With a hole
+    segments = random.uniform(-20, 120, (300, 4))
+    fractions = bom.segment_inside_fractions(segments, polygon["segments"])
+
+    t = (np.arange(2000) + 0.5) / 2000
+    for segment, fraction in zip(segments, fractions):
+        samples = segment[:2] + t[:, None] * (segment[2:] - segment[:2])
+        assert fraction == pytest.approx(bom.points_in_polygon(samples, polygon["segments"]).mean(), abs=2e-3)
+
+
+def test_lines_crossing_the_fdh_are_counted_by_their_share_inside(bom, portal, fdh_geometry, monkeypatch):
+    write_layers(bom, portal.folder, {"strand": [({"calcfootage": 40, "reareasment": "N"}, line((80, 50), (120, 50))),
+                                                 ({"calcfootage": 30, "reareasment": "N"}, line((20, 50), (50, 50)))]})
+    monkeypatch.setattr(bom, "CLIP_TO_FDH", True)
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert values["strand_calcfootage"] == pytest.approx(30 + 40 / 2)
+
+    portal.layers.clear()
+    bom.reset_fdh_state()
+    monkeypatch.setattr(bom, "CLIP_TO_FDH", False)
+    assert bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")["strand_calcfootage"] == 30  # Only lines inside
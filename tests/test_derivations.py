@@ -0,0 +1,34 @@
+"""The BOM calculations as a graph of derived values (DERIVATIONS)."""
+import pytest
+
+
+@pytest.fixture
+def values(bom, portal, fdh_geometry):
+    """Source and derived values of the TEST FDH."""
+    return bom.graph_values(bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V"))
+
+
+def test_every_value_comes_after_its_inputs(bom):
+    order = bom.derivation_order()
+    assert set(order) == set(bom.DERIVATIONS)
+    for name in order:
+        assert all(order.index(source) < order.index(name) for source in bom.DERIVATIONS[name][0]
+                   if source in bom.DERIVATIONS)
+    assert {"strand_ftg", "total_strand_ftg", "tree_trimming", "lashing_wire"} <= bom.downstream(["strand_sag"])
+    assert "total_ug1ft" not in bom.downstream(["strand_sag"])
+
+
+def test_only_values_downstream_of_a_change_are_recomputed(bom, values):
+    assert values["total_strand_ftg"] == pytest.approx(200 * 1.1 + 25)
+    changed = bom.evaluate_derivations({**values, "strand_sag": 1.2, "ug_bom_miles": -1}, changed={"strand_sag"})
+    assert changed["strand_ftg"] == pytest.approx(240)
+    assert changed["lashing_wire"] == pytest.approx(round(265 * 1.5, 2))
+    assert changed["est_total_miles"] == round((240 + 140) / 5280, 2)
+    assert changed["ug_bom_miles"] == -1  # Not downstream of strand_sag, kept as it was
+
+
+def test_batch_matches_single_fdh(bom, values):
+    rows = [values, {**values, "total_ug1ft": 0, "strand_calcfootage": 0}]
+    batch = bom.evaluate_batch(rows)
+    assert batch[0]["percent_ae"] == pytest.approx(bom.evaluate_derivations(rows[0])["percent_ae"])
+    assert batch[1]["percent_ae"] == 0  # No footage at all: no division by zero
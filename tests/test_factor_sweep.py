@@ -0,0 +1,27 @@
+"""What-if sweeps of the BOM factors over cached FDHs (SWEEP_FACTORS)."""
+import pytest
+
+
+@pytest.fixture
+def graphs(bom, portal, fdh_geometry):
+    """Stored values of the TEST FDH and of a copy with more strand and conduit."""
+    values = bom.graph_values(bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V"))
+    return {"TEST": values, "MORE": {**values, "strand_calcfootage": 900, "total_ug1ft": 1000}}
+
+
+def test_every_scenario_matches_a_single_evaluation(bom, graphs):
+    grid = {"strand_sag": [1.0, 1.1, 1.25], "coupler_spacing_ft": [250, 300]}
+    scenarios, table = bom.sweep_factors(graphs, grid)
+    assert len(scenarios) == 6 and {"total_strand_ftg", "lashing_wire"} <= set(table)
+    assert "total_ug1ft" not in table  # Not moved by the swept factors
+
+    for i, scenario in enumerate(scenarios):
+        for j, values in enumerate(graphs.values()):
+            single = bom.evaluate_derivations({**values, **scenario})
+            for quantity, swept in table.items():
+                assert swept[i, j] == pytest.approx(single[quantity]), (scenario, quantity)
+
+
+def test_unknown_factor(bom, graphs):
+    with pytest.raises(ValueError, match="Unknown BOM factors: sag"):
+        bom.sweep_factors(graphs, {"sag": [1.0]})
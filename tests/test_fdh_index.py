@@ -0,0 +1,40 @@
+"""The local FDH boundary index (USE_FDH_INDEX) kept in step with the FDH layer."""
+import numpy as np
+import pytest
+from conftest import DESIGN, write_layers
+
+
+@pytest.fixture
+def local_db(bom, tmp_path, monkeypatch):
+    monkeypatch.setattr(bom, "LOCAL_DB", str(tmp_path / "bom_local.sqlite"))
+    monkeypatch.setattr(bom, "fdh_index", {})
+
+
+def test_boundaries_are_looked_up_locally(bom, portal, local_db):
+    assert bom.refresh_fdh_index(bom.fdh_boundary_id) == {"TEST"}
+    assert bom.fdhs_at_point(50, 50) == ["TEST"] and bom.fdhs_at_point(150, 50) == []
+    assert bom.fdhs_in_serv_area("sa1") == ["TEST"]
+    assert np.allclose(bom.fdh_index_feature("test").geometry["rings"], DESIGN["fdh"][0][1]["rings"], atol=1e-6)
+    assert bom.fdh_index_feature("OTHER") is None
+
+
+def test_edited_boundaries_are_pulled_into_the_index(bom, portal, local_db):
+    bom.refresh_fdh_index(bom.fdh_boundary_id)
+    assert bom.refresh_fdh_index(bom.fdh_boundary_id) == set()  # Nothing edited
+
+    moved = {"rings": [[[100, 0], [200, 0], [200, 100], [100, 100], [100, 0]]]}
+    write_layers(bom, portal.folder, {"fdh": [({"cab_id": "NEXT", "Serv_Area": "SA2"}, moved)]})
+    portal.layers.clear()
+    bom.portal_layers.clear()
+    assert bom.refresh_fdh_index(bom.fdh_boundary_id) == {"TEST", "NEXT"}  # TEST was replaced by NEXT
+    assert bom.fdhs_at_point(150, 50) == ["NEXT"] and bom.fdhs_at_point(50, 50) == []
+    assert bom.fdhs_in_serv_area("SA1") == []
+
+
+def test_fdh_is_found_without_a_portal_request(bom, portal, local_db, monkeypatch):
+    bom.refresh_fdh_index(bom.fdh_boundary_id)
+    monkeypatch.setattr(bom, "USE_FDH_INDEX", True)
+    requests = portal.request_count
+    object_id, geometry, cab_id, serv_area, city_code, const_ven = bom.find_fdh(bom.fdh_boundary_id, "TEST")
+    assert (object_id, cab_id, serv_area, city_code, const_ven) == (1, "TEST", "SA1", "CC", "V")
+    assert portal.request_count == requests
@@ -0,0 +1,62 @@
+"""The per-host concurrency and rate governor (GOVERN_REQUESTS)."""
+import threading
+import time
+from collections import defaultdict
+
+import pytest
+
+
+@pytest.fixture
+def governor(bom, monkeypatch):
+    """A fresh governor of a host answering without a rate limit, starting with four requests in flight."""
+    monkeypatch.setattr(bom, "GOVERN_REQUESTS", True)
+    monkeypatch.setattr(bom, "host_governors", {})
+    monkeypatch.setattr(bom, "query_latencies", defaultdict(list))
+    monkeypatch.setattr(bom, "INITIAL_CONCURRENCY", 4)
+    monkeypatch.setattr(bom, "HOST_RATE", 1000)
+    monkeypatch.setattr(bom, "HOST_BURST", 1000)
+    with bom.bom_run():
+        yield bom.host_governor("layer")
+
+
+def test_requests_in_flight_stay_within_the_limit(bom, governor, monkeypatch):
+    monkeypatch.setattr(bom, "MAX_CONCURRENCY", 4)
+    in_flight, peak, lock = [0], [0], threading.Lock()
+
+    def request():
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+
+    pending = [bom.start_request(bom.run_request, request, "layer") for _ in range(12)]
+    for future in pending:
+        future.result()
+    assert peak[0] == 4 and governor.state()["sent"] == 12
+    assert governor.state()["in_flight"] == 0
+
+
+def test_good_responses_raise_the_limit(bom, governor):
+    for _ in range(8):
+        governor.release(governor.acquire(), "layer", 0.01)
+    assert 5 < governor.limit < 6  # One more slot per limit's worth of good responses
+
+
+def test_congestion_backs_off_once_per_cooldown(bom, governor, monkeypatch):
+    monkeypatch.setattr(bom, "BACKOFF_COOLDOWN", 60)
+    for _ in range(2):
+        governor.release(governor.acquire(), "layer", 0.01, ConnectionError("Error code 429: Too Many Requests"))
+    state = governor.state()
+    assert (state["limit"], state["rate"], state["congested"], state["backoffs"]) == (2, 500, 2, 1)
+
+    governor.release(governor.acquire(), "layer", 0.01, ValueError("Error code 400: invalid where clause"))
+    assert governor.limit == 2  # Not a sign of congestion
+
+
+def test_batch_requests_leave_room_for_interactive_ones(bom, governor, monkeypatch):
+    monkeypatch.setattr(bom, "BATCH_SHARE", 0.5)
+    tickets = [governor.acquire("batch", block=False) for _ in range(3)]
+    assert tickets[2] is None  # Half of the four slots
+    assert governor.acquire("interactive", block=False) is not None
@@ -0,0 +1,35 @@
+"""Recomputing only the FDHs and stages touched by edits (INCREMENTAL_REFRESH)."""
+import pytest
+from conftest import DESIGN, point, write_layers
+
+
+@pytest.fixture
+def edit_sv_vault(bom, portal, tmp_path, monkeypatch):
+    """DESIGN with editor tracking on every layer, and a function editing the SV vault into an FP vault."""
+    monkeypatch.setattr(bom, "LOCAL_DB", str(tmp_path / "bom_local.sqlite"))
+    monkeypatch.setattr(bom, "fdh_index", {})
+    design = {item_id: [({**attributes, "EditDate": 1000}, geometry) for attributes, geometry in features]
+              for item_id, features in DESIGN.items()}
+    for item_id in ("active", "dnb"):  # Outside the FDH, they give the empty layers their fields
+        design[item_id].append(({"EditDate": 1000}, point(150, 150)))
+    write_layers(bom, portal.folder, design)
+
+    def edit_sv_vault():
+        edited = ({"structuretype": "FP", "EditDate": 2000}, point(70, 70))
+        write_layers(bom, portal.folder, {"structures": [design["structures"][0], edited]})
+        portal.layers.clear()
+        bom.portal_layers.clear()
+    return edit_sv_vault
+
+
+def test_only_the_edited_stage_is_run_again(bom, edit_sv_vault):
+    assert "TEST" in bom.refresh_changed_fdhs(bom.fdh_boundary_id)  # Every FDH is new
+    assert bom.refresh_changed_fdhs(bom.fdh_boundary_id) == {}
+
+    edit_sv_vault()
+    changes = bom.refresh_changed_fdhs(bom.fdh_boundary_id)
+    assert set(bom.bom_context().stage_timings) == {"Structures"}
+    assert ("Summary", "D79", "fp_count", 1, 2) in changes["TEST"]
+    assert ("Summary", "D74", "sv_count", 1, 0) in changes["TEST"]
+    assert {quantity for _, _, quantity, _, _ in changes["TEST"]} <= \
+        {"fp_count", "sv_count"} | bom.downstream(["fp_count", "sv_count"])
@@ -0,0 +1,20 @@
+"""Leaving the features inside MDU boundaries out of the BOM (EXCLUDE_MDU_FEATURES)."""
+
+
+def test_features_inside_mdus_are_left_out_locally(bom, portal, fdh_geometry, monkeypatch):
+    bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    bom.reset_fdh_state()
+    bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")  # The layers' properties are read in the first run
+    requests = dict(bom.bom_context().request_counts)
+
+    monkeypatch.setattr(bom, "EXCLUDE_MDU_FEATURES", True)
+    bom.reset_fdh_state()
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    # The SV vault, the poles, the strand and the long drop are inside the MDU, the FP vault and short drop are not
+    assert (values["fp_count"], values["sv_count"]) == (1, 0)
+    assert values["total_pole_count"] == 0 and values["strand_calcfootage"] == 0
+    assert values["drop_count"] == 1
+    assert values["total_hhp_mdu"] == 12  # The Addresses stage keeps every feature
+    assert values["mdu_comparison"]["sv_count"] == (1, 0)
+    # Re-aggregated from the features already fetched, with no more requests
+    assert bom.bom_context().request_counts == requests
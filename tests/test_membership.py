@@ -0,0 +1,55 @@
+"""The feature-to-FDH membership table (USE_MEMBERSHIP_TABLE) and attribute-only reads by OBJECTID."""
+import pytest
+from conftest import FDH_RING, point, write_layers
+
+
+@pytest.fixture
+def local_db(bom, tmp_path, monkeypatch):
+    monkeypatch.setattr(bom, "LOCAL_DB", str(tmp_path / "bom_local.sqlite"))
+    monkeypatch.setattr(bom, "fdh_index", {})
+
+
+def test_features_are_read_by_objectid(bom, portal, local_db, fdh_geometry, monkeypatch):
+    expected = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert bom.membership_object_ids("structures", "TEST") is None  # Not synced yet
+
+    affected = bom.sync_membership(bom.fdh_boundary_id)
+    assert "structures" in affected["TEST"]
+    assert bom.membership_object_ids("structures", "TEST") == [1, 2]
+    assert bom.membership_object_ids("structures", "OTHER") is None
+
+    sent = []
+    monkeypatch.setattr(bom, "query_intersecting", lambda *args, **kwargs: sent.append(args))
+    monkeypatch.setattr(bom, "USE_MEMBERSHIP_TABLE", True)
+    monkeypatch.setattr(bom, "PLAN_QUERIES", True)
+    bom.reset_fdh_state()
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert not sent  # No spatial query at all
+    assert {name: values[name] for name in bom.stage_outputs()} == \
+        {name: expected[name] for name in bom.stage_outputs()}
+
+
+def test_sync_follows_edits(bom, portal, local_db):
+    def edit_sv_vault(edit_date, location):
+        write_layers(bom, portal.folder, {"structures": [({"structuretype": "FP", "EditDate": 1000}, point(5, 5)),
+                                                         ({"structuretype": "SV", "EditDate": edit_date},
+                                                          point(*location))]})
+        portal.layers.clear()
+        bom.portal_layers.clear()
+
+    edit_sv_vault(1000, (70, 70))
+    assert bom.sync_membership(bom.fdh_boundary_id, item_ids=["structures"]) == {"TEST": {"fdh", "structures"}}
+    assert bom.sync_membership(bom.fdh_boundary_id, item_ids=["structures"]) == {}  # Nothing edited since
+
+    edit_sv_vault(2000, (170, 70))
+    assert bom.sync_membership(bom.fdh_boundary_id, item_ids=["structures"]) == {"TEST": {"structures"}}
+    assert bom.membership_object_ids("structures", "TEST") == [1]  # Moved out of the FDH
+
+
+def test_cab_ids_are_matched_in_any_case(bom, portal, local_db, fdh_geometry, monkeypatch):
+    write_layers(bom, portal.folder, {"fdh": [({"cab_id": "Test", "Serv_Area": "SA1"}, {"rings": [FDH_RING]})]})
+    bom.sync_membership(bom.fdh_boundary_id)
+    assert bom.membership_object_ids("structures", "TEST") == bom.membership_object_ids("structures", "test") == [1, 2]
+
+    monkeypatch.setattr(bom, "USE_FDH_INDEX", True)
+    assert bom.find_fdh(bom.fdh_boundary_id, "TEST")[2] == "Test"  # The cab_id as stored
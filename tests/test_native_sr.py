@@ -0,0 +1,36 @@
+"""Queries sent in the layer's own spatial reference (NATIVE_SR_QUERIES) and projected locally."""
+import numpy as np
+import pytest
+
+
+def test_web_mercator_projection_round_trips(bom):
+    line = {"paths": [[[-9000000.5, 4000000.25], [-8999000, 4001000]]], "spatialReference": {"wkid": 102100}}
+    geographic = bom.project_geometry(line, 102100, 4326)
+    assert geographic["spatialReference"] == {"wkid": 4326}
+    assert geographic["paths"][0][0] == pytest.approx([-80.84838, 33.78523], abs=1e-5)
+    assert np.allclose(bom.project_geometry(geographic, 4326, 3857)["paths"], line["paths"], rtol=0, atol=1e-6)
+    assert bom.project_geometry(line, 102100, {"wkid": 102100, "latestWkid": 3857}) is line  # Same reference
+
+
+def test_query_and_features_are_projected_locally(bom, portal, fdh_geometry, monkeypatch):
+    expected = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    layer = portal.content.get("structures").layers[0]
+    sent = []
+
+    def query(**query_kwargs):
+        sent.append(query_kwargs)
+        return layer_query(**query_kwargs)
+
+    layer_query = layer.query
+    monkeypatch.setattr(layer, "query", query)
+    monkeypatch.setitem(bom.layer_wkids, "structures", 4326)  # As if the layer stored its features in WGS84
+    monkeypatch.setattr(bom, "NATIVE_SR_QUERIES", True)
+    bom.reset_fdh_state()
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+
+    assert (values["fp_count"], values["sv_count"]) == (expected["fp_count"], expected["sv_count"]) == (1, 1)
+    assert sent and all(query_kwargs["out_sr"] == 4326 for query_kwargs in sent)
+    assert all(query_kwargs["geometry_filter"]["inSR"] == 4326 for query_kwargs in sent)
+    features = bom.query_layer("structures", "Structures", geometry_filter=bom.filters.contains(fdh_geometry),
+                               out_fields="structuretype").features
+    assert features[1].geometry["x"] == pytest.approx(70, abs=1e-6)  # Back in JOIN_SR
@@ -0,0 +1,36 @@
+"""Record / replay of the Portal requests of a run (CASSETTE_MODE)."""
+import pytest
+
+
+def test_request_key_ignores_the_snapshot_moment():
+    portal_cassette = pytest.importorskip("portal_cassette")
+    assert portal_cassette.request_key("conduit", {"where": "1=1", "historic_moment": 1}) == \
+        portal_cassette.request_key("conduit", {"where": "1=1"})
+
+
+def test_replayed_bom_matches_the_recorded_one(portal, bom, fdh_geometry, tmp_path, monkeypatch):
+    monkeypatch.setattr(bom, "CASSETTE_PATH", str(tmp_path / "run.json.gz"))
+    monkeypatch.setattr(bom, "CASSETTE_MODE", "record")
+    monkeypatch.setattr(bom, "cassette", None)
+    recorded = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    bom.run_cassette().save()
+    requests = len(bom.cassette.records["requests"])
+
+    # Portal is gone, every answer comes from the cassette
+    monkeypatch.setattr(bom, "gis", None)
+    monkeypatch.setattr(bom, "CASSETTE_MODE", "replay")
+    monkeypatch.setattr(bom, "REPLAY_LATENCY_SCALE", 0)
+    monkeypatch.setattr(bom, "cassette", None)
+    bom.portal_layers.clear()
+    bom.reset_fdh_state()
+    replayed = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert not replayed["failed_stages"]
+    assert {name: replayed[name] for name in bom.stage_outputs()} == \
+        {name: recorded[name] for name in bom.stage_outputs()}
+    assert bom.cassette.replayed == requests
+
+    with pytest.raises(bom.LayerQueryError, match="not in the cassette"):
+        bom.query_layer("conduit", "Conduit", where="UG1FT > 1000")
+    bom.portal_layers.clear()
+    assert bom.get_portal_layer("unrecorded", "Conduit") is None
+    assert "Conduit" in bom.bom_context().failed_stages
@@ -0,0 +1,58 @@
+"""The local Portal emulator (EMULATOR_DIR) and a whole BOM read from it."""
+import pytest
+
+
+def test_where_clauses_are_rewritten_for_sqlite():
+    portal_emulator = pytest.importorskip("portal_emulator")
+    assert portal_emulator.emulator_where("TRIM(BOTH ' ' FROM type) = 'x'") == "TRIM(type, ' ') = 'x'"
+    assert portal_emulator.emulator_where("EditDate > TIMESTAMP '2025-01-02 03:04:05'") == "EditDate > 1735787045000"
+    assert portal_emulator.emulator_where(None) == "1=1"
+
+
+def test_layer_query_api(portal, bom, monkeypatch):
+    conduit = portal.content.get("conduit").layers[0]
+    assert conduit.query(where="1=1", return_count_only=True) == 2
+    assert conduit.query(return_ids_only=True)["objectIds"] == [1, 2]
+    totals = conduit.query(out_statistics=[{"statisticType": "sum", "onStatisticField": "UG1FT",
+                                            "outStatisticFieldName": "total"}],
+                           group_by_fields_for_statistics="reareasment")
+    assert {row.attributes["reareasment"]: row.attributes["total"] for row in totals.features} == {"Y": 100, "N": 40}
+    assert portal.content.get("missing") is None
+    with pytest.raises(ValueError, match="invalid where clause"):
+        conduit.query(where="nope=1")
+
+    monkeypatch.setattr(bom, "EMULATOR_MAX_RECORD_COUNT", 1)
+    paged = portal.content.get("structures").layers[0]
+    before = portal.request_count
+    assert len(paged.query(where="1=1").features) == 2
+    assert portal.request_count - before == 2  # One request per page of maxRecordCount
+
+
+def test_spatial_filter_in_join_sr(portal, bom):
+    conduit = portal.content.get("conduit").layers[0]
+    envelope = {"geometry": {"rings": [[[0, 0], [20, 0], [20, 60], [0, 60], [0, 0]]],
+                             "spatialReference": {"wkid": bom.JOIN_SR}},
+                "spatialRel": "esriSpatialRelEnvelopeIntersects"}
+    assert [feature.attributes["UG1FT"] for feature in conduit.query(geometry_filter=envelope).features] == [100]
+
+
+def test_bom_from_emulated_portal(portal, bom, fdh_geometry):
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert not values["failed_stages"]
+    assert values["total_ug1ft"] == 140
+    assert values["fp_count"] == 1 and values["sv_count"] == 1
+    assert values["drop_count"] == 2 and values["count_over_600ft"] == 1
+    assert values["total_f1"] == 550 and values["total_f2"] == 320
+    assert values["total_hhp_mdu"] == 12
+
+
+def test_injected_errors_are_retried(portal, bom, fdh_geometry, monkeypatch):
+    expected = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    monkeypatch.setattr(bom, "EMULATOR_ERROR_RATE", 0.2)
+    monkeypatch.setattr(bom, "QUERY_RETRIES", 10)
+    monkeypatch.setattr(bom, "QUERY_BACKOFF", 0)
+    bom.portal_layers.clear()
+    bom.reset_fdh_state()
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert {name: values[name] for name in bom.stage_outputs()} == \
+        {name: expected[name] for name in bom.stage_outputs()}
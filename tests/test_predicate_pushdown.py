@@ -0,0 +1,36 @@
+"""Status, loop type and placement filters sent with the query (stage_query) and re-checked locally."""
+import pytest
+from conftest import DESIGN, point, write_layers
+
+
+def test_local_check_agrees_with_the_where_clause(bom):
+    predicates = [bom.attribute_predicate("type", ["Maintenance Loop"]),
+                  bom.attribute_predicate("Status", ["Existing"], exclude=True)]
+    where = bom.compile_where(predicates)
+    assert where == ("UPPER(TRIM(BOTH ' ' FROM type)) IN ('MAINTENANCE LOOP') AND "
+                     "(Status IS NULL OR UPPER(TRIM(BOTH ' ' FROM Status)) NOT IN ('EXISTING'))")
+    assert bom.matches_predicates({"type": " maintenance loop", "Status": None}, predicates)
+    assert bom.matches_predicates({"TYPE": "Maintenance Loop", "status": "Proposed"}, predicates)
+    assert not bom.matches_predicates({"type": "Maintenance Loop", "Status": "existing "}, predicates)
+    assert not bom.matches_predicates({"type": "Storage Loop"}, predicates)
+
+
+@pytest.mark.parametrize("plan_queries", [False, True])
+def test_existing_features_are_left_out(bom, portal, fdh_geometry, monkeypatch, plan_queries):
+    design = {item_id: [({**attributes, "Status": "Proposed"}, geometry) for attributes, geometry in features]
+              for item_id, features in DESIGN.items()}
+    design["structures"] = [({"structuretype": "FP", "Status": "Proposed"}, point(5, 5)),
+                            ({"structuretype": "FP", "Status": "Existing"}, point(6, 6)),
+                            ({"structuretype": "SV", "Status": None}, point(70, 70))]
+    design["riser"].append(({"riser": 2, "Status": " existing"}, point(71, 71)))
+    design["active"].append(({"Cab_Size": "A", "Status": "Proposed"}, point(150, 150)))  # Gives the layer its fields
+    write_layers(bom, portal.folder, design)
+    monkeypatch.setattr(bom, "PLAN_QUERIES", plan_queries)
+    assert bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")["fp_count"] == 2
+
+    portal.layers.clear()
+    bom.reset_fdh_state()
+    monkeypatch.setattr(bom, "EXCLUDE_EXISTING", True)
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert (values["fp_count"], values["sv_count"]) == (1, 1)
+    assert values["total_risers"] == 1 and not values["failed_stages"]
@@ -0,0 +1,44 @@
+"""The query planner (PLAN_QUERIES) reading each layer once per FDH for every stage."""
+
+
+def test_each_layer_is_read_once_per_fdh(bom, portal, fdh_geometry, monkeypatch):
+    bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    bom.reset_fdh_state()
+    expected = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert bom.bom_context().request_counts["conduit"] == 2  # Read by the Conduit and the Strand and Poles stages
+
+    monkeypatch.setattr(bom, "PLAN_QUERIES", True)
+    bom.reset_fdh_state()
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert set(bom.bom_context().request_counts.values()) == {1}
+    assert {name: values[name] for name in bom.stage_outputs()} == \
+        {name: expected[name] for name in bom.stage_outputs()}
+
+
+def test_queries_the_plan_cannot_answer_are_sent(bom, portal, fdh_geometry):
+    bom.prefetch_fdh_layers(fdh_geometry, "TEST")
+    requests = bom.bom_context().request_counts
+    read = requests["structures"]
+    contains = bom.filters.contains(fdh_geometry)
+    view = bom.query_layer(bom.structures_id, "Structures", geometry_filter=contains, out_fields="structuretype")
+    assert len(view.features) == 2 and requests["structures"] == read  # From the plan
+
+    bom.query_layer(bom.structures_id, "Structures", geometry_filter=contains, out_fields="*")
+    bom.query_layer(bom.structures_id, "Structures", where="structuretype = 'FP'", geometry_filter=contains,
+                    out_fields="structuretype")
+    assert requests["structures"] == read + 2  # Fields and a where clause it did not read
+
+
+def test_stages_send_the_reads_the_plan_lists(bom, portal, fdh_geometry, monkeypatch):
+    query_layer = bom.query_layer
+    sent = []
+
+    def record(item_id, stage, **query_kwargs):
+        sent.append((stage, item_id, query_kwargs.get("out_fields"), query_kwargs.get("where")))
+        return query_layer(item_id, stage, **query_kwargs)
+
+    monkeypatch.setattr(bom, "query_layer", record)
+    bom.build_bom_values(fdh_geometry, "TEST", "SA1", "CC", "V")
+    listed = {(stage, item_id, out_fields, bom.compile_where(predicates))
+              for stage, item_id, out_fields, _, predicates in bom.stage_reads()}
+    assert set(sent) == listed
@@ -0,0 +1,92 @@
+"""Pricing BOMs from the BOM Template's rate cards (RateCards)."""
+import numpy as np
+import openpyxl
+import pytest
+from openpyxl.worksheet.datavalidation import DataValidation
+
+VENDORS = ["Thayer", "LeeComm"]
+LINES = {"RateCard": {"UG1": "total_ug1ft", "FP": "fp_count", "STR": "total_strand_ftg"},
+         "RateCard_E": {"ENG": "total_linear_footage", "EPM": "e_epmrt_1"}}
+RATES = {"RateCard": [("UG1", [10, 11.5]), ("FP", ["$120.00", 110]), ("STR", [1.1, "n/a"]), ("Labor", [None])],
+         "RateCard_E": [("ENG", [0.3, 0.35]), ("EPM", [95, 100])]}
+
+
+@pytest.fixture
+def write_template(bom, tmp_path, monkeypatch):
+    """Writes a BOM Template with two rate cards, vendors offered as a list on one and a cell range on the other.
+    The template was last calculated with 100 ft of UG1, 3 FP vaults and 1000 ft of engineering for Thayer."""
+    monkeypatch.setattr(bom, "RATE_CARD_LINES", LINES)
+    monkeypatch.setattr(bom, "RATE_CARD_TOTAL_CELLS", {"RateCard": "Summary!H1", "RateCard_E": "'Summary'!H2"})
+    monkeypatch.setattr(bom, "cost_models", {})
+
+    def write_template(rates=RATES, totals=(1360, 300)):
+        workbook = openpyxl.Workbook()
+        summary = workbook.active
+        summary.title = "Summary"
+        summary[bom.SUMMARY_CELLS["total_ug1ft"][0]] = 100
+        summary[bom.SUMMARY_CELLS["fp_count"][0]] = 3
+        summary["H1"], summary["H2"] = totals
+        workbook.create_sheet("Engineering")[bom.ENGINEERING_CELLS["total_linear_footage"][0]] = 1000
+        for rate_sheet, lines in rates.items():
+            sheet = workbook.create_sheet(rate_sheet)
+            sheet["E2"] = VENDORS[0]
+            for column, vendor in enumerate(VENDORS, start=3):
+                sheet.cell(3, column, vendor)
+            for row, (item, item_rates) in enumerate(lines, start=4):
+                sheet.cell(row, 1, item)
+                for column, rate in enumerate(item_rates, start=3):
+                    sheet.cell(row, column, rate)
+        for rate_sheet, choices in (("RateCard", f'"{",".join(VENDORS)}"'), ("RateCard_E", "=$C$3:$D$3")):
+            validation = DataValidation(type="list", formula1=choices)
+            workbook[rate_sheet].add_data_validation(validation)
+            validation.add("E2")
+        path = tmp_path / "BOM_Template.xlsx"
+        workbook.save(path)
+        return str(path)
+    return write_template
+
+
+def test_lines_are_priced_per_vendor(bom, write_template):
+    model = bom.RateCards(write_template())
+    assert model.vendors == {"RateCard": VENDORS, "RateCard_E": VENDORS}
+
+    costs = model.price([{"total_ug1ft": 100, "fp_count": 3, "total_linear_footage": 1000, "e_epmrt_1": 2}])
+    items = costs["RateCard"]["items"]
+    ug1 = costs["RateCard"]["lines"][items.index("UG1")]
+    assert ug1[:, 0].tolist() == [1000, 1150]
+    assert costs["RateCard"]["lines"][items.index("FP"), 0, 0] == 360  # "$120.00" is read as a rate
+    assert costs["RateCard_E"]["totals"][:, 0].tolist() == pytest.approx([490, 550])
+
+
+def test_a_line_without_a_rate_is_unpriced_not_zero(bom, write_template):
+    model = bom.RateCards(write_template())
+    costs = model.price([{"total_strand_ftg": 200}, {"total_strand_ftg": 0}],
+                        {"RateCard": ["leecomm"], "RateCard_E": ["Thayer"]})
+    cost = costs["RateCard"]
+    strand = cost["items"].index("STR")
+    assert np.isnan(cost["lines"][strand, 0, 0]) and cost["unpriced"][strand, 0, 0]
+    assert cost["lines"][strand, 0, 1] == 0 and not cost["unpriced"][strand, 0, 1]  # Nothing to price
+    unpriced = model.unpriced_lines("RateCard", cost, 0)
+    assert "STR (no leecomm rate)" in unpriced
+    assert "UG1 (no total_ug1ft quantity)" in unpriced
+
+
+@pytest.mark.parametrize("rates, error", [
+    ({**RATES, "RateCard": RATES["RateCard"][1:]}, "UG1 not on the rate card"),
+    ({**RATES, "RateCard_E": RATES["RateCard_E"] + [("PERMIT", [40, 45])]}, "PERMIT priced on the rate card"),
+])
+def test_rate_cards_must_list_the_same_line_items(bom, write_template, rates, error):
+    with pytest.raises(bom.CostError, match=error):
+        bom.RateCards(write_template(rates))
+
+
+def test_totals_must_match_the_templates(bom, write_template):
+    with pytest.raises(bom.CostError, match=r"at \$300.00 but 'Summary'!H2 totals \$290.00"):
+        bom.RateCards(write_template(totals=(1360, 290)))
+    with pytest.raises(bom.CostError, match="Summary!H1 holds no total"):
+        bom.RateCards(write_template(totals=(None, 300)))
+
+
+def test_unknown_vendor(bom, write_template):
+    with pytest.raises(bom.CostError, match="not on the 'RateCard' rate card"):
+        bom.RateCards(write_template()).price([{}], {"RateCard": ["Nobody"]})
@@ -0,0 +1,59 @@
+"""Per-layer timeouts, retries and hedged requests of run_request."""
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def requests(bom, monkeypatch):
+    """A fresh BOM context with no backoff between retries, its request counts per layer."""
+    monkeypatch.setattr(bom, "QUERY_BACKOFF", 0)
+    monkeypatch.setattr(bom, "GOVERN_REQUESTS", False)
+    with bom.bom_run() as context:
+        yield context.request_counts
+
+
+def test_transient_errors_are_retried(bom, requests):
+    errors = [ConnectionError("Error code 503: Service Unavailable"), TimeoutError("timed out")]
+
+    def flaky():
+        if errors:
+            raise errors.pop(0)
+        return "features"
+
+    assert bom.run_request(flaky, "flaky") == "features"
+    assert requests["flaky"] == 3
+
+
+def test_other_errors_and_timeouts_fail_the_layer(bom, requests, monkeypatch):
+    def invalid():
+        raise ValueError("Error code 400: invalid where clause")
+
+    with pytest.raises(bom.LayerQueryError, match="invalid where clause"):
+        bom.run_request(invalid, "invalid")
+    assert requests["invalid"] == 1  # Not worth retrying
+
+    released = threading.Event()
+    monkeypatch.setattr(bom, "LAYER_TIMEOUTS", {"slow": 0.05})
+    monkeypatch.setattr(bom, "QUERY_RETRIES", 1)
+    with pytest.raises(bom.LayerQueryError, match="no response within 0.05s"):
+        bom.run_request(released.wait, "slow", 5)
+    released.set()
+    assert requests["slow"] == 2
+
+
+def test_slow_request_is_hedged(bom, requests, monkeypatch):
+    monkeypatch.setattr(bom, "HEDGE_REQUESTS", True)
+    monkeypatch.setitem(bom.query_latencies, "hedged", [0.01] * bom.HEDGE_MIN_SAMPLES)
+    calls = []
+
+    def first_call_hangs():
+        calls.append(None)
+        if len(calls) == 1:
+            time.sleep(1)
+            return "late"
+        return "hedge"
+
+    assert bom.run_request(first_call_hangs, "hedged") == "hedge"
+    assert requests["hedged"] == 2
@@ -0,0 +1,48 @@
+"""City_Code / Serv_Area / market rollups of recorded BOMs (UPDATE_ROLLUPS)."""
+import pytest
+
+
+@pytest.fixture
+def local_db(bom, tmp_path, monkeypatch):
+    monkeypatch.setattr(bom, "LOCAL_DB", str(tmp_path / "bom_local.sqlite"))
+    monkeypatch.setattr(bom, "UPDATE_ROLLUPS", True)
+
+
+def record(bom, cab_id, serv_area, **quantities):
+    connection = bom.open_local_db()
+    try:
+        bom.insert_run(connection, {"cab_id": cab_id, "serv_area": serv_area, "city_code": "CC", "failed_stages": [],
+                                    **quantities}, timings={})
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def test_rollups_follow_the_latest_run_of_each_fdh(bom, local_db):
+    record(bom, "A1", "SA1", total_f1=2640, strand_ftg=300, total_ug1ft=100, drop_count=4)
+    record(bom, "A2", "SA1", total_f1=2640, strand_ftg=100, total_ug1ft=300, drop_count=6)
+    record(bom, "B1", "SA2", total_f1=5280, strand_ftg=0, total_ug1ft=0, drop_count=1)
+
+    serv_area = bom.rollup("CC", "SA1")
+    assert serv_area["fdh_count"] == 2 and serv_area["drop_count"] == 10
+    # Miles and shares are derived from the summed footage, not summed from each FDH's rounded values
+    assert serv_area["total_f1_miles"] == 1.0
+    assert serv_area["percent_ae"] == 50.0
+    assert bom.rollup()["fdh_count"] == 3 and bom.rollup()["total_f1_miles"] == 2.0
+
+    record(bom, "A2", "SA2", total_f1=0, strand_ftg=0, total_ug1ft=0, drop_count=2)  # A2 moved and was rebuilt
+    assert bom.rollup("CC", "SA1")["drop_count"] == 4 and bom.rollup("CC", "SA1")["fdh_count"] == 1
+    assert bom.rollup("CC", "SA2")["drop_count"] == 3
+    assert bom.rollup("CC")["drop_count"] == 7 and bom.rollup(cab_id="A2")["drop_count"] == 2
+
+
+def test_incomplete_runs_are_left_out(bom, local_db):
+    record(bom, "A1", "SA1", drop_count=4)
+    connection = bom.open_local_db()
+    try:
+        bom.insert_run(connection, {"cab_id": "A1", "serv_area": "SA1", "city_code": "CC", "drop_count": 0,
+                                    "failed_stages": ["Drops"]}, timings={})
+        connection.commit()
+    finally:
+        connection.close()
+    assert bom.rollup("CC", "SA1")["drop_count"] == 4
@@ -0,0 +1,32 @@
+"""The history of recorded runs (RECORD_RUNS), its latest-run lookups and diffs."""
+import pytest
+
+
+@pytest.fixture
+def history(bom, portal, fdh_geometry, tmp_path, monkeypatch):
+    """Two recorded runs of TEST, the second with a higher strand sag, and a failed run of OTHER."""
+    monkeypatch.setattr(bom, "LOCAL_DB", str(tmp_path / "bom_local.sqlite"))
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    bom.record_run(values, "Thayer", "LeeComm")
+    bom.record_run(bom.evaluate_derivations({**values, "strand_sag": 1.2}, changed={"strand_sag"}))
+    bom.record_run({**values, "cab_id": "OTHER", "failed_stages": {"Drops": "timed out"}})
+    return values
+
+
+def test_latest_runs(bom, history):
+    runs = bom.latest_runs("SA1")
+    assert list(runs) == ["TEST"] and runs["TEST"]["run_id"] == 2  # OTHER is incomplete
+    assert runs["TEST"]["values"]["strand_sag"] == 1.2
+    assert runs["TEST"]["values"]["stale_lengths"] == []  # Stored as JSON
+    assert list(bom.latest_runs("SA1", complete_only=False)) == ["OTHER", "TEST"]
+    assert bom.latest_runs("SA2") == {} and bom.latest_runs(city_code="CC").keys() == {"TEST"}
+
+
+def test_diff_of_the_last_two_runs(bom, history):
+    older_run_id, newer_run_id, differences = bom.diff_runs("TEST")
+    assert (older_run_id, newer_run_id) == (1, 2)
+    changed = {key: (old, new) for key, old, new in differences}
+    assert changed["strand_sag"] == (1.1, 1.2)
+    assert changed["strand_ftg"] == (pytest.approx(220), pytest.approx(240))
+    assert "total_ug1ft" not in changed
+    assert bom.diff_runs("OTHER") == (None, None, [])  # Only one run
@@ -0,0 +1,18 @@
+"""Large layer reads split into OBJECTID-range shards read in parallel (SHARD_READS)."""
+from conftest import point, write_layers
+
+
+def test_shards_return_the_features_of_one_read_in_order(bom, portal, fdh_geometry, monkeypatch):
+    poles = [({"MR_Level": x % 3}, point(x, 50 if x < 100 else 150)) for x in range(1, 200, 4)]
+    write_layers(bom, portal.folder, {"poles": poles})
+    query_kwargs = dict(where="MR_Level IN (1, 2)", geometry_filter=bom.filters.intersects(fdh_geometry),
+                        out_fields="OBJECTID, MR_Level")
+    expected = [feature.attributes for feature in bom.query_layer("poles", "Strand and Poles", **query_kwargs).features]
+
+    monkeypatch.setattr(bom, "SHARD_READS", True)
+    monkeypatch.setattr(bom, "SHARD_SIZE", 4)
+    monkeypatch.setattr(bom, "SHARDED_LAYERS", {"poles"})
+    bom.reset_fdh_state()
+    sharded = [feature.attributes for feature in bom.query_layer("poles", "Strand and Poles", **query_kwargs).features]
+    assert sharded == expected and len(expected) == 17
+    assert bom.bom_context().request_counts["poles"] == 1 + 5  # The OBJECTIDs, then a read per shard of 4
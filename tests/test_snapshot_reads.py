@@ -0,0 +1,58 @@
+"""Every layer read of one BOM pinned to one moment (SNAPSHOT_READS)."""
+import pytest
+from conftest import point, write_layers
+
+EDITED_AT = 1_700_000_000_000  # Epoch ms of the last edit to the structures
+
+
+@pytest.fixture
+def edit_sv_vault(bom, portal, monkeypatch):
+    """Editor tracking on the structures only, and a function editing the SV vault into an FP vault at a moment."""
+    monkeypatch.setattr(bom, "SNAPSHOT_READS", True)
+
+    def write_structures(sv_vault_type, edit_date):
+        write_layers(bom, portal.folder, {"structures": [
+            ({"structuretype": "FP", "EditDate": EDITED_AT}, point(5, 5)),
+            ({"structuretype": sv_vault_type, "EditDate": edit_date}, point(70, 70))]})
+        portal.layers.pop("structures", None)
+        bom.portal_layers.pop("structures", None)
+
+    write_structures("SV", EDITED_AT)
+    return lambda edit_date: write_structures("FP", edit_date)
+
+
+@pytest.fixture
+def builds(bom, edit_sv_vault, monkeypatch):
+    """Values of every build of a BOM, the SV vault is edited a minute after the snapshot moment during the first."""
+    build_fdh_bom = bom.build_fdh_bom
+    builds = []
+
+    def edited_during_first_build(*args):
+        builds.append(build_fdh_bom(*args))
+        if len(builds) == 1:
+            edit_sv_vault(EDITED_AT + 60_000)
+        return builds[-1]
+
+    monkeypatch.setattr(bom, "build_fdh_bom", edited_during_first_build)
+    return builds
+
+
+def test_bom_is_read_at_the_newest_edit(bom, edit_sv_vault, fdh_geometry):
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert values["snapshot"]["moment_ms"] == EDITED_AT
+    assert values["snapshot"]["local"] == ["structures"]  # Checked for edits after the moment
+    assert "conduit" in values["snapshot"]["unchecked"] and values["snapshot"]["edited_during_read"] == []
+
+
+def test_bom_edited_while_it_was_read_is_read_again(bom, builds, fdh_geometry):
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert len(builds) == 2 and builds[0]["sv_count"] == 1
+    assert (values["fp_count"], values["sv_count"]) == (2, 0)
+    assert values["snapshot"]["moment_ms"] == EDITED_AT + 60_000 and values["snapshot"]["edited_during_read"] == []
+
+
+def test_edit_is_reported_when_no_retry_is_left(bom, builds, fdh_geometry, monkeypatch):
+    monkeypatch.setattr(bom, "SNAPSHOT_RETRIES", 0)
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert len(builds) == 1 and values["sv_count"] == 1
+    assert values["snapshot"]["edited_during_read"] == ["structures"]
@@ -0,0 +1,38 @@
+"""Local spatial joins over the STR-packed R-tree (FeatureIndex)."""
+import copy
+
+import numpy as np
+from conftest import line, point, write_layers
+
+
+def test_index_matches_brute_force(bom):
+    random = np.random.default_rng(27)
+    points = [{"x": float(x), "y": float(y)} for x, y in random.uniform(0, 1000, (500, 2))]
+    index = bom.FeatureIndex(points)
+    polygon = {"rings": [[[100, 100], [600, 150], [400, 700], [100, 100]]]}
+    prepared = bom.prepare_geometry(polygon)
+    inside = bom.points_in_polygon(np.array([[point["x"], point["y"]] for point in points]), prepared["segments"])
+    assert sorted(index.query(polygon, "contains")) == np.flatnonzero(inside).tolist()
+
+    center = {"x": 500, "y": 500}
+    near = [i for i, point in enumerate(points) if np.hypot(point["x"] - 500, point["y"] - 500) <= 50]
+    assert sorted(index.query(center, "within_distance", 50)) == near
+    assert len(bom.FeatureIndex([])) == 0 and bom.FeatureIndex([]).contains(polygon) == []
+
+
+def test_stages_join_locally_with_one_read_per_layer(bom, portal, fdh_geometry):
+    """Poles are joined to the strand spans of the FDH locally, more spans take no more Portal requests."""
+    bom.run_fdh_bom(copy.deepcopy(fdh_geometry), "TEST", "SA1", "CC", "V")
+    requests = dict(bom.bom_context().request_counts)
+
+    spans = [({"calcfootage": 10, "reareasment": "N"}, line((x, 20), (x + 4, 20))) for x in range(5, 85, 4)]
+    poles = [({"MR_Level": 3 if x in (5, 85) else 1}, point(x, 20)) for x in range(5, 89, 4)]
+    write_layers(bom, portal.folder, {"strand": spans, "poles": poles + [({"MR_Level": 1}, point(150, 20))]})
+    portal.layers.clear()
+    bom.portal_layers.clear()
+    bom.reset_fdh_state()
+    values = bom.run_fdh_bom(copy.deepcopy(fdh_geometry), "TEST", "SA1", "CC", "V")
+    # A pole is counted once per strand span it is on, as the per-span queries did; the one outside the FDH is not
+    assert values["total_pole_count"] == 2 * len(spans) and values["strand_calcfootage"] == 10 * len(spans)
+    assert values["mr_filtered_pole_count"] == 2 * len(spans) - 2  # Both end poles are on one span each
+    assert bom.bom_context().request_counts == requests
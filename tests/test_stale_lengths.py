@@ -0,0 +1,26 @@
+"""Stored footage checked against the geodesic length of the geometry (VALIDATE_LENGTHS)."""
+import pytest
+from conftest import line, write_layers
+
+
+@pytest.fixture
+def strand(bom, portal, monkeypatch):
+    """A strand span stored with the footage of its geometry and one stored at 200 ft for 20 m of strand."""
+    write_layers(bom, portal.folder, {"strand": [({"calcfootage": 200, "reareasment": "N"}, line((70, 70), (90, 70))),
+                                                 ({"calcfootage": 100, "reareasment": "N"}, line((10, 20), (40, 20)))]})
+    monkeypatch.setattr(bom, "LENGTH_FIELDS", {"strand": ("Strand", "calcfootage")})
+    monkeypatch.setattr(bom, "VALIDATE_LENGTHS", True)
+
+
+def test_stale_footage_is_reported(bom, strand, fdh_geometry):
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert list(values["stale_lengths"]) == [("Strand", 1)]
+    stored, geodesic = values["stale_lengths"][("Strand", 1)]
+    assert stored == 200 and geodesic == pytest.approx(20 * bom.FEET_PER_METER, rel=1e-3)
+    assert values["strand_calcfootage"] == 300  # Stored footage is used unless USE_RECOMPUTED_LENGTHS is set
+
+
+def test_recomputed_lengths_replace_stale_footage(bom, strand, fdh_geometry, monkeypatch):
+    monkeypatch.setattr(bom, "USE_RECOMPUTED_LENGTHS", True)
+    values = bom.run_fdh_bom(fdh_geometry, "TEST", "SA1", "CC", "V")
+    assert values["strand_calcfootage"] == pytest.approx(100 + 20 * bom.FEET_PER_METER, rel=1e-3)
@@ -0,0 +1,26 @@
+"""Dense FDHs counted and fetched as quadtree tiles in parallel (TILE_QUERIES)."""
+import pytest
+from conftest import point, write_layers
+
+
+@pytest.fixture
+def dense_poles(bom, portal):
+    """A pole every 10 m across the FDH, one on the corner of the first four tiles and a row of poles outside."""
+    poles = [({"MR_Level": 1}, point(x, y)) for x in range(5, 100, 10) for y in range(5, 100, 10)]
+    poles.append(({"MR_Level": 1}, point(50, 50)))
+    write_layers(bom, portal.folder, {"poles": poles + [({"MR_Level": 2}, point(x, 150)) for x in range(5, 100, 10)]})
+    return len(poles)
+
+
+def test_tiles_return_every_feature_once(bom, dense_poles, fdh_geometry, monkeypatch):
+    monkeypatch.setattr(bom, "TILE_QUERIES", True)
+    monkeypatch.setattr(bom, "TILE_FEATURE_LIMIT", 30)
+    features = bom.query_intersecting("poles", "Strand and Poles", fdh_geometry, out_fields="OBJECTID")
+    object_ids = [feature.attributes["OBJECTID"] for feature in features.features]
+    assert sorted(object_ids) == list(range(1, dense_poles + 1))
+    assert bom.bom_context().request_counts["poles"] > 2  # Counted and fetched per tile
+
+    bom.reset_fdh_state()
+    monkeypatch.setattr(bom, "TILE_FEATURE_LIMIT", None)  # Within one query of the layer: a count and one read
+    assert len(bom.query_intersecting("poles", "Strand and Poles", fdh_geometry).features) == dense_poles
+    assert bom.bom_context().request_counts["poles"] == 2